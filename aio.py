@@ -0,0 +1,611 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+# A small event loop for driving many negotiations from one thread.
+# Coroutines are generators which yield what they are waiting for:
+#   - another coroutine (a generator), which runs to completion first;
+#   - a Future, a Sleep, or a Readable or Writable file descriptor;
+#   - a Command, which runs without blocking the loop.
+# The value of the yield is the result, and errors are raised at the
+# yield. A coroutine returns a value by raising Return(value).
+#
+# The same coroutines can be run synchronously by [wait], which runs
+# Commands with util.run: that is how the blocking API of Drbd and
+# losetup wraps theirs.
+
+import os, time, fcntl, errno, socket, select, subprocess, heapq, collections, types, sys
+import util, rpc
+from util import CommandError, log
+from metrics import metrics
+from tracing import tracer
+
+class Return(Exception):
+    """Raised by a coroutine to return [value]"""
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Future:
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None   # sys.exc_info() of the failure, if any
+        self.callbacks = []
+    def set_result(self, result):
+        self.result = result
+        self._finish()
+    def set_error(self, exc_info):
+        self.error = exc_info
+        self._finish()
+    def _finish(self):
+        self.done = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        for fn in callbacks:
+            fn(self)
+    def add_callback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+    def get(self):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+def succeed(result):
+    """A Future which already has [result]"""
+    f = Future()
+    f.set_result(result)
+    return f
+
+class Sleep:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Readable:
+    def __init__(self, fd):
+        self.fd = fd
+
+class Writable:
+    def __init__(self, fd):
+        self.fd = fd
+
+class Command:
+    """Run [cmd] as util.run (or util.run_as_root if [root]) would"""
+    def __init__(self, cmd, task='unknown', root=False):
+        self.cmd = cmd
+        self.task = task
+        self.root = root
+    def argv(self):
+        if self.root and os.geteuid() <> 0:
+            return [ "sudo" ] + self.cmd
+        return self.cmd
+
+def _trampoline(gen, handle):
+    """Run the coroutine [gen] to completion in this thread, calling
+    [handle x] for each x it yields which isn't a coroutine"""
+    stack = [ gen ]
+    value = None
+    error = None
+    while True:
+        try:
+            if error:
+                x = stack[-1].throw(*error)
+            else:
+                x = stack[-1].send(value)
+        except StopIteration:
+            x, value, error = None, None, None
+            stack.pop()
+        except Return, r:
+            x, value, error = None, r.value, None
+            stack.pop()
+        except:
+            x, value, error = None, None, sys.exc_info()
+            stack.pop()
+        else:
+            if isinstance(x, types.GeneratorType):
+                stack.append(x)
+                value, error = None, None
+                continue
+            try:
+                value, error = handle(x), None
+            except:
+                value, error = None, sys.exc_info()
+            continue
+        if stack == []:
+            if error:
+                raise error[0], error[1], error[2]
+            return value
+
+def _handle_blocking(x):
+    if isinstance(x, Command):
+        return util.run(x.argv(), x.task)
+    if isinstance(x, Future):
+        if not x.done:
+            raise RuntimeError("can't wait for a Future outside a Loop")
+        return x.get()
+    if isinstance(x, Sleep):
+        time.sleep(x.seconds)
+        return None
+    raise TypeError("can't wait for %s outside a Loop" % repr(x))
+
+def wait(x):
+    """Run the coroutine, Command or completed Future [x] in this thread,
+    blocking, and return its result"""
+    if isinstance(x, types.GeneratorType):
+        return _trampoline(x, _handle_blocking)
+    return _handle_blocking(x)
+
+class Semaphore:
+    """Lets [n] coroutines at a time past [acquire]"""
+    def __init__(self, n):
+        self.n = n
+        self.waiters = collections.deque()
+    def acquire(self):
+        """Return a Future which completes when we have a slot"""
+        f = Future()
+        if self.n > 0:
+            self.n = self.n - 1
+            f.set_result(None)
+        else:
+            self.waiters.append(f)
+        return f
+    def release(self):
+        if self.waiters:
+            self.waiters.popleft().set_result(None)
+        else:
+            self.n = self.n + 1
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def run(command, processes=None):
+    """A coroutine running [command] (a Command) like util.run, but reading
+    its output as it becomes available. At most [processes] (a Semaphore)
+    commands run at once."""
+    cmd = command.argv()
+    labels = util._command_labels(cmd, command.task)
+    # a span of its own, if part of a traced negotiation
+    name = labels[0][1]
+    if command.task <> 'unknown':
+        name = "%s %s" % (name, command.task)
+    if processes:
+        yield processes.acquire()
+    span = tracer.begin(name, root=False, push=False)
+    p = None
+    try:
+        start = time.time()
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        except OSError:
+            metrics.increment("drbd_manager_command_errors_total", labels)
+            raise
+        fd = p.stdout.fileno()
+        _set_nonblocking(fd)
+        chunks = []
+        while True:
+            yield Readable(fd)
+            try:
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            if data == "":
+                break
+            chunks.append(data)
+        p.stdout.close()
+        # the output is closed, so it has exited or is about to
+        delay = 0.0005
+        while p.poll() is None:
+            yield Sleep(delay)
+            delay = min(delay * 2, 0.05)
+        metrics.observe("drbd_manager_command_seconds", labels, time.time() - start)
+    except:
+        # closed (GeneratorExit) or failed: don't leave the process behind
+        error = sys.exc_info()
+        if p is not None and p.returncode is None:
+            try:
+                p.kill()
+            except OSError:
+                pass
+            p.wait()
+            p.stdout.close()
+        tracer.end(span, error[1])
+        raise error[0], error[1], error[2]
+    finally:
+        if processes:
+            processes.release()
+    result = "".join(chunks).splitlines(True)
+    if p.returncode <> 0:
+        metrics.increment("drbd_manager_command_errors_total", labels)
+        tracer.end(span, CommandError(p.returncode, result))
+        log("%s: %s exitted with code %d: %s" % (command.task, repr(cmd), p.returncode, repr(result)))
+        raise CommandError(p.returncode, result)
+    tracer.end(span)
+    log("%s: %s" % (command.task, " ".join(cmd)))
+    raise Return(result)
+
+class Task:
+    def __init__(self, gen):
+        self.stack = [ gen ]
+        self.future = Future()
+
+class Loop:
+    """Runs coroutines until they complete. Not thread-safe: use from one
+    thread. At most [max_processes] Commands run at once."""
+    def __init__(self, max_processes=32, clock=time.time):
+        self.clock = clock
+        self.processes = Semaphore(max_processes)
+        self.ready = collections.deque()  # (task, value, exc_info)
+        self.timers = []                  # heap of (time, n, task)
+        self.n = 0
+        self.readers = {}                 # fd -> task
+        self.writers = {}                 # fd -> task
+    def spawn(self, gen):
+        """Start running the coroutine [gen] and return a Future of its
+        result"""
+        task = Task(gen)
+        self.ready.append((task, None, None))
+        return task.future
+    def _wake(self, task, future):
+        if future.error:
+            self.ready.append((task, None, future.error))
+        else:
+            self.ready.append((task, future.result, None))
+    def _step(self, task, value, error):
+        while True:
+            gen = task.stack[-1]
+            try:
+                if error:
+                    x = gen.throw(*error)
+                else:
+                    x = gen.send(value)
+            except StopIteration:
+                x, value, error = None, None, None
+                task.stack.pop()
+            except Return, r:
+                x, value, error = None, r.value, None
+                task.stack.pop()
+            except:
+                x, value, error = None, None, sys.exc_info()
+                task.stack.pop()
+            else:
+                value, error = None, None
+                if isinstance(x, types.GeneratorType):
+                    task.stack.append(x)
+                elif isinstance(x, Command):
+                    task.stack.append(run(x, self.processes))
+                elif isinstance(x, Future):
+                    if x.done:
+                        value, error = x.result, x.error
+                    else:
+                        x.add_callback(lambda f, task=task:self._wake(task, f))
+                        return
+                elif isinstance(x, Sleep):
+                    self.n = self.n + 1
+                    heapq.heappush(self.timers, (self.clock() + x.seconds, self.n, task))
+                    return
+                elif isinstance(x, Readable):
+                    self.readers[x.fd] = task
+                    return
+                elif isinstance(x, Writable):
+                    self.writers[x.fd] = task
+                    return
+                else:
+                    try:
+                        raise TypeError("can't wait for %s" % repr(x))
+                    except TypeError:
+                        error = sys.exc_info()
+                continue
+            if task.stack == []:
+                if error:
+                    task.future.set_error(error)
+                else:
+                    task.future.set_result(value)
+                return
+    def run_once(self, timeout=None):
+        """Run everything which is ready, then wait up to [timeout] seconds
+        (None: until something happens) for more"""
+        for i in range(0, len(self.ready)):
+            task, value, error = self.ready.popleft()
+            self._step(task, value, error)
+        if self.ready:
+            timeout = 0.0
+        elif self.timers:
+            delay = max(0.0, self.timers[0][0] - self.clock())
+            if timeout is None or delay < timeout:
+                timeout = delay
+        elif self.readers == {} and self.writers == {} and timeout is None:
+            # nothing to wait for
+            return
+        try:
+            readable, writable, _ = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+        except select.error, e:
+            if e.args[0] <> errno.EINTR:
+                raise
+            readable, writable = [], []
+        for fd in readable:
+            self.ready.append((self.readers.pop(fd), None, None))
+        for fd in writable:
+            self.ready.append((self.writers.pop(fd), None, None))
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            self.ready.append((heapq.heappop(self.timers)[2], None, None))
+    def run_until_complete(self, gen):
+        """Run the coroutine [gen], and anything it spawns meanwhile, until
+        it completes and return its result"""
+        future = self.spawn(gen)
+        while not future.done:
+            if not (self.ready or self.timers or self.readers or self.writers):
+                raise RuntimeError("deadlock: nothing to wait for")
+            self.run_once()
+        return future.get()
+
+def gather(loop, gens, limit=None):
+    """A coroutine running all of [gens] on [loop], [limit] at a time.
+    Returns a list with each result or, if it failed, the exception."""
+    slots = None
+    if limit:
+        slots = Semaphore(limit)
+    def one(gen):
+        if slots:
+            yield slots.acquire()
+        try:
+            try:
+                result = yield gen
+            except Exception, e:
+                result = e
+        finally:
+            if slots:
+                slots.release()
+        raise Return(result)
+    futures = [ loop.spawn(one(gen)) for gen in gens ]
+    results = []
+    for f in futures:
+        x = yield f
+        results.append(x)
+    raise Return(results)
+
+def _connect(address):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(0)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    code = s.connect_ex(address)
+    if code not in [ 0, errno.EINPROGRESS ]:
+        s.close()
+        raise socket.error(code, os.strerror(code))
+    if code == errno.EINPROGRESS:
+        yield Writable(s.fileno())
+        code = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code <> 0:
+            s.close()
+            raise socket.error(code, os.strerror(code))
+    raise Return(s)
+
+def _send(s, data):
+    while data:
+        yield Writable(s.fileno())
+        try:
+            n = s.send(data)
+        except socket.error, e:
+            if e.args[0] == errno.EAGAIN:
+                continue
+            raise
+        data = data[n:]
+
+def _read(s, n):
+    chunks = []
+    while n > 0:
+        yield Readable(s.fileno())
+        try:
+            data = s.recv(n)
+        except socket.error, e:
+            if e.args[0] == errno.EAGAIN:
+                continue
+            raise
+        if not data:
+            raise EOFError("connection closed")
+        chunks.append(data)
+        n = n - len(data)
+    raise Return("".join(chunks))
+
+class Pool:
+    """The non-blocking counterpart of rpc.Pool, for one Loop"""
+    def __init__(self, size=8):
+        self.size = size
+        self.idle = {}  # (host, port) -> [ socket ]
+    def call(self, address, uri, method, params):
+        """A coroutine calling [method] with [params] on the object at [uri]
+        on the rpc.Server at [address]"""
+        request = rpc.json.dumps({ "uri": uri, "method": method, "params": list(params) }, separators=(",", ":"))
+        request = rpc._length.pack(len(request)) + request
+        x = self.idle.get(address, [])
+        s = None
+        while s is None and x <> []:
+            s = x.pop()
+            if rpc.closed(s):
+                s.close()
+                s = None
+        if s is None:
+            s = yield _connect(address)
+        # as rpc.Pool, never send a request which may have run again
+        try:
+            yield _send(s, request)
+            header = yield _read(s, rpc._length.size)
+            n = rpc._length.unpack(header)[0]
+            if n > rpc.max_message:
+                raise ValueError("message of %d bytes is too big" % n)
+            body = yield _read(s, n)
+        except:
+            s.close()
+            raise
+        x = self.idle.setdefault(address, [])
+        if len(x) < self.size:
+            x.append(s)
+        else:
+            s.close()
+        reply = rpc._str(rpc.json.loads(body))
+        if "error" in reply:
+            raise rpc._error(reply)
+        raise Return(reply["result"])
+    def close(self):
+        for x in self.idle.values():
+            for s in x:
+                s.close()
+        self.idle = {}
+
+class Proxy:
+    """Calls the methods of the remote object at [uri] on the rpc.Server at
+    [address] as coroutines"""
+    def __init__(self, address, uri, pool):
+        self.address = address
+        self.uri = uri
+        self.pool = pool
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *params:self.pool.call(self.address, self.uri, name, params)
+
+class Local:
+    """Calls the methods of [obj] as coroutines: its async_ version if it
+    has one, otherwise the blocking method"""
+    def __init__(self, obj):
+        self.obj = obj
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if hasattr(self.obj, "async_" + name):
+            return getattr(self.obj, "async_" + name)
+        fn = getattr(self.obj, name)
+        return lambda *params:succeed(fn(*params))
+
+import unittest, threading
+class Loop_test(unittest.TestCase):
+    def testSleep(self):
+        """Sleeping coroutines interleave and return their values"""
+        order = []
+        def sleeper(name, seconds):
+            yield Sleep(seconds)
+            order.append(name)
+            raise Return(name)
+        def main(loop):
+            results = yield gather(loop, [ sleeper("b", 0.02), sleeper("a", 0.01) ])
+            raise Return(results)
+        loop = Loop()
+        self.failUnless(loop.run_until_complete(main(loop)) == [ "b", "a" ])
+        self.failUnless(order == [ "a", "b" ])
+    def testErrors(self):
+        """Errors are raised at the yield and can be caught there"""
+        def fail():
+            raise KeyError("x")
+            yield
+        def main():
+            try:
+                yield fail()
+            except KeyError:
+                raise Return("caught")
+        self.failUnless(Loop().run_until_complete(main()) == "caught")
+        self.failUnless(wait(main()) == "caught")
+    def testCommand(self):
+        """Commands run concurrently, [max_processes] at a time"""
+        loop = Loop(max_processes=4)
+        start = time.time()
+        results = loop.run_until_complete(gather(loop, [ Command([ "/bin/sh", "-c", "sleep 0.1; echo x" ]) for i in range(0, 8) ]))
+        elapsed = time.time() - start
+        self.failUnless(results == [ [ "x\n" ] ] * 8)
+        self.failUnless(0.2 <= elapsed < 0.8)
+        x = loop.run_until_complete(gather(loop, [ Command([ "/bin/false" ]) ]))
+        self.failUnless(isinstance(x[0], CommandError))
+        self.failUnless(wait(Command([ "/bin/echo", "y" ])) == [ "y\n" ])
+    def testCommandClosed(self):
+        """A Command closed while running is killed, reaped and traced"""
+        filename = util.make_sparse_file(0)
+        root = tracer.begin("test")
+        try:
+            g = run(Command([ "/bin/sh", "-c", "echo $$ > %s; exec sleep 10" % filename ], "test"))
+            g.next()
+            deadline = time.time() + 5
+            while open(filename).read() == "" and time.time() < deadline:
+                time.sleep(0.01)
+            pid = int(open(filename).read())
+            start = time.time()
+            g.close()
+            self.failUnless(time.time() - start < 1)
+        finally:
+            tracer.end(root)
+            os.unlink(filename)
+        self.failUnless(tracer.current() is None)
+        try:
+            os.kill(pid, 0)
+            self.fail("process %d is still there" % pid)
+        except OSError, e:
+            self.failUnless(e.errno == errno.ESRCH)
+        span = filter(lambda x:x["name"] == "sh test", tracer.dump(root.trace))[0]
+        self.failUnless(span["error"] == "GeneratorExit")
+        self.failUnless(span["parent"] == root.id)
+    def testProxy(self):
+        """Calls to an rpc.Server don't block the loop"""
+        server = rpc.Server(("127.0.0.1", 0), lambda uri, method, params:[ uri, method ] + params)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.start()
+        try:
+            loop = Loop()
+            pool = Pool()
+            proxy = Proxy(server.server_address, "/1", pool)
+            x = loop.run_until_complete(gather(loop, [ proxy.start(i) for i in range(0, 20) ]))
+            self.failUnless(x == [ [ "/1", "start", i ] for i in range(0, 20) ])
+            self.failUnless(len(pool.idle[server.server_address]) == pool.size)
+            pool.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            t.join()
+    def testNoResend(self):
+        """Stale pooled connections are replaced, but a request to a server
+        which dies before replying isn't sent again"""
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        requests = []
+        def serve():
+            c, _ = listener.accept()
+            requests.append(rpc.receive(c))
+            rpc.send(c, { "result": None })
+            c.close()
+            c, _ = listener.accept()
+            requests.append(rpc.receive(c))
+            c.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        try:
+            address = listener.getsockname()
+            pool = Pool()
+            loop = Loop()
+            loop.run_until_complete(pool.call(address, "/", "start", []))
+            # wait for the server to close the pooled connection
+            select.select(pool.idle[address], [], [], 5.0)
+            self.assertRaises(EOFError, lambda:loop.run_until_complete(pool.call(address, "/", "start", [])))
+            t.join()
+            # the closed connection was dropped, and there's no third
+            listener.settimeout(0.1)
+            self.assertRaises(socket.timeout, listener.accept)
+            pool.close()
+        finally:
+            listener.close()
+        self.failUnless(len(requests) == 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,443 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+# Micro-benchmarks. Run all of them with "python benchmark.py" or pick
+# some by name: "python benchmark.py proc_drbd". Benchmarks which return
+# results can save them with "--json FILE" and compare them with an
+# earlier run with "--compare FILE".
+
+import sys, os, time, threading, xmlrpclib, json
+import drbdadm, util, losetup, metrics
+
+def timeit(fn, min_time=0.5):
+    """Call [fn] repeatedly for at least [min_time] seconds and return
+    (number of calls, elapsed seconds)"""
+    n = 0
+    start = time.time()
+    elapsed = 0.0
+    while elapsed < min_time:
+        fn()
+        n = n + 1
+        elapsed = time.time() - start
+    return n, elapsed
+
+def deep_sizeof(x):
+    """Approximate number of bytes used by a Proc_drbd_device and its values"""
+    total = sys.getsizeof(x)
+    for key in x.__slots__:
+        if hasattr(x, key):
+            total = total + sys.getsizeof(getattr(x, key))
+    return total
+
+headers = {
+    "8.0": [ "version: 8.0.14 (api:86/proto:86)\n",
+             "GIT-hash: bb447522fc9a87d0069b7e14f0234911ebdab0f7 build by phil@fat-tyre, 2008-11-12 16:40:33\n" ],
+    "8.3": [ "version: 8.3.11 (api:88/proto:86-96)\n",
+             "srcversion: 71955441799F513ACA6DA60\n" ],
+    "8.4": [ "version: 8.4.3 (api:1/proto:86-101)\n",
+             "GIT-hash: 89a294209144b68adb3ee85a73221f964d3ee515 build by root@host, 2013-07-01 12:00:00\n" ],
+}
+
+def synthetic_proc_drbd(layout, nminors):
+    """Return the lines of a /proc/drbd with [nminors] devices in a mixture
+    of connected, synchronising and unconfigured states"""
+    role = "st"
+    extra = ""
+    if layout <> "8.0":
+        role = "ro"
+        extra = " ep:1 wo:f oos:0"
+    lines = headers[layout] + [ "\n" ]
+    for minor in range(0, nminors):
+        if minor % 10 == 9:
+            lines.append("%2d: cs:Unconfigured\n" % minor)
+            continue
+        if minor % 3 == 0:
+            lines = lines + [
+                "%2d: cs:SyncSource %s:Primary/Secondary ds:UpToDate/Inconsistent C r---\n" % (minor, role),
+                "    ns:%d nr:0 dw:%d dr:%d al:0 bm:0 lo:0 pe:0 ua:0 ap:0%s\n" % (minor * 1024, minor, minor * 1024, extra),
+                "	[>....................] sync'ed:  0.1% (8058/8063)M\n",
+                "	finish: 8:35:44 speed: 12,252 (12,240) K/sec\n" ]
+        else:
+            lines = lines + [
+                "%2d: cs:Connected %s:Primary/Secondary ds:UpToDate/UpToDate C r---\n" % (minor, role),
+                "    ns:%d nr:0 dw:%d dr:%d al:0 bm:504 lo:0 pe:0 ua:0 ap:0%s\n" % (minor * 1024, minor, minor * 1024, extra) ]
+        if layout == "8.0":
+            lines = lines + [
+                "	resync: used:0/61 hits:0 misses:0 starving:0 dirty:0 changed:0\n",
+                "	act_log: used:0/127 hits:0 misses:0 starving:0 dirty:0 changed:0\n" ]
+    return lines
+
+def proc_drbd():
+    """Parse synthetic /proc/drbd dumps with 10, 100 and 1000 minors"""
+    for layout in [ "8.0", "8.3", "8.4" ]:
+        for nminors in [ 10, 100, 1000 ]:
+            lines = synthetic_proc_drbd(layout, nminors)
+            n, elapsed = timeit(lambda:drbdadm.proc_drbd(lines))
+            devices = drbdadm.proc_drbd(lines)["devices"]
+            memory = sum(map(deep_sizeof, devices.values()))
+            print "proc_drbd layout=%s minors=%d: %d lines/s, %d bytes/minor" % (
+                layout, nminors, int(n * len(lines) / elapsed), memory / len(devices))
+
+def replication_port():
+    """Compare finding a free port via netstat with reading /proc/net"""
+    ip = "127.0.0.1"
+    n, elapsed = timeit(lambda:util.used_ports_netstat(ip))
+    print "used_ports_netstat: %.1f us/call" % (elapsed * 1e6 / n)
+    n, elapsed = timeit(lambda:util.used_ports(ip))
+    print "used_ports (/proc/net): %.1f us/call" % (elapsed * 1e6 / n)
+    ports = util.Port_allocator(refresh_interval=0.0)
+    n, elapsed = timeit(lambda:ports.release(ip, ports.reserve(ip)))
+    print "Port_allocator reserve+release (refreshing every call): %.1f us/call" % (elapsed * 1e6 / n)
+    ports = util.Port_allocator()
+    n, elapsed = timeit(lambda:ports.release(ip, ports.reserve(ip)))
+    print "Port_allocator reserve+release (cached): %.1f us/call" % (elapsed * 1e6 / n)
+
+def loop():
+    """Loop device add/remove cycles per second for each backend"""
+    filename = util.make_sparse_file(16L * 1024L * 1024L)
+    try:
+        for backend in [ losetup.Loop_losetup, losetup.Loop_ioctl ]:
+            l = backend()
+            try:
+                n, elapsed = timeit(lambda:l.remove(l.add(filename)))
+            except (OSError, IOError, util.CommandError), e:
+                print "%s: skipped: %s" % (backend.__name__, str(e))
+                continue
+            print "%s: %.1f add/remove cycles/s" % (backend.__name__, n / elapsed)
+    finally:
+        os.unlink(filename)
+
+def percentile(samples, p):
+    """Return the [p]th percentile of a list of numbers"""
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def server(duration=2.0):
+    """Requests/s and p99 latency of drbd.Server with 1, 8 and 64 clients"""
+    import drbd
+    localhost = "127.0.0.1"
+    port = util.replication_port(localhost)
+    s = drbd.Server(localhost, port)
+    # don't measure the cost of logging every request
+    drbd.DRBD.log_message = lambda *args:None
+    s.start()
+    prefix = "http://%s:%d" % (localhost, port)
+    uri = xmlrpclib.Server(prefix + "/", allow_none=True).make("/dev/null", "uuid")
+    try:
+        for nclients in [ 1, 8, 64 ]:
+            latencies = []
+            def client():
+                proxy = xmlrpclib.Server(prefix + uri, allow_none=True)
+                mine = []
+                end = time.time() + duration
+                while time.time() < end:
+                    start = time.time()
+                    proxy.versionExchange("simulator")
+                    mine.append(time.time() - start)
+                latencies.extend(mine)
+            clients = [ threading.Thread(target=client) for i in range(0, nclients) ]
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+            print "server clients=%d: %d requests/s, p50 %.2fms, p99 %.2fms" % (
+                nclients, len(latencies) / duration,
+                percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3)
+    finally:
+        del drbd.peers[uri]
+        s.stop()
+        s.join()
+
+def registry():
+    """Start and stop 100, 1000 and 10000 resources on a Drbd_simulator:
+    the cost per resource shouldn't grow with the number running"""
+    for n in [ 100, 1000, 10000 ]:
+        drbd = drbdadm.Drbd_simulator()
+        configs = [ drbdadm.make_simple_config(i, 20000 + i) for i in range(1, n + 1) ]
+        start = time.time()
+        for config in configs:
+            drbd.start(config)
+        started = time.time()
+        for config in configs:
+            drbd.stop(config)
+        stopped = time.time()
+        print "registry resources=%d: start %.1f us, stop %.1f us per resource" % (
+            n, (started - start) * 1e6 / n, (stopped - started) * 1e6 / n)
+
+class Counting_proxy:
+    """Forwards method calls to [target], counting them by name"""
+    def __init__(self, target, counts, lock):
+        self.target = target
+        self.counts = counts
+        self.lock = lock
+    def __getattr__(self, name):
+        fn = getattr(self.target, name)
+        def call(*args):
+            self.lock.acquire()
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.lock.release()
+            return fn(*args)
+        return call
+
+def negotiate_case(mode, nclients, duration, disk, prefix):
+    """Run negotiations from [nclients] threads for [duration] seconds
+    and return a dictionary of results. In mode "local" the two sides
+    have their own simulated hosts; "localhost" shares one; "contended"
+    shares one kernel between two managers with their own allocators, so
+    they clash; "remote" talks to drbd.Server at [prefix]."""
+    local = drbdadm.Drbd_simulator()
+    if mode == "local":
+        factory = drbdadm.Peer_factory(drbdadm.Drbd_simulator())
+    elif mode == "localhost":
+        factory = drbdadm.Peer_factory(local)
+    elif mode == "contended":
+        remote = drbdadm.Drbd_simulator()
+        remote.configs = local.configs
+        factory = drbdadm.Peer_factory(remote)
+    if mode == "remote":
+        connect = lambda uri:xmlrpclib.Server(prefix + uri, allow_none=True)
+    else:
+        connect = lambda uri:(uri == "/" and factory) or factory.peers[uri]
+    counts = {}
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+    def client(n):
+        i = 0
+        end = time.time() + duration
+        while time.time() < end:
+            uuid = "bench-%d-%d" % (n, i)
+            i = i + 1
+            peer = drbdadm.Peer(local, disk, uuid)
+            uri = None
+            start = time.time()
+            # one kernel can't run two resources with the same name
+            remote_uuid = uuid
+            if mode in [ "localhost", "contended" ]:
+                remote_uuid = uuid + "-remote"
+            try:
+                uri = Counting_proxy(connect("/"), counts, lock).make(disk, remote_uuid)
+                peer.negotiate(Counting_proxy(connect(uri), counts, lock))
+                latencies.append(time.time() - start)
+            except Exception, e:
+                errors.append(str(e))
+            # tidy up outside the measurement
+            peer.close()
+            if uri:
+                connect("/").close([ uri ])
+    clients = [ threading.Thread(target=client, args=(n,)) for n in range(0, nclients) ]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    attempts = len(latencies) + len(errors)
+    if latencies == []:
+        latencies = [ float("nan") ]
+    return {
+        "name": "negotiate mode=%s clients=%d" % (mode, nclients),
+        "negotiations": attempts - len(errors),
+        "errors": len(errors),
+        "error_messages": sorted(set(errors))[:5],
+        "throughput": (attempts - len(errors)) / duration,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "rpcs": counts,
+        "rpcs_per_negotiation": sum(counts.values()) / float(max(1, attempts)),
+        # each reallocation asks the remote side for a fresh config
+        "retries": counts.get("softAllocateResources", 0) - attempts,
+        }
+
+def negotiate(duration=2.0):
+    """Throughput, latency, RPCs and retries of Peer.negotiate against
+    simulated hosts in-process and via drbd.Server with 1, 4 and 16
+    concurrent negotiations"""
+    import drbd
+    localhost = "127.0.0.1"
+    port = util.replication_port(localhost)
+    s = drbd.Server(localhost, port)
+    drbd.DRBD.log_message = lambda *args:None
+    s.start()
+    filename = util.make_sparse_file(16L * 1024L * 1024L * 1024L)
+    l = losetup.Loop()
+    disk = l.add(filename)
+    results = []
+    try:
+        for mode in [ "local", "localhost", "contended", "remote" ]:
+            for nclients in [ 1, 4, 16 ]:
+                x = negotiate_case(mode, nclients, duration, disk, "http://%s:%d" % (localhost, port))
+                print "%s: %.1f/s, p50 %.1fms, p90 %.1fms, p99 %.1fms, %.1f RPCs each, %d retries, %d errors" % (
+                    x["name"], x["throughput"], x["p50"] * 1e3, x["p90"] * 1e3, x["p99"] * 1e3,
+                    x["rpcs_per_negotiation"], x["retries"], x["errors"])
+                results.append(x)
+    finally:
+        s.stop()
+        s.join()
+        l.remove(disk)
+        os.unlink(filename)
+    return results
+
+class Unsplit_peer(drbdadm.Peer):
+    """A receiving Peer which doesn't agree to split the ranges"""
+    def versionExchange(self, other_version):
+        return self.drbd.version()
+
+def _retries():
+    return sum([ metrics.metrics.get("drbd_manager_negotiate_retries_total", (("side", side),)) or 0
+                 for side in [ "local", "remote" ] ])
+
+def allocation(n=100):
+    """Retries in [n] back-to-back negotiations between two managers on
+    one host, with their own allocators, when the receiver splits the
+    minor and port ranges and when it doesn't"""
+    filename = util.make_sparse_file(16L * 1024L * 1024L * 1024L)
+    l = losetup.Loop()
+    disk = l.add(filename)
+    log = drbdadm.log
+    drbdadm.log = lambda *args:None
+    results = []
+    try:
+        for name, receiver in [ ("split", drbdadm.Peer), ("unsplit", Unsplit_peer) ]:
+            local = drbdadm.Drbd_simulator()
+            remote = drbdadm.Drbd_simulator()
+            remote.configs = local.configs
+            before = _retries()
+            latencies = []
+            for i in range(0, n):
+                peers = [ drbdadm.Peer(local, disk, "bench-%d" % i), receiver(remote, disk, "bench-%d-remote" % i) ]
+                start = time.time()
+                peers[0].negotiate(peers[1])
+                latencies.append(time.time() - start)
+                drbdadm.close_peers(peers)
+            x = {
+                "name": "allocation receiver=%s negotiations=%d" % (name, n),
+                "retries": _retries() - before,
+                "throughput": n / sum(latencies),
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                }
+            print "%s: %d retries, %.1f/s, p50 %.1fms, p99 %.1fms" % (
+                x["name"], x["retries"], x["throughput"], x["p50"] * 1e3, x["p99"] * 1e3)
+            results.append(x)
+    finally:
+        drbdadm.log = log
+        l.remove(disk)
+        os.unlink(filename)
+    return results
+
+def rpc(duration=2.0):
+    """Per-call latency of a Peer method over XML-RPC (a new connection
+    per call) and over the compact transport (pooled connections) with 1
+    and 8 clients"""
+    import drbd
+    import rpc as transport
+    localhost = "127.0.0.1"
+    port = util.replication_port(localhost)
+    s = drbd.Server(localhost, port)
+    drbd.DRBD.log_message = lambda *args:None
+    s.start()
+    prefix = "http://%s:%d" % (localhost, port)
+    uri = xmlrpclib.Server(prefix + "/", allow_none=True).make("/dev/null", "uuid")
+    results = []
+    try:
+        for name in [ "xmlrpc", "json" ]:
+            for nclients in [ 1, 8 ]:
+                latencies = []
+                pool = transport.Pool()
+                def client():
+                    proxy = transport.Proxy(prefix + uri, pool, transports=[])
+                    if name == "json":
+                        proxy = transport.Proxy(prefix + uri, pool)
+                        proxy.versionExchange("simulator")
+                    mine = []
+                    end = time.time() + duration
+                    while time.time() < end:
+                        start = time.time()
+                        proxy.versionExchange("simulator")
+                        mine.append(time.time() - start)
+                    latencies.extend(mine)
+                clients = [ threading.Thread(target=client) for i in range(0, nclients) ]
+                for c in clients:
+                    c.start()
+                for c in clients:
+                    c.join()
+                pool.close()
+                x = {
+                    "name": "rpc transport=%s clients=%d" % (name, nclients),
+                    "throughput": len(latencies) / duration,
+                    "p50": percentile(latencies, 50),
+                    "p99": percentile(latencies, 99),
+                    }
+                print "%s: %d calls/s, p50 %.3fms, p99 %.3fms" % (
+                    x["name"], x["throughput"], x["p50"] * 1e3, x["p99"] * 1e3)
+                results.append(x)
+    finally:
+        del drbd.peers[uri]
+        s.stop()
+        s.join()
+    return results
+
+benchmarks = [ proc_drbd, replication_port, loop, server, registry, negotiate, rpc, allocation ]
+
+def revision():
+    """Return the git revision being measured, if we can tell"""
+    try:
+        return util.run([ "git", "describe", "--always", "--dirty" ])[0].strip()
+    except (OSError, util.CommandError):
+        return None
+
+def compare(old, new):
+    """Print how the results in [new] changed since [old]"""
+    before = {}
+    for results in old["results"].values():
+        for x in results:
+            before[x["name"]] = x
+    for results in new["results"].values():
+        for x in results:
+            if x["name"] in before:
+                y = before[x["name"]]
+                print "%s: throughput %.1f -> %.1f/s, p99 %.1f -> %.1fms" % (
+                    x["name"], y["throughput"], x["throughput"], y["p99"] * 1e3, x["p99"] * 1e3)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    output = None
+    old = None
+    if "--json" in args:
+        output = args[args.index("--json") + 1]
+        args.remove(output)
+        args.remove("--json")
+    if "--compare" in args:
+        f = open(args[args.index("--compare") + 1])
+        try:
+            old = json.load(f)
+        finally:
+            f.close()
+        args.remove(args[args.index("--compare") + 1])
+        args.remove("--compare")
+    names = args
+    results = {}
+    for b in benchmarks:
+        if names == [] or b.__name__ in names:
+            x = b()
+            if x is not None:
+                results[b.__name__] = x
+    new = { "revision": revision(), "time": time.time(), "results": results }
+    if output:
+        f = open(output, "w")
+        try:
+            json.dump(new, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if old:
+        compare(old, new)
@@ -11,7 +11,7 @@
 # GNU Lesser General Public License for more details.
 #
 
-import SimpleXMLRPCServer, xmlrpclib, json, sys, drbdadm
+import SimpleXMLRPCServer, xmlrpclib, json, sys, drbdadm, metrics, tracing, rpc
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
@@ -19,24 +19,179 @@ from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 #  so we can use xmlrpclib.Server(URI) as a Peer proxy
 # time out and delete Peers (therefore freeing loops, files)
 
-class Drbd_factory:
+import threading, time
+class Peer_table:
+    """The URI -> Peer table, shared by the request handler threads. Calls
+    to each Peer are serialized by a per-entry lock unless the object was
+    added with [serialize] False (because it does its own locking). The
+    time of the last call to each entry is recorded so that idle ones can
+    be found by [idle]; entries added with [evict] False are never idle."""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}   # URI -> (object, lock or None)
+        self.last_used = {} # URI -> time of the last call, if evictable
+    def add(self, uri, obj, serialize=True, evict=True):
+        lock = None
+        if serialize:
+            lock = threading.Lock()
+        self.lock.acquire()
+        try:
+            self.entries[uri] = (obj, lock)
+            if evict:
+                self.last_used[uri] = self.clock()
+        finally:
+            self.lock.release()
+    def __setitem__(self, uri, obj):
+        self.add(uri, obj)
+    def __getitem__(self, uri):
+        return self.entries[uri][0]
+    def __delitem__(self, uri):
+        self.lock.acquire()
+        try:
+            del self.entries[uri]
+            self.last_used.pop(uri, None)
+        finally:
+            self.lock.release()
+    def __contains__(self, uri):
+        return uri in self.entries
+    def pop(self, uri, default=None, wait=True, keep=None):
+        """Remove the entry for [uri] and return its object, first waiting
+        for a call in progress on it to finish. Without [wait], leave an
+        entry which is in a call and return [default]. Likewise leave an
+        entry whose object [keep] (if given) is true of."""
+        entry = self.entries.get(uri)
+        if entry is None:
+            return default
+        lock = entry[1]
+        if lock is not None and not lock.acquire(wait):
+            return default
+        try:
+            self.lock.acquire()
+            try:
+                if self.entries.get(uri) is not entry:
+                    return default
+                if keep is not None and keep(entry[0]):
+                    return default
+                del self.entries[uri]
+                self.last_used.pop(uri, None)
+            finally:
+                self.lock.release()
+        finally:
+            if lock is not None:
+                lock.release()
+        return entry[0]
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self.entries.keys()
+        finally:
+            self.lock.release()
+    def idle(self, ttl):
+        """Return the URIs which haven't been called for [ttl] seconds"""
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            return [ uri for uri in self.last_used if now - self.last_used[uri] > ttl ]
+        finally:
+            self.lock.release()
+    def call(self, uri, func, params):
+        """Call [func] with [params] on the object at [uri]"""
+        entry = self.entries[uri]
+        obj, lock = entry
+        if uri in self.last_used:
+            self.last_used[uri] = self.clock()
+        if not hasattr(obj, func):
+            raise AttributeError("No such method: %s" % func)
+        if lock is None:
+            return getattr(obj, func)(*params)
+        lock.acquire()
+        try:
+            # it may have been removed (and closed) while we waited
+            if self.entries.get(uri) is not entry:
+                raise KeyError(uri)
+            return getattr(obj, func)(*params)
+        finally:
+            lock.release()
+
+class Drbd_factory(drbdadm.Peer_factory):
     def __init__(self):
-        self.x = 0
-    def make(self, disk, uuid):
-        peer = drbdadm.Peer(drbdadm.Drbd_simulator(), disk, uuid)
-        uri = "/%d" % self.x
-        self.x = self.x + 1
-        peers[uri] = peer
-        return uri
+        drbdadm.Peer_factory.__init__(self, drbdadm.Drbd_simulator(), peers)
 
-peers = {"/": Drbd_factory() }
+peers = Peer_table()
+peers.add("/", Drbd_factory(), serialize=False, evict=False)
+
+class Reaper(threading.Thread):
+    """Every [interval] seconds, close the Peers in [table] which have been
+    idle for [ttl] seconds, so an abandoned negotiation gives back its
+    metadata device, loop, minor and port promptly rather than whenever
+    the garbage collector gets around to it. A Peer in the middle of a
+    call is left alone, as is a started one: its mirror is running, and
+    only an explicit stop or close ends it."""
+    def __init__(self, table, ttl=300.0, interval=10.0):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.table = table
+        self.ttl = ttl
+        self.interval = interval
+        self.stopped = threading.Event()
+    def reap(self):
+        """Close the idle Peers now and return how many there were"""
+        idle = [ self.table.pop(uri, None, wait=False, keep=lambda peer:peer.started)
+                 for uri in self.table.idle(self.ttl) ]
+        idle = filter(lambda peer:peer is not None, idle)
+        drbdadm.close_peers(idle)
+        return len(idle)
+    def run(self):
+        while not self.stopped.isSet():
+            try:
+                self.reap()
+            except Exception, e:
+                drbdadm.log("Reaper: %s" % str(e))
+            self.stopped.wait(self.interval)
+    def stop(self):
+        self.stopped.set()
 
 class DRBD(BaseHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = "HTTP/1.1"
+    # send the headers and body of a reply in one segment
+    wbufsize = -1
 
-    def do_GET(self):
-        self.send_response(200)
+    def handle(self):
+        # Handle a single request: Pool_server waits for the next one on
+        # a keep-alive connection without tying up a worker thread
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def reply(self, code, body, content_type=None):
+        self.send_response(code)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(peers))
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/resync":
+            # cheap enough to poll: the monitor has already parsed /proc/drbd
+            self.reply(200, json.dumps(peers["/"].resyncStatus()))
+            return
+        if self.path == "/metrics":
+            self.reply(200, metrics.metrics.expose(), "text/plain; version=0.0.4")
+            return
+        if self.path == "/trace":
+            # merge with the peers' dumps and render with tracing.timeline
+            self.reply(200, json.dumps(tracing.tracer.dump()))
+            return
+        if self.path == "/trace/timeline":
+            self.reply(200, tracing.timeline(tracing.tracer.dump()), "text/plain")
+            return
+        if self.path == "/trace/folded":
+            self.reply(200, tracing.folded(tracing.tracer.dump()), "text/plain")
+            return
+        self.reply(200, json.dumps(peers.keys()))
 
     def do_POST(self):
         # Simplified version of SimpleXMLRPCRequestHandler.do_POST
@@ -44,50 +199,291 @@ class DRBD(BaseHTTPRequestHandler):
         request_txt = self.rfile.read(l)
         params, func = xmlrpclib.loads(request_txt)
         if self.path not in peers:
-            self.send_response(404)
-            self.end_headers()
+            self.reply(404, "")
             return
-        self.send_response(200)
-        self.end_headers()
-
-        peer = peers[self.path]
+        # continue the caller's trace, if it sent one
+        tracing.tracer.adopt(self.headers.get(tracing.header))
         try:
-            if not hasattr(peer, func):
-                raise "No such method"
-            result = getattr(peer, func)(*params)
-            response = xmlrpclib.dumps((result,))
+            result = peers.call(self.path, func, params)
+            response = xmlrpclib.dumps((result,), methodresponse=True, allow_none=True)
         except:
             exc_type, exc_value, exc_tb = sys.exc_info()
             response = xmlrpclib.dumps(
                 xmlrpclib.Fault(1, "%s:%s" % (exc_type, exc_value)),
                 )
-        # need to call a function with (*params)
-        self.wfile.write(response)
+        tracing.tracer.release()
+        self.reply(200, response)
 
-from threading import Thread
-class Server(Thread):
-    def __init__(self, host, port):
-        Thread.__init__(self)
+import os, time, select, socket, Queue
+class Pool_server(HTTPServer):
+    """An HTTPServer which handles requests on a bounded pool of [threads]
+    worker threads. Between requests, keep-alive connections wait in
+    select() rather than occupying a worker, and are closed after
+    [keepalive_timeout] idle seconds."""
+    def __init__(self, address, handler, threads=16, keepalive_timeout=60.0):
+        HTTPServer.__init__(self, address, handler)
+        self.keepalive_timeout = keepalive_timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = {}   # socket -> (client address, time it became idle)
+        # written to when a connection goes idle, to wake up select()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.workers = []
+        for i in range(0, threads):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+    def get_request(self):
+        request, address = HTTPServer.get_request(self)
+        # replies are small: don't let Nagle hold them back
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return request, address
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, address = item
+            keep = False
+            try:
+                handler = self.RequestHandlerClass(request, address, self)
+                keep = not handler.close_connection
+            except:
+                self.handle_error(request, address)
+            if keep:
+                self.lock.acquire()
+                try:
+                    self.idle[request] = (address, time.time())
+                finally:
+                    self.lock.release()
+                os.write(self.wakeup_w, "x")
+            else:
+                self.shutdown_request(request)
+    def serve_once(self, timeout):
+        """Wait up to [timeout] seconds for new connections or requests and
+        queue them for the workers"""
+        self.lock.acquire()
+        try:
+            idle = self.idle.keys()
+        finally:
+            self.lock.release()
+        try:
+            readable, _, _ = select.select([ self.socket, self.wakeup_r ] + idle, [], [], timeout)
+        except select.error:
+            # a socket was closed under us
+            return
+        now = time.time()
+        for s in readable:
+            if s is self.socket:
+                try:
+                    request, address = self.get_request()
+                except socket.error:
+                    continue
+                self.queue.put((request, address))
+            elif s is self.wakeup_r:
+                os.read(self.wakeup_r, 4096)
+            else:
+                self.lock.acquire()
+                try:
+                    address, _ = self.idle.pop(s)
+                finally:
+                    self.lock.release()
+                self.queue.put((s, address))
+        self.lock.acquire()
+        try:
+            expired = [ s for s in self.idle if now - self.idle[s][1] > self.keepalive_timeout ]
+            for s in expired:
+                del self.idle[s]
+        finally:
+            self.lock.release()
+        for s in expired:
+            self.shutdown_request(s)
+    def server_close(self):
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        for s in self.idle.keys():
+            self.shutdown_request(s)
+        self.idle = {}
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        HTTPServer.server_close(self)
+
+class Server(threading.Thread):
+    """Serves XML-RPC on [port] and, unless [rpc_port] is None, the compact
+    transport of rpc.py on [rpc_port] (0 picks a free one), which our
+    Peers offer in versionExchange"""
+    def __init__(self, host, port, threads=16, ttl=None, rpc_port=0):
+        threading.Thread.__init__(self)
         self.host = host
         self.port = port
         self.stopped = False
-        self.server = HTTPServer((self.host, self.port), DRBD)
+        self.server = Pool_server((self.host, self.port), DRBD, threads)
+        self.rpc = None
+        if rpc_port is not None:
+            self.rpc = rpc.Server((self.host, rpc_port), peers.call)
+        # close Peers which have been idle for [ttl] seconds
+        self.reaper = None
+        if ttl is not None:
+            self.reaper = Reaper(peers, ttl, min(ttl, 10.0))
     def run(self):
+        if self.reaper:
+            self.reaper.start()
+        if self.rpc:
+            t = threading.Thread(target=self.rpc.serve_forever, args=(0.1,))
+            t.setDaemon(True)
+            t.start()
+            peers["/"].transports["json"] = self.rpc.server_address[1]
         while not(self.stopped):
-            self.server.handle_request()
+            self.server.serve_once(0.1)
         print 'stop received, shutting down server'
-        self.server.socket.close()
+        if self.reaper:
+            self.reaper.stop()
+            self.reaper.join()
+        if self.rpc:
+            peers["/"].transports.pop("json", None)
+            self.rpc.shutdown()
+            self.rpc.server_close()
+            t.join()
+        self.server.server_close()
     def stop(self):
         self.stopped = True
-        x = xmlrpclib.Server("http://%s:%d/" % (self.host, self.port))
+
+import unittest, util, losetup
+class Server_test(unittest.TestCase):
+    def testConcurrentKeepalive(self):
+        """More keep-alive clients than worker threads are all served"""
+        localhost = "127.0.0.1"
+        port = util.replication_port(localhost)
+        s = Server(localhost, port, threads=2)
+        s.start()
+        results = []
+        def client():
+            proxy = xmlrpclib.Server("http://%s:%d/" % (localhost, port), allow_none=True)
+            for i in range(0, 5):
+                uri = proxy.make("/dev/null", "uuid")
+                results.append(uri)
+                del peers[uri]
         try:
-            x.ping()
-        except:
-            pass
+            clients = [ threading.Thread(target=client) for i in range(0, 8) ]
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+        finally:
+            s.stop()
+            s.join()
+        self.failUnless(len(set(results)) == 40)
+
+    def testResync(self):
+        """GET /resync returns the status of every resource"""
+        import httplib
+        localhost = "127.0.0.1"
+        port = util.replication_port(localhost)
+        s = Server(localhost, port)
+        s.start()
+        try:
+            c = httplib.HTTPConnection(localhost, port)
+            c.request("GET", "/resync")
+            x = json.loads(c.getresponse().read())
+            c.close()
+        finally:
+            s.stop()
+            s.join()
+        minors = map(lambda r:r["minor"], peers["/"].resyncStatus())
+        peers["/"].drbd.monitor.stop()
+        self.failUnless(map(lambda r:r["minor"], x) == minors)
+
+    def testMetrics(self):
+        """GET /metrics returns the Peer timings in the Prometheus format"""
+        import httplib
+        localhost = "127.0.0.1"
+        port = util.replication_port(localhost)
+        s = Server(localhost, port)
+        s.start()
+        try:
+            proxy = xmlrpclib.Server("http://%s:%d/" % (localhost, port), allow_none=True)
+            uri = proxy.make("/dev/null", "uuid")
+            xmlrpclib.Server("http://%s:%d%s" % (localhost, port, uri)).versionExchange("simulator")
+            del peers[uri]
+            c = httplib.HTTPConnection(localhost, port)
+            c.request("GET", "/metrics")
+            r = c.getresponse()
+            x = r.read()
+            c.close()
+        finally:
+            s.stop()
+            s.join()
+        self.failUnless(r.getheader("Content-Type").startswith("text/plain"))
+        self.failUnless('drbd_manager_peer_seconds_count{method="versionExchange"}' in x)
+
+class Reaper_test(unittest.TestCase):
+    def testReap(self):
+        """Only Peers which have been idle for the ttl are closed"""
+        now = [ 0.0 ]
+        table = Peer_table(clock=lambda:now[0])
+        factory = drbdadm.Peer_factory(drbdadm.Drbd_simulator(), table)
+        table.add("/", factory, serialize=False, evict=False)
+        old = factory.make("/dev/null", "old")
+        now[0] = 50.0
+        new = factory.make("/dev/null", "new")
+        reaper = Reaper(table, ttl=60.0)
+        now[0] = 70.0
+        self.failUnless(reaper.reap() == 1)
+        self.failUnless(sorted(table.keys()) == sorted([ "/", new ]))
+        # a call keeps a Peer alive
+        table.call(new, "versionExchange", [ "simulator" ])
+        now[0] = 125.0
+        self.failUnless(reaper.reap() == 0)
+        now[0] = 200.0
+        self.failUnless(reaper.reap() == 1)
+        self.failUnless(table.keys() == [ "/" ])
+    def testBusy(self):
+        """Peers in the middle of a call are neither reaped nor closed
+        until it finishes"""
+        now = [ 0.0 ]
+        table = Peer_table(clock=lambda:now[0])
+        factory = drbdadm.Peer_factory(drbdadm.Drbd_simulator(), table)
+        uri = factory.make("/dev/null", "busy")
+        peer = table[uri]
+        lock = table.entries[uri][1]
+        lock.acquire()
+        now[0] = 100.0
+        self.failUnless(Reaper(table, ttl=60.0).reap() == 0 and uri in table)
+        t = threading.Thread(target=lambda:factory.close([ uri ]))
+        t.start()
+        t.join(0.1)
+        self.failUnless(t.isAlive() and uri in table)
+        lock.release()
+        t.join()
+        self.failIf(uri in table)
+        self.assertRaises(KeyError, lambda:table.call(uri, "versionExchange", [ "simulator" ]))
+    def testStarted(self):
+        """Started Peers outlive the ttl"""
+        now = [ 0.0 ]
+        table = Peer_table(clock=lambda:now[0])
+        drbd = drbdadm.Drbd_simulator()
+        factory = drbdadm.Peer_factory(drbd, table)
+        filename = util.make_sparse_file(16L * 1024L * 1024L * 1024L)
+        loop = losetup.Loop()
+        disk = loop.add(filename)
+        try:
+            uri = factory.make(disk, "started")
+            local = drbdadm.Peer(drbdadm.Drbd_simulator(), disk, "started")
+            local.negotiate(table[uri])
+            now[0] = 400.0
+            self.failUnless(Reaper(table, ttl=300.0).reap() == 0)
+            self.failUnless(uri in table and len(drbd.configs) == 1)
+            factory.close([ uri ])
+            drbdadm.close_peers([ local ])
+            self.failUnless(len(drbd.configs) == 0)
+        finally:
+            loop.remove(disk)
+            os.unlink(filename)
 
 if __name__ == '__main__':
-    s = Server('', 8081)
+    s = Server('', 8081, ttl=300.0)
     s.start()
     s.join()
-
-
@@ -14,39 +14,143 @@
 import re
 import unittest
 
-def proc_drbd(lines):
-    """Parse [lines] (from /proc/drbd) and return a dictionary"""
-    m = re.match('^version: (\S+)', lines[0])
+# /proc/drbd is polled frequently on hosts with hundreds of minors, so
+# the patterns are compiled once rather than on every line.
+_minor_re = re.compile('^(\d+):\s')
+_version_re = re.compile('^version: (\S+)(?: \(api:([^/]+)/proto:([^)]+)\))?')
+_sync_re = re.compile("sync'ed:\s*([\d.]+)%(?:\s+\((\d+)/(\d+)\)(\S+))?")
+_finish_re = re.compile('finish: (\S+)(?:\s+speed:\s*([\d,]+)(?:\s+\(([\d,]+)\))?)?')
+
+# The I/O counters of a minor, in the order /proc/drbd prints them. 8.0
+# lacks "ep" and "oos"; "wo" (write ordering) is a flag, not a counter.
+_counters = ("ns", "nr", "dw", "dr", "al", "bm", "lo", "pe", "ua", "ap",
+             "ep", "oos")
+_counter_index = dict([ (key, i) for i, key in enumerate(_counters) ])
+_counters_re = re.compile('ns:(\d+) nr:(\d+) dw:(\d+) dr:(\d+) al:(\d+) bm:(\d+) lo:(\d+) pe:(\d+) ua:(\d+) ap:(\d+)(?: ep:(\d+))?(?: wo:(\w))?(?: oos:(\d+))?')
+
+class Proc_drbd_device(object):
+    """The state of one minor from /proc/drbd. The I/O counters are held
+    as a single tuple of integers and fields which were not present are
+    left unset. Supports read-only dictionary access (x["cs"], x["ns"])
+    for fields which are present."""
+    __slots__ = ("cs", "st", "ro", "ds", "wo", "counters",
+                 "progress", "remaining", "total", "units",
+                 "finish", "speed", "speed_avg")
+    def role(self):
+        """Return the role pair: 'st' in 8.0, 'ro' in 8.3 and later"""
+        return self.get("ro", self.get("st"))
+    def keys(self):
+        results = []
+        for key in self.__slots__:
+            if key == "counters":
+                results = results + [ c for c in _counters if self.get(c) is not None ]
+            elif hasattr(self, key):
+                results.append(key)
+        return results
+    def items(self):
+        return [ (key, self.get(key)) for key in self.keys() ]
+    def get(self, key, default=None):
+        if key in _counter_index:
+            counters = getattr(self, "counters", None)
+            if counters is None or counters[_counter_index[key]] is None:
+                return default
+            return counters[_counter_index[key]]
+        if key in _fields:
+            return getattr(self, key, default)
+        return default
+    def __contains__(self, key):
+        return self.get(key) is not None
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+    def __eq__(self, other):
+        if isinstance(other, Proc_drbd_device):
+            other = dict(other.items())
+        return dict(self.items()) == other
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __repr__(self):
+        return "Proc_drbd_device(%s)" % repr(dict(self.items()))
+
+# Fields stored directly in a Proc_drbd_device slot
+_fields = frozenset(Proc_drbd_device.__slots__) - frozenset(["counters"])
+
+def _parse_counters(txt):
+    """Return the tuple of counters and the write-ordering flag from a
+    counters line, tolerating layouts we haven't seen before"""
+    m = _counters_re.match(txt)
     if m:
-        version = m.group(1)
+        g = m.groups()
+        return tuple(map(int, g[:10])) + (g[10] and int(g[10]), g[12] and int(g[12])), g[11]
+    values = {}
+    for bit in txt.split():
+        key, _, val = bit.partition(":")
+        values[key] = val
+    counters = []
+    for key in _counters:
+        if key in values and values[key].isdigit():
+            counters.append(int(values[key]))
+        else:
+            counters.append(None)
+    return tuple(counters), values.get("wo")
+
+def _parse_int(txt):
+    return int(txt.replace(",", ""))
+
+def proc_drbd(lines):
+    """Parse [lines] (from /proc/drbd) and return a dictionary. Understands
+    the 8.0, 8.3 and 8.4 layouts."""
+    version = None
+    api = None
+    proto = None
     minors = {}
-    minor = None
-    device = {}
-    for line in lines[2:]:
-        m = re.match('^\s*(\d+):\s+(.*)', line)
+    device = None
+    for line in lines:
+        txt = line.lstrip()
+        m = _minor_re.match(txt)
         if m:
-            # start of a new minor number
-            if device <> {}:
-                minors[minor] = device
-                device = {}            
-            minor = int(m.group(1))
-            for bit in m.group(2).split():
-                # pull the key:value pairs apart
+            # start of a new minor number (a verify's progress line,
+            # "0% sector pos: ...", also starts with a digit)
+            device = Proc_drbd_device()
+            minors[int(m.group(1))] = device
+            for bit in txt[m.end():].split():
+                # pull the key:value pairs apart, ignoring the protocol
+                # letter and the flags
                 index = bit.find(":")
                 if index <> -1:
                     key = bit[:index]
-                    val = bit[index+1:]
-                    device[key] = val
-        m = re.match(".*sync'ed:\s*(\S+)", line)
-        if m:
-            device["progress"] = float(m.group(1)[:-1])
-        m = re.match("\s*finish: (\S+)", line)
-        if m:
-            device["finish"] = str(m.group(1))
-    if device <> {}:
-        minors[minor] = device
+                    if key in _fields:
+                        setattr(device, key, bit[index+1:])
+        elif device is None:
+            m = _version_re.match(line)
+            if m:
+                version, api, proto = m.groups()
+        elif txt.startswith("ns:"):
+            device.counters, wo = _parse_counters(txt)
+            if wo:
+                device.wo = wo
+        elif txt.startswith("finish:"):
+            m = _finish_re.match(txt)
+            if m:
+                device.finish = m.group(1)
+                if m.group(2):
+                    device.speed = _parse_int(m.group(2))
+                if m.group(3):
+                    device.speed_avg = _parse_int(m.group(3))
+        elif txt.startswith("["):
+            m = _sync_re.search(txt)
+            if m:
+                device.progress = float(m.group(1))
+                if m.group(2):
+                    device.remaining = long(m.group(2))
+                    device.total = long(m.group(3))
+                    device.units = m.group(4)
     return {
         "version": version,
+        "api": api,
+        "proto": proto,
         "devices": minors
         }
 
@@ -109,30 +213,187 @@ class Proc_drbd_test(unittest.TestCase):
         self.failUnless(x["devices"][1]["progress"] - 0.1 < 0.001)
         self.failUnless(x["devices"][1]["finish"] == "8:35:44")
 
-def drbd_conf(config):
-    """Given [config] (a dictionary representing a proposed drbd configuration)
-    return the corresponding drbd.conf"""
-    # XXX: later version of drbd support 'floating' arguments: this
-    # matches on IP rather than hostname (probably better for us)
+    def testCounters(self):
+        """Check that the I/O counters and resync speed are integers"""
+        x = proc_drbd(header + [
+                " 1: cs:SyncSource st:Primary/Secondary ds:UpToDate/Inconsistent C r---\n",
+                "    ns:5592 nr:0 dw:0 dr:5592 al:0 bm:0 lo:0 pe:0 ua:0 ap:0\n",
+                "	[>....................] sync'ed:  0.1% (8058/8063)M\n",
+                "	finish: 8:35:44 speed: 1,252 (240) K/sec\n",
+                ])
+        d = x["devices"][1]
+        self.failUnless(d["ns"] == 5592 and d["dr"] == 5592 and d["nr"] == 0)
+        self.failUnless(d["speed"] == 1252 and d["speed_avg"] == 240)
+        self.failUnless(d.remaining == 8058 and d.total == 8063)
+
+    def testVersion84(self):
+        """Check that the 8.3/8.4 layout ('ro:', 'ep:', 'oos:') parses correctly"""
+        x = proc_drbd([
+                "version: 8.4.3 (api:1/proto:86-101)\n",
+                "GIT-hash: 89a294209144b68adb3ee85a73221f964d3ee515 build by root@host, 2013-07-01 12:00:00\n",
+                " 0: cs:Connected ro:Primary/Secondary ds:UpToDate/UpToDate C r-----\n",
+                "    ns:1024 nr:0 dw:2048 dr:4096 al:3 bm:1 lo:0 pe:0 ua:0 ap:0 ep:1 wo:f oos:0\n",
+                " 1: cs:Unconfigured\n"
+                ])
+        self.failUnless(x["version"] == "8.4.3")
+        self.failUnless(x["api"] == "1" and x["proto"] == "86-101")
+        self.failUnless(x["devices"][0].role() == "Primary/Secondary")
+        self.failUnless(x["devices"][0]["oos"] == 0 and x["devices"][0]["wo"] == "f")
+        self.failUnless(x["devices"][1] == { "cs": "Unconfigured" })
+
+    def testVerify(self):
+        """Check that a verify's progress line isn't taken for a minor"""
+        x = proc_drbd([
+                "version: 8.3.13 (api:88/proto:86-96)\n",
+                " 0: cs:VerifyS ro:Primary/Secondary ds:UpToDate/UpToDate C r-----\n",
+                "    ns:0 nr:0 dw:0 dr:12032 al:0 bm:0 lo:0 pe:0 ua:0 ap:0 ep:1 wo:b oos:0\n",
+                "\t  0% sector pos: 1024/2097152\n",
+                "\tfinish: 0:08:42 speed: 4,000 (4,000) want: 40,960 K/sec\n",
+                " 1: cs:Unconfigured\n"
+                ])
+        self.failUnless(sorted(x["devices"].keys()) == [ 0, 1 ])
+        self.failUnless(x["devices"][0]["cs"] == "VerifyS" and x["devices"][0]["dr"] == 12032)
+        self.failUnless(x["devices"][0]["finish"] == "0:08:42" and x["devices"][0]["speed"] == 4000)
+
+def drbd_conf_header():
+    """Return the global sections of a drbd.conf"""
     return [
         "global {",
         "  usage-count no;",
         "}",
         "common {",
         "  protocol C;",
-        "}",
-        "resource %s {" % config["uuid"],
+        "}"
+        ]
+
+def drbd_conf(config):
+    """Given [config] (a dictionary representing a proposed drbd configuration)
+    return the corresponding drbd.conf"""
+    return drbd_conf_header() + drbd_conf_resource(config)
+
+def drbd_conf_many(configs):
+    """Return a single drbd.conf containing every one of [configs]"""
+    results = drbd_conf_header()
+    for config in configs:
+        results = results + drbd_conf_resource(config)
+    return results
+
+# Named sets of tuning options. "protocol" replaces the common protocol C;
+# the other keys are sections of the resource whose options are either
+# values or True for flags. A host config may name one of these as its
+# "profile" and add "tuning" overrides in the same form, where False
+# removes a flag.
+profiles = {
+    # a fast, low-latency link: keep protocol C, use bigger buffers
+    "lan": {
+        "protocol": "C",
+        "net": { "max-buffers": 8000, "max-epoch-size": 8000, "sndbuf-size": 0 },
+        "syncer": { "al-extents": 3389 },
+        },
+    # a high-latency link: don't wait a round trip for every write
+    "wan": {
+        "protocol": "A",
+        "net": { "max-buffers": 8000, "max-epoch-size": 8000,
+                 "sndbuf-size": "4M", "rcvbuf-size": "4M" },
+        "syncer": { "al-extents": 3389 },
+        },
+    # copying a disk which is about to be thrown away if the migration
+    # fails: trade durability of the copy for throughput
+    "bulk": {
+        "protocol": "A",
+        "net": { "max-buffers": 16000, "max-epoch-size": 16000, "sndbuf-size": 0 },
+        "disk": { "no-disk-flushes": True, "no-md-flushes": True },
+        "syncer": { "al-extents": 3833 },
+        },
+    }
+
+# The resource sections tuning options may appear in, in drbd.conf order
+_tuning_sections = [ "disk", "net", "syncer" ]
+
+class TuningMismatch(Exception):
+    """The two hosts asked for different tuning of the same option"""
+    pass
+
+def _flatten_tuning(host):
+    """Return the tuning [host] asks for as a dictionary of
+    (section, option) -> value, with the protocol under (None, "protocol")"""
+    results = {}
+    if "profile" in host:
+        if host["profile"] not in profiles:
+            raise TuningMismatch("Unknown tuning profile: %s" % host["profile"])
+        tunings = [ profiles[host["profile"]], host.get("tuning", {}) ]
+    else:
+        tunings = [ host.get("tuning", {}) ]
+    for tuning in tunings:
+        for key in tuning:
+            if key == "protocol":
+                results[(None, key)] = tuning[key]
+            else:
+                for option in tuning[key]:
+                    results[(key, option)] = tuning[key][option]
+    return results
+
+def resolve_tuning(a, b):
+    """Return the tuning both hosts [a] and [b] (host configs) will use:
+    everything either asked for, as a dictionary of (section, option) ->
+    value. The result doesn't depend on which is which, so both ends
+    generate the same drbd.conf. Raises TuningMismatch if they asked for
+    different values of the same option."""
+    if a.get("profile") and b.get("profile") and a["profile"] <> b["profile"]:
+        raise TuningMismatch("Tuning profiles differ: %s <> %s" % (a["profile"], b["profile"]))
+    results = _flatten_tuning(a)
+    for key, value in _flatten_tuning(b).items():
+        if key in results and results[key] <> value:
+            raise TuningMismatch("%s %s: %s <> %s" % (key[0], key[1], str(results[key]), str(value)))
+        results[key] = value
+    return results
+
+def _tuning_option(option, value):
+    if value is True:
+        return "    %s;" % option
+    return "    %s %s;" % (option, str(value))
+
+def drbd_conf_tuning(config):
+    """Return the protocol and tuning sections of [config]'s resource"""
+    tuning = resolve_tuning(config["hosts"][0], config["hosts"][1])
+    if "rate" in config:
+        # resync rate in KiB/s (see ratecontrol.py)
+        tuning[("syncer", "rate")] = "%dK" % config["rate"]
+    results = []
+    if (None, "protocol") in tuning:
+        results.append("  protocol %s;" % tuning[(None, "protocol")])
+    for section in _tuning_sections:
+        options = sorted([ key[1] for key in tuning if key[0] == section and tuning[key] is not False ])
+        if options <> []:
+            results = results + [ "  %s {" % section ] + [ _tuning_option(o, tuning[(section, o)]) for o in options ] + [ "  }" ]
+    return results
+
+def _meta_disk(host):
+    """Return the metadata line for [host]: "md" is "internal", a shared
+    volume with a slot "md_index", or a device of its own"""
+    if host["md"] == "internal":
+        return "    meta-disk internal;"
+    if host.get("md_index") is not None:
+        return "    meta-disk %s [%d];" % (host["md"], host["md_index"])
+    return "    flexible-meta-disk %s;" % host["md"]
+
+def drbd_conf_resource(config):
+    """Return the resource section of the drbd.conf for [config]"""
+    # XXX: later version of drbd support 'floating' arguments: this
+    # matches on IP rather than hostname (probably better for us)
+    return [
+        "resource %s {" % config["uuid"] ] + drbd_conf_tuning(config) + [
         "  on %s {" % config["hosts"][0]["name"],
         "    device %s;" % config["hosts"][0]["device"],
         "    disk %s;" % config["hosts"][0]["disk"],
         "    address %s;" % config["hosts"][0]["address"],
-        "    flexible-meta-disk %s;" % config["hosts"][0]["md"],
+        _meta_disk(config["hosts"][0]),
         "  }",
         "  on %s {" % config["hosts"][1]["name"],
         "    device %s;" % config["hosts"][1]["device"],
         "    disk %s;" % config["hosts"][1]["disk"],
         "    address %s;" % config["hosts"][1]["address"],
-        "    flexible-meta-disk %s;" % config["hosts"][1]["md"],
+        _meta_disk(config["hosts"][1]),
         "  }",
         "}"
         ]
@@ -164,10 +425,55 @@ def port_of_config(config):
     """Return the port in use on localhost from a drbd config"""
     return int(get_this_host(config)["address"].split(":")[1])
 
+def ip_of_config(config):
+    """Return the replication IP in use on localhost from a drbd config"""
+    return get_this_host(config)["address"].split(":")[0]
+
 class Drbd_conf_test(unittest.TestCase):
     def testConfigPrint(self):
         """test the drbd.conf printer"""
         x = drbd_conf(make_simple_config(1, 8080))
+    def testConfigMany(self):
+        """Several resources share one set of global sections"""
+        x = drbd_conf_many([make_simple_config(1, 8080), make_simple_config(2, 8081)])
+        self.failUnless(x.count("global {") == 1)
+        self.failUnless("resource 1.8080 {" in x and "resource 2.8081 {" in x)
+    def testRate(self):
+        """A resync rate is written to the syncer section"""
+        config = make_simple_config(1, 8080)
+        self.failIf("  syncer {" in drbd_conf(config))
+        config["rate"] = 10240
+        self.failUnless("    rate 10240K;" in drbd_conf(config))
+    def testProfile(self):
+        """A profile asked for by either host is used by both"""
+        config = make_simple_config(1, 8080)
+        config["hosts"] = [ dict(config["hosts"][0]), dict(config["hosts"][1], profile="wan") ]
+        x = drbd_conf(config)
+        self.failUnless("  protocol A;" in x and "    max-buffers 8000;" in x)
+        config["hosts"].reverse()
+        self.failUnless(drbd_conf(config) == x)
+    def testOverride(self):
+        """Overrides are merged with the profile and False drops a flag"""
+        config = make_simple_config(1, 8080)
+        config["hosts"] = [ dict(config["hosts"][0], profile="bulk", tuning={ "protocol": "B", "disk": { "no-md-flushes": False } }),
+                            dict(config["hosts"][1], tuning={ "net": { "max-buffers": 16000 } }) ]
+        x = drbd_conf(config)
+        self.failUnless("  protocol B;" in x and "    no-disk-flushes;" in x)
+        self.failIf("    no-md-flushes;" in x)
+    def testMetaDisk(self):
+        """Metadata may be internal, in an indexed slot or a device"""
+        config = make_simple_config(1, 8080)
+        config["hosts"] = [ dict(config["hosts"][0], md="internal"), dict(config["hosts"][1], md="/dev/loop1", md_index=3) ]
+        x = drbd_conf(config)
+        self.failUnless("    meta-disk internal;" in x and "    meta-disk /dev/loop1 [3];" in x)
+        self.failIf("flexible-meta-disk" in x)
+        self.failUnless("    flexible-meta-disk /dev/loop0;" in drbd_conf(make_simple_config(1, 8080)))
+    def testMismatch(self):
+        """Hosts asking for different values of an option don't agree"""
+        a = { "tuning": { "net": { "max-buffers": 100 } } }
+        b = { "profile": "lan" }
+        self.assertRaises(TuningMismatch, lambda:resolve_tuning(a, b))
+        self.assertRaises(TuningMismatch, lambda:resolve_tuning({ "profile": "wan" }, b))
 
 import math
 def size_needed_for_md(bytes_per_sector, sectors):
@@ -177,11 +483,27 @@ def size_needed_for_md(bytes_per_sector, sectors):
     ms = long(math.ceil(float(sectors) / (2.0 ** 18)) * 8L) + 72L
     return ms * bytes_per_sector
 
+def size_needed_for_md_many(geometries):
+    """size_needed_for_md of each of [geometries], a list of
+    (bytes_per_sector, sectors)"""
+    # ceil(sectors / 2^18) in integer arithmetic
+    return [ ((((sectors + (1L << 18) - 1) >> 18) << 3) + 72L) * bytes_per_sector for bytes_per_sector, sectors in geometries ]
+
+def md_sizes(disks):
+    """The metadata size needed by each of [disks], eg all of a VM's. The
+    geometry of each is read in-process and cached: see
+    util.Block_device_cache."""
+    return size_needed_for_md_many(map(util.block_device_geometry, disks))
+
 class Size_needed_for_md_test(unittest.TestCase):
     def testSmall(self):
         """Test the metadata disk size calculation"""
         size = size_needed_for_md(512, 8L * 1024L * 1024L * 2L)
         self.failUnless(size == 299008L)
+    def testMany(self):
+        """The batch form agrees with the original"""
+        geometries = [ (512, 0L), (512, 1L), (4096, 1L << 18), (512, (1L << 18) + 1), (512, 8L * 1024L * 1024L * 2L) ]
+        self.failUnless(size_needed_for_md_many(geometries) == [ size_needed_for_md(b, s) for b, s in geometries ])
 
 def free_minor_number(drbd):
     """Returns a DRBD minor number which is currently free. Note someone
@@ -221,9 +543,152 @@ class Free_minor_number_test(unittest.TestCase):
         self.failUnless(free_minor_number({"devices": devices}) == 4
 )
 
-# Where we will store our drbd.conf fragments
+import time, heapq, threading
+
+def _outside(part, length):
+    """Return a bitmap, at least [length] bits long, of the numbers outside
+    [part] (see Minor_allocator.reserve)"""
+    index, count = part
+    pattern = ((1L << count) - 1) & ~(1L << index)
+    repeats = length / count + 1
+    # [pattern] repeated [repeats] times
+    return pattern * (((1L << (count * repeats)) - 1) / ((1L << count) - 1))
+
+class Minor_allocator:
+    """Hands out DRBD minor numbers which are currently free. Minors
+    configured in the kernel and minors handed out by [reserve] are tracked
+    as bitmaps so the next free minor is found without a scan. A
+    reservation is a lease: unless [use] or [release] is called it expires
+    after [lease] seconds, so an abandoned negotiation can't leak minors.
+    Safe to share between threads."""
+    def __init__(self, lease=60.0, clock=time.time):
+        self.lease = lease
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.used = 1L       # bit n set => minor n configured (0 is never used)
+        self.reserved = 0L   # bit n set => minor n leased by reserve()
+        self.expiry = {}     # minor -> time its lease expires
+        self.leases = []     # heap of (expiry, minor)
+    def _expire(self, now):
+        while self.leases and self.leases[0][0] <= now:
+            expiry, minor = heapq.heappop(self.leases)
+            # a lease may have been renewed, used or released since
+            if self.expiry.get(minor) == expiry:
+                del self.expiry[minor]
+                self.reserved = self.reserved & ~(1L << minor)
+    def refresh(self, devices):
+        """Replace the set of configured minors with [devices] (as returned
+        by proc_drbd). Unconfigured minors count as free."""
+        used = 1L
+        for minor in devices:
+            if devices[minor].get("cs") <> "Unconfigured":
+                used = used | (1L << minor)
+        self.lock.acquire()
+        try:
+            self.used = used
+        finally:
+            self.lock.release()
+    def reserve(self, part=None):
+        """Return the lowest minor which is neither configured nor leased,
+        and lease it. With [part], an [index, count] pair, only minors n
+        with n % count == index are considered."""
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            self._expire(now)
+            taken = self.used | self.reserved
+            if part:
+                taken = taken | _outside(part, taken.bit_length() + part[1])
+            # the lowest clear bit of [taken]
+            minor = (~taken & (taken + 1)).bit_length() - 1
+            expiry = now + self.lease
+            self.reserved = self.reserved | (1L << minor)
+            self.expiry[minor] = expiry
+            heapq.heappush(self.leases, (expiry, minor))
+            return minor
+        finally:
+            self.lock.release()
+    def use(self, minor):
+        """Record that [minor] is now configured, ending any lease"""
+        self.lock.acquire()
+        try:
+            self.used = self.used | (1L << minor)
+            self.reserved = self.reserved & ~(1L << minor)
+            self.expiry.pop(minor, None)
+        finally:
+            self.lock.release()
+    def cancel(self, minor):
+        """End the lease on [minor] if it was never used"""
+        self.lock.acquire()
+        try:
+            self.reserved = self.reserved & ~(1L << minor)
+            self.expiry.pop(minor, None)
+        finally:
+            self.lock.release()
+    def release(self, minor):
+        """Record that [minor] is free again"""
+        self.lock.acquire()
+        try:
+            self.used = self.used & ~(1L << minor)
+            self.reserved = self.reserved & ~(1L << minor)
+            self.expiry.pop(minor, None)
+        finally:
+            self.lock.release()
+    def in_use(self, minor):
+        return (self.used >> minor) & 1 == 1
+
+class Minor_allocator_test(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.minors = Minor_allocator(lease=10.0, clock=lambda:self.now)
+    def testReserve(self):
+        """Reservations never hand out the same minor twice"""
+        x = [ self.minors.reserve() for i in range(0, 100) ]
+        self.failUnless(x == range(1, 101))
+    def testRefresh(self):
+        """Configured minors are skipped, Unconfigured ones reused"""
+        self.minors.refresh({
+            1: { "cs": "Connected" },
+            2: { "cs": "Unconfigured" },
+            3: { "cs": "Connected" }
+            })
+        self.failUnless(self.minors.reserve() == 2)
+        self.failUnless(self.minors.reserve() == 4)
+    def testPart(self):
+        """Reservations from different parts never overlap"""
+        self.failUnless([ self.minors.reserve([ 0, 2 ]) for i in range(0, 3) ] == [ 2, 4, 6 ])
+        self.failUnless([ self.minors.reserve([ 1, 2 ]) for i in range(0, 3) ] == [ 1, 3, 5 ])
+        self.failUnless(self.minors.reserve() == 7)
+        self.failUnless(self.minors.reserve([ 2, 3 ]) == 8)
+    def testLeaseExpiry(self):
+        """An unused reservation is returned to the pool when it expires"""
+        a = self.minors.reserve()
+        b = self.minors.reserve()
+        self.minors.use(b)
+        self.now = 11.0
+        self.failUnless(self.minors.reserve() == a)
+        self.failUnless(self.minors.reserve() == b + 1)
+    def testCancel(self):
+        """Cancelling a lease doesn't free a minor which is in use"""
+        a = self.minors.reserve()
+        b = self.minors.reserve()
+        self.minors.use(a)
+        self.minors.cancel(a)
+        self.minors.cancel(b)
+        self.failUnless(self.minors.reserve() == b)
+    def testRelease(self):
+        """A released minor is handed out again"""
+        a = self.minors.reserve()
+        self.minors.use(a)
+        self.minors.release(a)
+        self.failUnless(self.minors.reserve() == a)
+
+# Where we will store our drbd.conf and its fragments
 conf_dir = "/var/run/sm/drbd"
 
+# How often (in seconds) Drbd re-reads /proc/drbd when allocating minors
+proc_drbd_refresh_interval = 5.0
+
 class TransientException(Exception):
     """An exception which should be handled by retrying"""
     pass
@@ -242,107 +707,837 @@ class PortInUse(TransientException):
     def __str__(self):
         return "The port number %d is in use" % self.port
 
+class ResourceInUse(Exception):
+    """A resource with the requested uuid is already running: not
+    transient, since reallocating wouldn't change its name"""
+    def __init__(self, uuid):
+        self.uuid = uuid
+    def __str__(self):
+        return "The DRBD resource %s is already in use" % self.uuid
+
+# The states of a resource in a Registry
+ALLOCATED = "allocated"     # configured, but not attached to its disk
+ATTACHED = "attached"       # attached, so holding its minor
+CONNECTED = "connected"     # connected, so holding its port too
+
+_transitions = {
+    ALLOCATED: [ ATTACHED, CONNECTED ],
+    ATTACHED: [ ALLOCATED, CONNECTED ],
+    CONNECTED: [ ATTACHED ],
+    }
+
+class Registry:
+    """The resources a Drbd or Drbd_simulator is running, indexed by
+    uuid, minor and (IP, port) so that adding, finding and removing one
+    costs the same however many there are. Behaves like a read-only
+    dictionary of uuid -> config. Safe to share between threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configs = {}   # uuid -> config
+        self.states = {}    # uuid -> state
+        self.minors = {}    # minor -> uuid
+        self.ports = {}     # (IP, port) -> uuid
+    def add(self, config):
+        """Register [config] as ALLOCATED. Raises ResourceInUse if a
+        resource with the same uuid is registered, or MinorInUse or
+        PortInUse if another resource has its minor or port."""
+        uuid = config["uuid"]
+        minor = minor_of_config(config)
+        port = (ip_of_config(config), port_of_config(config))
+        self.lock.acquire()
+        try:
+            if uuid in self.configs:
+                raise ResourceInUse(uuid)
+            if minor in self.minors:
+                raise MinorInUse(minor)
+            if port in self.ports:
+                raise PortInUse(port[1])
+            self.configs[uuid] = config
+            self.states[uuid] = ALLOCATED
+            self.minors[minor] = uuid
+            self.ports[port] = uuid
+        finally:
+            self.lock.release()
+    def _remove(self, uuid):
+        config = self.configs.pop(uuid, None)
+        if config is None:
+            return None
+        del self.states[uuid]
+        del self.minors[minor_of_config(config)]
+        del self.ports[(ip_of_config(config), port_of_config(config))]
+        return config
+    def remove(self, uuid):
+        """Forget [uuid] and return its config, or None if we didn't
+        know it"""
+        self.lock.acquire()
+        try:
+            return self._remove(uuid)
+        finally:
+            self.lock.release()
+    def state(self, uuid):
+        return self.states.get(uuid)
+    def set_state(self, uuid, state):
+        self.lock.acquire()
+        try:
+            if state not in _transitions[self.states[uuid]]:
+                raise ValueError("%s: %s -> %s" % (uuid, self.states[uuid], state))
+            self.states[uuid] = state
+        finally:
+            self.lock.release()
+    def by_minor(self, minor):
+        """Return the config using [minor], or None"""
+        uuid = self.minors.get(minor)
+        return uuid and self.configs.get(uuid)
+    def by_port(self, ip, port):
+        """Return the config using [port] on [ip], or None"""
+        uuid = self.ports.get((ip, port))
+        return uuid and self.configs.get(uuid)
+    def get(self, uuid, default=None):
+        return self.configs.get(uuid, default)
+    def __getitem__(self, uuid):
+        return self.configs[uuid]
+    def __contains__(self, uuid):
+        return uuid in self.configs
+    def __len__(self):
+        return len(self.configs)
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self.configs.keys()
+        finally:
+            self.lock.release()
+    def values(self):
+        self.lock.acquire()
+        try:
+            return self.configs.values()
+        finally:
+            self.lock.release()
+
+class Registry_test(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+    def testIndexes(self):
+        """Resources can be found by uuid, minor and port"""
+        config = make_simple_config(3, 8080)
+        self.registry.add(config)
+        self.failUnless(self.registry["3.8080"] is config)
+        self.failUnless(self.registry.by_minor(3) is config)
+        self.failUnless(self.registry.by_port("127.0.0.1", 8080) is config)
+        self.failUnless(self.registry.remove("3.8080") is config)
+        self.failUnless(self.registry.by_minor(3) is None and len(self.registry) == 0)
+        self.failUnless(self.registry.minors == {} and self.registry.ports == {})
+    def testClash(self):
+        """A second resource can't take a minor or port in use"""
+        self.registry.add(make_simple_config(3, 8080))
+        self.assertRaises(MinorInUse, lambda:self.registry.add(make_simple_config(3, 8081)))
+        self.assertRaises(PortInUse, lambda:self.registry.add(make_simple_config(4, 8080)))
+        self.failUnless(self.registry.keys() == [ "3.8080" ])
+    def testDuplicate(self):
+        """A resource isn't replaced by another with its uuid"""
+        config = make_simple_config(3, 8080)
+        self.registry.add(config)
+        other = dict(make_simple_config(4, 8081), uuid="3.8080")
+        self.assertRaises(ResourceInUse, lambda:self.registry.add(other))
+        self.failUnless(self.registry["3.8080"] is config and self.registry.by_minor(4) is None)
+    def testStates(self):
+        """Resources move between states in order"""
+        self.registry.add(make_simple_config(3, 8080))
+        self.failUnless(self.registry.state("3.8080") == ALLOCATED)
+        self.registry.set_state("3.8080", ATTACHED)
+        self.registry.set_state("3.8080", CONNECTED)
+        self.assertRaises(ValueError, lambda:self.registry.set_state("3.8080", ALLOCATED))
+
+class Conf_manager:
+    """Keeps the configuration of every resource we run in [directory]: a
+    main drbd.conf holding the global sections includes one fragment per
+    resource. A fragment is only rewritten when the resource changes, and
+    is replaced atomically so drbdadm never reads half of one. Any number
+    of resources can then be acted on with one drbdadm command."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.main = os.path.join(directory, "drbd.conf")
+        self.lock = threading.Lock()
+        self.written = {}   # uuid -> lines of its fragment on disk
+        self.main_written = False
+    def fragment(self, uuid):
+        return os.path.join(self.directory, uuid + ".res")
+    def _write(self, filename, lines):
+        tmp = filename + ".tmp"
+        f = open(tmp, "w")
+        try:
+            f.write("\n".join(lines) + "\n")
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+    def _write_main(self):
+        if self.main_written:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._write(self.main, drbd_conf_header() + [
+            'include "%s";' % os.path.join(self.directory, "*.res") ])
+        self.main_written = True
+    def update(self, configs):
+        """Write the fragments of [configs] which have changed and return
+        their uuids"""
+        changed = []
+        self.lock.acquire()
+        try:
+            self._write_main()
+            for config in configs:
+                lines = drbd_conf_resource(config)
+                if self.written.get(config["uuid"]) <> lines:
+                    self._write(self.fragment(config["uuid"]), lines)
+                    self.written[config["uuid"]] = lines
+                    changed.append(config["uuid"])
+        finally:
+            self.lock.release()
+        return changed
+    def remove(self, uuids):
+        """Delete the fragments of [uuids]"""
+        self.lock.acquire()
+        try:
+            for uuid in uuids:
+                if os.path.exists(self.fragment(uuid)):
+                    os.unlink(self.fragment(uuid))
+                self.written.pop(uuid, None)
+        finally:
+            self.lock.release()
+
 class Drbd:
     """Represents the real drbd system"""
-    def _read_proc_drbd():
+    def _read_proc_drbd(self):
         return proc_drbd(util.read_file("/proc/drbd"))
-    def _get_drbdadm_conf(self, config):
-        return conf_dir + "/" + config["uuid"]
+    def _drbdadm(self, args, names):
+        """Return an aio.Command running drbdadm [args] over the resources
+        [names]"""
+        return aio.Command(["/sbin/drbdadm", "-c", self.conf.main] + args + names, args[0])
     def _run_drbdadm(self, config, args):
-        util.run(["/sbin/drbdadm", "-c", self._get_drbdadm_conf(config)] + args + [self.config["uuid"]])
+        return self._drbdadm(args, [ config["uuid"] ])
     
-    def __init__(self):
-        self.configs = []
-        self.connected = {}
-        self.allocated_minors = {}
+    def __init__(self, minors=None, ports=None, md_pool=None, monitor_interval=1.0, directory=None, md_volume=None):
+        self.configs = Registry()
+        if directory is None:
+            directory = conf_dir
+        self.conf = Conf_manager(directory)
+        if minors is None:
+            minors = Minor_allocator()
+        self.minors = minors
+        self.minors_refreshed = None
+        if ports is None:
+            ports = util.port_allocator
+        self.ports = ports
+        # an optional mdpool.Md_pool of ready-made metadata devices
+        self.md_pool = md_pool
+        # an optional mdpool.Md_volume of shared metadata slots, used in
+        # preference to the pool
+        self.md_volume = md_volume
+        self.monitor = monitor.Resync_monitor(self._read_proc_drbd, monitor_interval)
     def version(self):
         drbd = self._read_proc_drbd()
         return drbd["version"]
-    def get_free_minor_number(self):
-        return free_minor_number(self.read_proc_drbd())
+    def resync_status(self):
+        """Return minor -> resync status (see monitor.Resync_monitor).
+        /proc/drbd is sampled in the background from the first call."""
+        if self.monitor.thread is None:
+            self.monitor.sample()
+            self.monitor.start()
+        return self.monitor.status()
+    def get_free_minor_number(self, part=None):
+        # Minors we configure ourselves are recorded as we go and a clash
+        # with a third party surfaces as MinorInUse, so /proc/drbd only
+        # needs re-reading occasionally
+        now = time.time()
+        if self.minors_refreshed is None or now - self.minors_refreshed > proc_drbd_refresh_interval:
+            self.minors.refresh(self._read_proc_drbd()["devices"])
+            self.minors_refreshed = now
+        return self.minors.reserve(part)
     def get_replication_ip(self):
-        return util.get_replication_ip()
-    def get_replication_port(self, ip):
-        return util.get_replication_port(ip)
+        return util.replication_ip()
+    def get_replication_port(self, ip, part=None):
+        return self.ports.reserve(ip, part)
+    def set_resync_rate(self, minor, rate):
+        """Change the resync rate of our resource on [minor] to [rate]
+        KiB/s while it is running"""
+        config = self.configs.by_minor(minor)
+        if config is None:
+            raise KeyError(minor)
+        config["rate"] = int(rate)
+        self.reconfigure([ config ])
+    def reconfigure(self, configs):
+        """Apply changes to the running resources [configs] with one
+        "drbdadm adjust" over just those which changed. Returns their
+        uuids."""
+        changed = self.conf.update(configs)
+        if changed <> []:
+            aio.wait(self._drbdadm(["adjust"], changed))
+        return changed
+    def _forget(self, uuid):
+        """Release the minor and port of [uuid], which DRBD has already
+        let go of, and forget it"""
+        state = self.configs.state(uuid)
+        config = self.configs.remove(uuid)
+        if state == CONNECTED:
+            self.ports.release(ip_of_config(config), port_of_config(config))
+        if state in [ ATTACHED, CONNECTED ]:
+            self.minors.release(minor_of_config(config))
+    # The commands of start, stop and stop_many are run by coroutines (see
+    # aio) which the blocking methods wrap
+    def async_stop(self, config):
+        # drbdadm down is idempotent and so are we
+        uuid = config["uuid"]
+        config = self.configs.get(uuid)
+        if config is None:
+            return
+        if self.configs.state(uuid) == CONNECTED:
+            yield self._run_drbdadm(config, ["disconnect"])
+            self.configs.set_state(uuid, ATTACHED)
+            self.ports.release(ip_of_config(config), port_of_config(config))
+        if self.configs.state(uuid) == ATTACHED:
+            yield self._run_drbdadm(config, ["detach"])
+            self.configs.set_state(uuid, ALLOCATED)
+            self.minors.release(minor_of_config(config))
+        self.configs.remove(uuid)
+        self.conf.remove([ uuid ])
     def stop(self, config):
-        if config in self.connected:
-            self._run_drbdadm(config, ["disconnect"])
-            self.connected.remove(config)
-        if config in self.allocated_minors:
-            self._run_drbdadm(config, ["detach"])
-            self.allocated_minors.remove(config)
-        self.configs.remove(config)
-        os.unlink(self._get_drbdadm_conf(config))
+        aio.wait(self.async_stop(config))
 
-    def _start(self, config):
-        self.configs.append(config)
-        os.makedirs(conf_dir)
-        f = open(self._get_drbdadm_conf(config), "w")
+    def async_stop_many(self, configs):
+        uuids = [ c["uuid"] for c in configs if c["uuid"] in self.configs ]
+        if uuids == []:
+            return
         try:
-            f.write(drbd_conf(config))
-        finally:
-            f.close()
+            yield self._drbdadm(["down"], uuids)
+        except CommandError, e:
+            log("stop_many: %s: stopping one at a time" % str(e))
+            for config in configs:
+                yield self.async_stop(config)
+            return
+        for uuid in uuids:
+            self._forget(uuid)
+        self.conf.remove(uuids)
+    def stop_many(self, configs):
+        """Stop all of [configs] with one drbdadm down"""
+        aio.wait(self.async_stop_many(configs))
+
+    def _start(self, config):
+        uuid = config["uuid"]
+        self.conf.update([ config ])
         try:
             # Since we expect to occasionally clash over minor numbers we
             # mustn't use "up" and "down": "up" would fail and then "down"
             # would bring down someone else's device
-            if config in self.allocated_minors:
-                self.allocated_minors.remove(config)
-            if config in self.connected:
-                self.connected.remove(config)
-            self._run_drbdadm(config, ["create-dm"])
-            self._run_drbdadm(config, ["attach"])
-            self.allocated_minors.append(config)
-            self._run_drbdadm(config, ["syncer"])
-            self._run_drbdadm(config, ["connect"])
-            self.connected.add(config)
+            yield self._run_drbdadm(config, ["create-md"])
+            yield self._run_drbdadm(config, ["attach"])
+            self.configs.set_state(uuid, ATTACHED)
+            self.minors.use(minor_of_config(config))
+            yield self._run_drbdadm(config, ["syncer"])
+            self.ports.handover(ip_of_config(config), port_of_config(config))
+            yield self._run_drbdadm(config, ["connect"])
+            self.configs.set_state(uuid, CONNECTED)
+            self.ports.use(ip_of_config(config), port_of_config(config))
         except CommandError, e:
             # Device '/dev/drbdN' is configured!
             if e.code <> 0 and e.output[0].endswith("is configured!\n"):
+                self.minors.use(minor_of_config(config))
                 raise MinorInUse(minor_of_config(config))
             # /dev/drbd2: Failure: (102) Local address(port) already in use.
             elif e.code <> 0 and e.output[0].endswith("Local address(port) already in use.\n"):
+                self.ports.use(ip_of_config(config), port_of_config(config))
                 raise PortInUse(port_of_config(config))
             else:
                 raise
+    def async_start(self, config):
+        # a clash with one of our own resources needn't wait for drbdadm
+        self.configs.add(config)
+        try:
+            yield self._start(config)
+        except:
+            # the yield below would lose the exception
+            error = sys.exc_info()
+            yield self.async_stop(config)
+            raise error[0], error[1], error[2]
+    def start(self, config):
+        aio.wait(self.async_start(config))
+    def start_many(self, configs):
+        """Start all of [configs] with one "drbdadm create-md" and one
+        "drbdadm adjust" over our multi-resource drbd.conf. Returns a
+        dictionary of uuid -> None if the resource started or the exception
+        (eg MinorInUse, PortInUse) which starting it alone would have
+        raised. Failed resources have already been stopped."""
+        results = {}
+        # "adjust" would happily reconfigure someone else's device, so
+        # refuse minors which are already configured
+        devices = self._read_proc_drbd()["devices"]
+        self.minors.refresh(devices)
+        self.minors_refreshed = time.time()
+        todo = []
+        for config in configs:
+            minor = minor_of_config(config)
+            if minor in devices and devices[minor].get("cs") <> "Unconfigured":
+                results[config["uuid"]] = MinorInUse(minor)
+                continue
+            try:
+                self.configs.add(config)
+            except TransientException, e:
+                results[config["uuid"]] = e
+                continue
+            todo.append(config)
+            self.ports.handover(ip_of_config(config), port_of_config(config))
+        if todo == []:
+            return results
+        self.conf.update(todo)
+        names = map(lambda x:x["uuid"], todo)
+        output = []
+        failure = None
+        for args in [ ["create-md"], ["adjust"] ]:
+            try:
+                output = output + aio.wait(self._drbdadm(args, names))
+            except CommandError, e:
+                output = output + e.output
+                failure = e
+        errors = drbdadm_errors(output, todo)
+        for config in todo:
+            minor = minor_of_config(config)
+            ip = ip_of_config(config)
+            port = port_of_config(config)
+            error = errors.get(config["uuid"])
+            if error is None and failure and errors == {}:
+                # drbdadm failed without saying which resource was at fault
+                error = failure
+            if error is None:
+                self.configs.set_state(config["uuid"], CONNECTED)
+                self.minors.use(minor)
+                self.ports.use(ip, port)
+            else:
+                if isinstance(error, MinorInUse):
+                    self.minors.use(minor)
+                else:
+                    # we may have attached before failing to connect
+                    self.configs.set_state(config["uuid"], ATTACHED)
+                if isinstance(error, PortInUse):
+                    self.ports.use(ip, port)
+                try:
+                    self.stop(config)
+                except CommandError, e:
+                    log("%s: cleaning up after %s: %s" % (config["uuid"], str(error), str(e)))
+            results[config["uuid"]] = error
+        return results
+
+class Recording_drbd(Drbd):
+    """A Drbd which records the drbdadm commands it would run"""
+    def __init__(self, directory):
+        Drbd.__init__(self, ports=util.Port_allocator(read=lambda:{}), directory=directory)
+        self.commands = []
+    def _read_proc_drbd(self):
+        return proc_drbd(header)
+    def _drbdadm(self, args, names):
+        self.commands.append((args, names))
+        return aio.succeed([])
+
+class Conf_manager_test(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.drbd = Recording_drbd(self.directory)
+        self.configs = [ make_simple_config(i, 8000 + i) for i in range(1, 101) ]
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+    def testMain(self):
+        """The main drbd.conf includes every fragment"""
+        self.drbd.conf.update(self.configs[:1])
+        x = util.read_file(self.drbd.conf.main)
+        self.failUnless('include "%s/*.res";\n' % self.directory in x)
+        self.failUnless(util.read_file(self.drbd.conf.fragment("1.8001")) == map(lambda l:l + "\n", drbd_conf_resource(self.configs[0])))
+    def testIncremental(self):
+        """100 resources start with one create-md and one adjust, and only
+        changed resources are rewritten and adjusted"""
+        results = self.drbd.start_many(self.configs)
+        self.failUnless(results.values() == [ None ] * 100)
+        self.failUnless(map(lambda x:x[0], self.drbd.commands) == [ ["create-md"], ["adjust"] ])
+        self.failUnless(len(self.drbd.commands[1][1]) == 100)
+        self.drbd.commands = []
+        self.failUnless(self.drbd.reconfigure(self.configs) == [])
+        self.drbd.set_resync_rate(5, 10240)
+        self.failUnless(self.drbd.commands == [ (["adjust"], [ "5.8005" ]) ])
+        self.failUnless("    rate 10240K;\n" in util.read_file(self.drbd.conf.fragment("5.8005")))
+    def testStop(self):
+        """Stopping removes the fragments with one drbdadm down"""
+        self.drbd.start_many(self.configs)
+        self.drbd.commands = []
+        self.drbd.stop_many(self.configs)
+        self.failUnless(map(lambda x:x[0], self.drbd.commands) == [ ["down"] ])
+        self.failUnless(os.listdir(self.directory) == [ "drbd.conf" ])
+
+class Batch:
+    """Queues resources to start so many can be brought up with a few
+    drbdadm invocations (see Drbd.start_many)"""
+    def __init__(self, drbd):
+        self.drbd = drbd
+        self.queue = []
     def start(self, config):
+        self.queue.append(config)
+    def run(self):
+        """Start everything queued, returning uuid -> None or exception"""
+        queue = self.queue
+        self.queue = []
+        return self.drbd.start_many(queue)
+
+_drbdadm_device_re = re.compile("/dev/drbd(\d+)")
+
+def drbdadm_errors(lines, configs):
+    """Given the output [lines] of a drbdadm run over several [configs],
+    return a dictionary of uuid -> exception for the resources which
+    failed. Lines are matched to resources by device or resource name."""
+    by_minor = {}
+    by_uuid = {}
+    for config in configs:
+        by_minor[minor_of_config(config)] = config
+        by_uuid[config["uuid"]] = config
+    results = {}
+    for line in lines:
+        config = None
+        m = _drbdadm_device_re.search(line)
+        if m and int(m.group(1)) in by_minor:
+            config = by_minor[int(m.group(1))]
+        else:
+            name = line.split(":", 1)[0].strip()
+            if name.startswith("resource "):
+                name = name[len("resource "):]
+            config = by_uuid.get(name)
+        if config is None or config["uuid"] in results:
+            continue
+        # Device '/dev/drbdN' is configured!
+        if line.endswith("is configured!\n"):
+            results[config["uuid"]] = MinorInUse(minor_of_config(config))
+        # /dev/drbd2: Failure: (102) Local address(port) already in use.
+        elif line.endswith("Local address(port) already in use.\n"):
+            results[config["uuid"]] = PortInUse(port_of_config(config))
+        elif "Failure" in line or "rror" in line:
+            results[config["uuid"]] = CommandError(1, [ line ])
+    return results
+
+class Drbdadm_errors_test(unittest.TestCase):
+    def testMapping(self):
+        """Check drbdadm errors are attributed to the right resources"""
+        configs = [ make_simple_config(1, 7789), make_simple_config(2, 7790), make_simple_config(3, 7791) ]
+        x = drbdadm_errors([
+                "Device '/dev/drbd1' is configured!\n",
+                "/dev/drbd3: Failure: (102) Local address(port) already in use.\n",
+                "Command 'drbdsetup 3 net ...' terminated with exit code 10\n"
+                ], configs)
+        self.failUnless(isinstance(x["1.7789"], MinorInUse) and x["1.7789"].minor == 1)
+        self.failUnless(isinstance(x["3.7791"], PortInUse) and x["3.7791"].port == 7791)
+        self.failUnless("2.7790" not in x)
+
+import random
+
+# Latency distributions for Sim_model: functions of a random.Random
+# returning seconds
+def constant(seconds):
+    return lambda r:seconds
+def uniform(low, high):
+    return lambda r:r.uniform(low, high)
+def lognormal(median, sigma):
+    """A long-tailed distribution, like that of real drbdadm runs"""
+    return lambda r:r.lognormvariate(math.log(median), sigma)
+
+# Operations a Sim_model can slow down or break
+sim_operations = [ "version", "start", "stop" ]
+
+class Sim_model:
+    """How a Drbd_simulator behaves under load. [latency] maps an
+    operation to a distribution of how long it takes; [transient] and
+    [permanent] map it to the probability that it fails with a
+    TransientException (which a Peer retries) or a CommandError (which it
+    doesn't). With [serialize], operations queue behind each other as
+    concurrent drbdadm runs do. Resources start [resync_size] KiB out of
+    sync and resync at [resync_speed] KiB/s, or their "rate" if lower.
+    Given the same [seed], a single-threaded run makes the same choices
+    every time; pass a fake [clock] and [sleep] to take no real time."""
+    def __init__(self, seed=0, latency={}, transient={}, permanent={}, serialize=False,
+                 resync_size=0, resync_speed=102400, clock=time.time, sleep=time.sleep):
+        for operation in latency.keys() + transient.keys() + permanent.keys():
+            if operation not in sim_operations:
+                raise ValueError("Unknown operation: %s" % operation)
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.transient = transient
+        self.permanent = permanent
+        self.serialize = serialize
+        self.resync_size = resync_size
+        self.resync_speed = resync_speed
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+    def enter(self, operation):
+        """Take as long as [operation] takes and return "transient" or
+        "permanent" if it should fail, otherwise None"""
+        self.lock.acquire()
         try:
-            self._start(config)
-        except e:
-            self.stop(config)
-            raise
+            delay = 0.0
+            if operation in self.latency:
+                delay = self.latency[operation](self.random)
+            x = self.random.random()
+        finally:
+            self.lock.release()
+        if self.serialize:
+            self.busy.acquire()
+        try:
+            if delay > 0.0:
+                self.sleep(delay)
+        finally:
+            if self.serialize:
+                self.busy.release()
+        permanent = self.permanent.get(operation, 0.0)
+        if x < permanent:
+            return "permanent"
+        if x < permanent + self.transient.get(operation, 0.0):
+            return "transient"
+        return None
+
+def _thousands(n):
+    return "{:,}".format(int(n))
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
 
 class Drbd_simulator:
-    """A simulation of the real drbd system"""
-    def __init__(self):
+    """A simulation of the real drbd system, whose speed, failures and
+    resyncs are described by a Sim_model"""
+    def __init__(self, minors=None, md_pool=None, monitor_interval=1.0, model=None, md_volume=None):
+        if model is None:
+            model = Sim_model()
+        self.model = model
         self.version_number = "simulator"
-        self.configs = {}
+        self.configs = Registry()
+        if minors is None:
+            minors = Minor_allocator()
+        self.minors = minors
+        self.ports = util.Port_allocator(read=self._used_ports)
+        self.md_pool = md_pool
+        self.md_volume = md_volume
+        self.monitor = monitor.Resync_monitor(self._read_proc_drbd, monitor_interval, clock=model.clock)
+        self.trace = []     # recorded /proc/drbd snapshots to replay
+        self.lock = threading.Lock()
+        self.resyncs = {}   # uuid -> [ KiB resynced, time last updated ]
+    def _fail(self, operation, config=None):
+        failure = self.model.enter(operation)
+        if failure == "permanent":
+            raise CommandError(1, [ "%s: simulated failure\n" % operation ])
+        if failure == "transient":
+            # a flaky link looks like a clash to the Peer, which retries
+            if config is None:
+                raise TransientException("%s: simulated failure" % operation)
+            if self.model.random.random() < 0.5:
+                raise MinorInUse(minor_of_config(config))
+            raise PortInUse(port_of_config(config))
     def version(self):
+        self._fail("version")
         return self.version_number
-    def get_free_minor_number(self):
-        return max([0] + (map(lambda x:minor_of_config(x), self.configs.values()))) + 1
+    def replay(self, trace):
+        """Make /proc/drbd read as each of the snapshots (lists of lines)
+        in [trace] in turn, the last one repeating"""
+        self.trace = list(trace)
+    def proc_drbd_lines(self):
+        """Return what /proc/drbd would say: every resource connected and
+        in sync, unless a trace is being replayed"""
+        if self.trace:
+            if len(self.trace) > 1:
+                return self.trace.pop(0)
+            return self.trace[0]
+        configs = self.configs.values()
+        configs.sort(key=minor_of_config)
+        lines = [ "version: %s (api:88/proto:86-96)\n" % self.version_number ]
+        for config in configs:
+            minor = minor_of_config(config)
+            done, speed = self._resync(config)
+            total = self.model.resync_size
+            oos = total - done
+            if oos <= 0:
+                lines = lines + [
+                    "%2d: cs:Connected ro:Secondary/Secondary ds:UpToDate/UpToDate C r-----\n" % minor,
+                    "    ns:%d nr:0 dw:0 dr:%d al:0 bm:0 lo:0 pe:0 ua:0 ap:0 ep:1 wo:f oos:0\n" % (total, total) ]
+                continue
+            progress = 100.0 * done / total
+            bar = int(progress / 5)
+            lines = lines + [
+                "%2d: cs:SyncSource ro:Secondary/Secondary ds:UpToDate/Inconsistent C r-----\n" % minor,
+                "    ns:%d nr:0 dw:0 dr:%d al:0 bm:0 lo:0 pe:0 ua:0 ap:0 ep:1 wo:f oos:%d\n" % (done, done, oos),
+                "\t[%s>%s] sync'ed: %4.1f%% (%d/%d)K\n" % ("=" * bar, "." * (19 - bar), progress, oos, total) ]
+            if speed == 0:
+                # as DRBD says when a resync has made no progress for a while
+                lines.append("\tstalled\n")
+            else:
+                lines.append("\tfinish: %s speed: %s (%s) K/sec\n" % (_duration(oos / speed), _thousands(speed), _thousands(speed)))
+        return lines
+    def _resync(self, config):
+        """Advance the simulated resync of [config] to now and return the
+        KiB resynced and the current speed"""
+        speed = self.model.resync_speed
+        if config.get("rate") is not None:
+            speed = min(speed, config["rate"])
+        now = self.model.clock()
+        self.lock.acquire()
+        try:
+            if config["uuid"] not in self.resyncs:
+                return self.model.resync_size, speed
+            state = self.resyncs[config["uuid"]]
+            state[0] = min(self.model.resync_size, state[0] + speed * (now - state[1]))
+            state[1] = now
+            if state[0] >= self.model.resync_size:
+                del self.resyncs[config["uuid"]]
+            return int(state[0]), speed
+        finally:
+            self.lock.release()
+    def _read_proc_drbd(self):
+        return proc_drbd(self.proc_drbd_lines())
+    def _used_ports(self):
+        """The simulated kernel's socket table: the ports of the resources
+        we (or whoever shares our configs) are running"""
+        used = {}
+        for config in self.configs.values():
+            used.setdefault(ip_of_config(config), set()).add(port_of_config(config))
+        return used
+    def resync_status(self):
+        if self.monitor.thread is None:
+            self.monitor.sample()
+            self.monitor.start()
+        return self.monitor.status()
+    def set_resync_rate(self, minor, rate):
+        config = self.configs.by_minor(minor)
+        if config is None:
+            raise KeyError(minor)
+        config["rate"] = int(rate)
+    def get_free_minor_number(self, part=None):
+        return self.minors.reserve(part)
     def get_replication_ip(self):
         return "127.0.0.1"
-    def get_replication_port(self, ip):
-        ports = map(lambda x:port_of_config(x), self.configs.values())
-        return max([7788] + ports) + 1
+    def get_replication_port(self, ip, part=None):
+        return self.ports.reserve(ip, part)
     def start(self, config):
-        #print "start self.configs=%s config=%s" % (repr(self.configs), repr(config))
-        this_minor = minor_of_config(config)
-        this_port = port_of_config(config)
-        for other_config in self.configs.values():
-            other_minor = minor_of_config(other_config)
-            other_port = port_of_config(other_config)
-            if other_minor == this_minor:
-                raise MinorInUse(this_minor)
-            if other_port == this_port:
-                raise PortInUse(this_port)
-        self.configs[config["uuid"]] = config
+        self._fail("start", config)
+        self.configs.add(config)
+        self.configs.set_state(config["uuid"], CONNECTED)
+        self.minors.use(minor_of_config(config))
+        self.ports.use(ip_of_config(config), port_of_config(config))
+        if self.model.resync_size > 0:
+            self.lock.acquire()
+            try:
+                self.resyncs[config["uuid"]] = [ 0.0, self.model.clock() ]
+            finally:
+                self.lock.release()
     def stop(self, config):
+        self._fail("stop", config)
         # drdbadm down is idempotent
-        if config["uuid"] in self.configs.keys():
-            del self.configs[config["uuid"]]
+        old = self.configs.remove(config["uuid"])
+        self.lock.acquire()
+        try:
+            self.resyncs.pop(config["uuid"], None)
+        finally:
+            self.lock.release()
+        if old:
+            self.minors.release(minor_of_config(old))
+            self.ports.release(ip_of_config(old), port_of_config(old))
+    def start_many(self, configs):
+        results = {}
+        for config in configs:
+            try:
+                self.start(config)
+                results[config["uuid"]] = None
+            except TransientException, e:
+                results[config["uuid"]] = e
+        return results
+    def stop_many(self, configs):
+        for config in configs:
+            self.stop(config)
+    # nothing to wait for: the same, for aio
+    def async_start(self, config):
+        return aio.succeed(self.start(config))
+    def async_stop(self, config):
+        return aio.succeed(self.stop(config))
+    def async_stop_many(self, configs):
+        return aio.succeed(self.stop_many(configs))
         
+class Fake_clock:
+    """A clock which only moves when something sleeps"""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now = self.now + seconds
+
+class Sim_model_test(unittest.TestCase):
+    def setUp(self):
+        self.clock = Fake_clock()
+    def model(self, **kwargs):
+        return Sim_model(clock=self.clock.time, sleep=self.clock.sleep, **kwargs)
+    def testLatency(self):
+        """Operations take as long as the model says"""
+        drbd = Drbd_simulator(model=self.model(latency={ "start": constant(0.5), "stop": uniform(1.0, 2.0) }))
+        drbd.start(make_simple_config(1, 8080))
+        drbd.stop(make_simple_config(1, 8080))
+        self.failUnless(self.clock.sleeps[0] == 0.5 and 1.0 <= self.clock.sleeps[1] <= 2.0)
+    def testFailures(self):
+        """Injected failures are transient or permanent as asked"""
+        drbd = Drbd_simulator(model=self.model(transient={ "start": 1.0 }))
+        self.assertRaises(TransientException, lambda:drbd.start(make_simple_config(1, 8080)))
+        self.failUnless(len(drbd.configs) == 0)
+        drbd = Drbd_simulator(model=self.model(permanent={ "version": 1.0 }))
+        self.assertRaises(CommandError, drbd.version)
+        self.assertRaises(ValueError, lambda:self.model(transient={ "nonsense": 1.0 }))
+    def testDeterministic(self):
+        """The same seed makes the same choices"""
+        def run(seed):
+            drbd = Drbd_simulator(model=self.model(seed=seed, transient={ "start": 0.5 }))
+            results = []
+            for i in range(1, 20):
+                try:
+                    drbd.start(make_simple_config(i, 8080 + i))
+                    results.append(None)
+                except TransientException, e:
+                    results.append(str(e))
+            return results
+        self.failUnless(run(1) == run(1))
+        self.failUnless(run(1) <> run(2))
+    def testResync(self):
+        """Resyncs progress with time and show up in /proc/drbd"""
+        drbd = Drbd_simulator(model=self.model(resync_size=1000, resync_speed=100))
+        config = make_simple_config(1, 8080)
+        drbd.start(config)
+        drbd.monitor.sample()
+        self.clock.sleep(5.0)
+        x = drbd._read_proc_drbd()["devices"][1]
+        self.failUnless(x["cs"] == "SyncSource" and x["oos"] == 500 and x["progress"] == 50.0)
+        self.failUnless(x["remaining"] == 500 and x["speed"] == 100)
+        drbd.monitor.sample()
+        self.failUnless(drbd.monitor.status(1)["throughput"] == 100.0)
+        # the resync rate limits the speed
+        drbd.set_resync_rate(1, 50)
+        self.clock.sleep(2.0)
+        self.failUnless(drbd._read_proc_drbd()["devices"][1]["oos"] == 400)
+        self.clock.sleep(100.0)
+        x = drbd._read_proc_drbd()["devices"][1]
+        self.failUnless(x["cs"] == "Connected" and x["oos"] == 0)
+    def testStalled(self):
+        """A resync with a rate or speed of zero stalls"""
+        for speed, rate in [ (0, None), (100, 0) ]:
+            drbd = Drbd_simulator(model=self.model(resync_size=1000, resync_speed=speed))
+            drbd.start(make_simple_config(1, 8080))
+            if rate is not None:
+                drbd.set_resync_rate(1, rate)
+            self.clock.sleep(5.0)
+            lines = drbd.proc_drbd_lines()
+            self.failUnless("\tstalled\n" in lines)
+            x = proc_drbd(lines)["devices"][1]
+            self.failUnless(x["cs"] == "SyncSource" and x["oos"] == 1000)
+
 class Drbd_simulator_test(unittest.TestCase):
     def setUp(self):
         self.drbd = Drbd_simulator()
@@ -365,6 +1560,34 @@ class Drbd_simulator_test(unittest.TestCase):
         for i in range(0, 10):
             self.drbd.start(make_simple_config(i, 8080 + i))
             self.failUnless(len(self.drbd.configs) - 1 == i)
+    def testSharedMinors(self):
+        """Check simulators sharing a Minor_allocator never offer the same minor"""
+        minors = Minor_allocator()
+        a = Drbd_simulator(minors)
+        b = Drbd_simulator(minors)
+        x = a.get_free_minor_number()
+        y = b.get_free_minor_number()
+        self.failUnless(x <> y)
+        a.start(make_simple_config(x, 8080))
+        a.stop(make_simple_config(x, 8080))
+        self.failUnless(b.get_free_minor_number() == x)
+    def testBatch(self):
+        """Check a Batch reports per-resource failures"""
+        b = Batch(self.drbd)
+        b.start(make_simple_config(1, 8080))
+        b.start(make_simple_config(2, 8081))
+        b.start(make_simple_config(1, 8082))
+        x = b.run()
+        self.failUnless(x["1.8080"] is None and x["2.8081"] is None)
+        self.failUnless(isinstance(x["1.8082"], MinorInUse))
+        self.failUnless(b.queue == [])
+    def testResyncStatus(self):
+        """Check the DRBD simulator reports its resources in /proc/drbd"""
+        self.drbd.start(make_simple_config(3, 8080))
+        x = self.drbd.resync_status()
+        self.failUnless(x.keys() == [ 3 ] and x[3]["out_of_sync"] == 0)
+        self.failUnless(x[3]["eta"] == 0.0)
+        self.drbd.monitor.stop()
     def testStartStop(self):
         """Check the DRBD simulator allows multiple configurations to be manipulated separately"""
         for j in range(0, 10):
@@ -375,36 +1598,79 @@ class Drbd_simulator_test(unittest.TestCase):
                 self.drbd.stop(make_simple_config(i, 8080 + i))
                 self.failUnless(len(self.drbd.configs) + i + 1 == 10)
 
-import util, losetup, os
+import util, losetup, mdpool, monitor, metrics, tracing, rpc, aio, os, sys
 from util import run, CommandError, log
 class Localdevice:
-    """Wrapper around local resource allocation/deallocation"""
-    def __init__(self, drbd, disk):
+    """Wrapper around local resource allocation/deallocation. With [meta]
+    "internal" the metadata lives at the end of the disk itself, which
+    must have room for it; otherwise it goes in a slot of the shared
+    drbd.md_volume if there is one free, or else on a device of its own.
+    The minor and port come from [part] of the ranges, if given (see
+    Minor_allocator.reserve)."""
+    def __init__(self, drbd, disk, meta=None, part=None):
+        self.drbd = drbd
         self.disk = disk
         self.hostname = os.uname()[1]
-        self.minor = drbd.get_free_minor_number()
-        bytes_per_sector = util.block_device_sector_size(disk)
-        sectors = util.block_device_sectors(disk)
-        mdsize = size_needed_for_md(bytes_per_sector, sectors)
-        self.md_file = util.make_sparse_file(mdsize)
-        l = losetup.Loop()
-        self.loop = l.add(self.md_file)
+        self.md_file = None
+        self.md_index = None
+        self.minor = drbd.get_free_minor_number(part)
+        self.md_pool = drbd.md_pool
+        self.md_volume = drbd.md_volume
+        if meta == "internal":
+            self.loop = "internal"
+        else:
+            mdsize = md_sizes([ disk ])[0]
+            if self.md_volume:
+                self.md_index = self.md_volume.get(mdsize)
+            if self.md_index is not None:
+                self.loop = self.md_volume.device
+            elif self.md_pool:
+                self.md_file, self.loop = self.md_pool.get(mdsize)
+            else:
+                self.md_file = util.make_sparse_file(mdsize)
+                l = losetup.Loop()
+                self.loop = l.add(self.md_file)
         self.address = drbd.get_replication_ip()
-        self.port = drbd.get_replication_port(self.address)
+        self.port = drbd.get_replication_port(self.address, part)
     def get_config(self):
-        return {
+        config = {
             "name": self.hostname,
             "device": "/dev/drbd%d" % self.minor,
             "disk": self.disk,
             "address": "%s:%d" % (self.address, self.port),
             "md": self.loop
             }
-    def __del__(self):
+        if self.md_index is not None:
+            config["md_index"] = self.md_index
+        return config
+    def _free_md(self):
+        if self.md_index is not None:
+            md_index = self.md_index
+            self.md_index = None
+            self.md_volume.put(md_index)
+            return
+        if self.md_file is None:
+            return
+        md_file = self.md_file
+        self.md_file = None
+        if self.md_pool:
+            self.md_pool.put((md_file, self.loop))
+            return
         # Remove loop device
         l = losetup.Loop()
         l.remove(self.loop)
         # Remove the temporary file
-        os.unlink(self.md_file)
+        os.unlink(md_file)
+    def close(self, cancel=True):
+        """Free the metadata device now and, with [cancel], give back the
+        minor and port leases if they were never used. Safe to call more
+        than once."""
+        self._free_md()
+        if cancel:
+            self.drbd.minors.cancel(self.minor)
+            self.drbd.ports.cancel(self.address, self.port)
+    def __del__(self):
+        self._free_md()
 
 class Localdevice_test(unittest.TestCase):
     def setUp(self):
@@ -421,84 +1687,471 @@ class Localdevice_test(unittest.TestCase):
         del l
         nloops = len(self.losetup.list())
         self.failUnless(self.nloops == nloops)
+    def testPool(self):
+        """Verify metadata devices come from and return to an Md_pool"""
+        pool = mdpool.Md_pool(low=0, high=1)
+        try:
+            l = Localdevice(Drbd_simulator(md_pool=pool), self.disk)
+            entry = (l.md_file, l.loop)
+            del l
+            self.failUnless(pool.get(1) == entry)
+            pool.put(entry)
+        finally:
+            pool.close()
+        self.failUnless(self.nloops == len(self.losetup.list()))
+    def testInternal(self):
+        """Internal metadata needs no loop device"""
+        l = Localdevice(Drbd_simulator(), self.disk, "internal")
+        self.failUnless(l.get_config()["md"] == "internal")
+        self.failUnless(self.nloops == len(self.losetup.list()))
+        l.close()
+    def testVolume(self):
+        """Metadata goes in slots of a shared volume while there are any"""
+        volume = mdpool.Md_volume(slots=2)
+        try:
+            drbd = Drbd_simulator(md_volume=volume)
+            ls = [ Localdevice(drbd, self.disk) for i in range(0, 3) ]
+            configs = [ l.get_config() for l in ls ]
+            self.failUnless([ c.get("md_index") for c in configs ] == [ 0, 1, None ])
+            self.failUnless(configs[0]["md"] == volume.device and configs[2]["md"] <> volume.device)
+            self.failUnless("    meta-disk %s [1];" % volume.device in drbd_conf({ "uuid": "x", "hosts": configs[:2] }))
+            for l in ls:
+                l.close()
+            self.failUnless(volume.get(1) == 0)
+        finally:
+            volume.close()
+        self.failUnless(self.nloops == len(self.losetup.list()))
     def tearDown(self):
         self.losetup.remove(self.disk)
         os.unlink(self.file)
 
 
+# Remote errors which negotiations handle, raised again by rpc.Proxy
+for e in [ TransientException, MinorInUse, PortInUse ]:
+    rpc.errors[e.__name__] = TransientException
+rpc.errors[TuningMismatch.__name__] = TuningMismatch
+
+# The two Peers of a negotiation allocate minors and ports from disjoint
+# parts of the ranges, agreed in versionExchange, so that they can't clash
+# with each other even when both are on one host
+initiator_part = [ 0, 2 ]
+receiver_part = [ 1, 2 ]
+
+# A negotiation which clashes with a third party retries at most
+# max_negotiate_attempts times, first sleeping for a random time of up to
+# negotiate_backoff * 2^n seconds (but no more than max_negotiate_backoff)
+# before retry n
+max_negotiate_attempts = 10
+negotiate_backoff = 0.01
+max_negotiate_backoff = 1.0
+
+def backoff(retry):
+    return random.uniform(0, min(max_negotiate_backoff, negotiate_backoff * (1 << retry)))
+
 class VersionMismatchError(Exception):
     def __init__(self, my_version, their_version):
+        Exception.__init__(self, "version %s <> %s" % (my_version, their_version))
         self.my_version = my_version
         self.their_version = their_version
 
 class Peer:
-    """Two Peers negotiate a DRBD connection"""
-    def __init__(self, drbd, disk, uuid):
+    """Two Peers negotiate a DRBD connection. Either may ask for a tuning
+    [profile] (see profiles) and [tuning] overrides; the connection uses
+    the union of what both asked for. [transports] are the RPC transports
+    (name -> port) offered to the other side besides XML-RPC. [meta] is
+    where our metadata goes (see Localdevice)."""
+    def __init__(self, drbd, disk, uuid, profile=None, tuning=None, transports=None, meta=None):
         self.drbd = drbd
         self.disk = disk
         self.uuid = uuid
+        self.profile = profile
+        self.tuning = tuning
+        if transports is None:
+            transports = {}
+        self.transports = transports
+        self.meta = meta
+        self.part = None     # of the minor and port ranges: see negotiate
         self.localdevice = None
-    def versionExchange(self, other_version):
-        return self.drbd.version()
+        self.started = None  # the drbd config we started, if any
+    @metrics.timed
+    @tracing.traced
+    def versionExchange(self, other_version, transports=None, split=None):
+        """Return our version. A caller which lists the [transports] it
+        speaks, or asks us to allocate from [split] (which must be
+        receiver_part), gets a dictionary of our "version", which of the
+        transports we offer, with their ports, as "transports" and the
+        part we agreed to, if any, as "split"."""
+        if transports is None and split is None:
+            return self.drbd.version()
+        offered = {}
+        for name in transports or []:
+            if name in self.transports:
+                offered[name] = self.transports[name]
+        result = { "version": self.drbd.version(), "transports": offered }
+        # any other part could be huge (see _outside) or overlap the
+        # initiator's, so isn't agreed to
+        if split == receiver_part:
+            self.part = list(receiver_part)
+            result["split"] = self.part
+        return result
+    @metrics.timed
+    @tracing.traced
     def softAllocateResources(self):
         if self.localdevice:
-            del self.localdevice
-        self.localdevice = Localdevice(self.drbd, self.disk)
-        return self.localdevice.get_config()
-    def start(self, my_config, other_config):
+            # keep the leases so that a retry after a clash doesn't get
+            # the same minor and port again
+            self.localdevice.close(cancel=False)
+        self.localdevice = Localdevice(self.drbd, self.disk, self.meta, self.part)
+        config = self.localdevice.get_config()
+        if self.profile:
+            config["profile"] = self.profile
+        if self.tuning:
+            config["tuning"] = self.tuning
+        return config
+    def async_start(self, my_config, other_config):
         drbd_conf = {
             "uuid": self.uuid,
             "hosts": [ my_config, other_config ]
             }
-        self.drbd.start(drbd_conf)
-        return "OK"
-    def stop(self, my_config, other_config):
+        # fail before touching DRBD if we can't agree
+        resolve_tuning(my_config, other_config)
+        yield self.drbd.async_start(drbd_conf)
+        self.started = drbd_conf
+        raise aio.Return("OK")
+    @metrics.timed
+    @tracing.traced
+    def start(self, my_config, other_config):
+        return aio.wait(self.async_start(my_config, other_config))
+    def async_stop(self, my_config, other_config):
         drbd_conf = {
             "uuid": self.uuid,
             "hosts": [ my_config, other_config ]
             }
-        n = len(self.drbd.configs)
-        self.drbd.stop(drbd_conf)
-        nn = len(self.drbd.configs)
-        assert(n - 1 == nn)
+        yield self.drbd.async_stop(drbd_conf)
+        self.started = None
+        raise aio.Return("OK")
+    @metrics.timed
+    @tracing.traced
+    def stop(self, my_config, other_config):
+        return aio.wait(self.async_stop(my_config, other_config))
+    def close(self):
+        """Stop our DRBD resource, if started, and free everything we
+        allocated"""
+        close_peers([ self ])
         return "OK"
+    def _agree(self, reply):
+        """Return the version in the [reply] to versionExchange and, if the
+        receiver took receiver_part, allocate from initiator_part"""
+        self.part = None
+        if not isinstance(reply, dict):
+            # a receiver which doesn't know about splitting
+            return reply
+        if reply.get("split") == receiver_part:
+            self.part = initiator_part
+        return reply["version"]
+    def _retried(self, side, e, retry):
+        log("%s: %s: reallocating" % (side, str(e)))
+        metrics.metrics.increment("drbd_manager_negotiate_retries_total", (("side", side),))
+        return backoff(retry)
+    @metrics.timed
+    @tracing.traced
     def negotiate(self, receiver):
         my_version = self.drbd.version()
-        their_version = receiver.versionExchange(my_version)
+        try:
+            reply = receiver.versionExchange(my_version, None, receiver_part)
+        except (TypeError, xmlrpclib.Fault):
+            reply = receiver.versionExchange(my_version)
+        their_version = self._agree(reply)
         if my_version <> their_version:
             log("Versions must match exactly. My version = %s; Their version = %s" % (my_version, their_version))
             raise VersionMismatchError(my_version, their_version)
 
-        other_config = None # must be regenerated if localdevice changes
-        local_service_started = False
-        while not local_service_started:
-            while not local_service_started:
-                my_config = self.softAllocateResources()
-                if not other_config:
-                    other_config = receiver.softAllocateResources()
-                # NB my_config and other_config might conflict with other 3rd party
-                # configurations, or with each other in the localhost case.
-                try:
-                    self.start(my_config, other_config)
-                    local_service_started = True
-                except TransientException, e:
-                    # transient failure, retry
-                    log("local: %s: retrying" % str(e))
-                    raise
-            log("Local service started; signalling remote")
+        # with the ranges split, only a third party can clash with us
+        other_config = receiver.softAllocateResources()
+        for retry in range(0, max_negotiate_attempts):
+            if retry > 0:
+                time.sleep(delay)
+            # each time round is one attempt: a span of its own
+            attempt = tracing.tracer.begin("attempt")
+            side = "local"
             try:
+                my_config = self.softAllocateResources()
+                self.start(my_config, other_config)
+                log("Local service started; signalling remote")
+                side = "remote"
                 receiver.start(other_config, my_config)
+                tracing.tracer.end(attempt)
+                return "OK"
+            except TransientException, e:
+                tracing.tracer.end(attempt, e)
+                failure = e
+                delay = self._retried(side, e, retry)
+                if side == "remote":
+                    self.stop(my_config, other_config)
+                    # there is no next attempt to reallocate for
+                    if retry + 1 < max_negotiate_attempts:
+                        other_config = receiver.softAllocateResources()
+            except Exception, e:
+                tracing.tracer.end(attempt, e)
+                raise
+        raise failure
+    def async_negotiate(self, receiver):
+        """A coroutine doing what negotiate does, with a [receiver] whose
+        methods are coroutines too (an aio.Proxy or aio.Local), so one
+        aio.Loop can drive many negotiations at once"""
+        my_version = self.drbd.version()
+        try:
+            reply = yield receiver.versionExchange(my_version, None, receiver_part)
+        except (TypeError, xmlrpclib.Fault):
+            reply = yield receiver.versionExchange(my_version)
+        their_version = self._agree(reply)
+        if my_version <> their_version:
+            log("Versions must match exactly. My version = %s; Their version = %s" % (my_version, their_version))
+            raise VersionMismatchError(my_version, their_version)
+        other_config = yield receiver.softAllocateResources()
+        for retry in range(0, max_negotiate_attempts):
+            if retry > 0:
+                yield aio.Sleep(delay)
+            side = "local"
+            try:
+                my_config = self.softAllocateResources()
+                yield self.async_start(my_config, other_config)
+                log("Local service started; signalling remote")
+                side = "remote"
+                yield receiver.start(other_config, my_config)
+                raise aio.Return("OK")
             except TransientException, e:
-                log("remote: %s: reallocating" % str(e))
-                # this is either bad luck *or* the receiver just clashed with
-                # the transmitter (expected in the localhost case)
-                other_config = receiver.softAllocateResources()
-                
-                # if we just clashed on localhost, then other_config will now
-                # be disjoint from my_config
-                self.stop(my_config, other_config)
-                local_service_started = False
+                failure = e
+                delay = self._retried(side, e, retry)
+                if side == "remote":
+                    yield self.async_stop(my_config, other_config)
+                    if retry + 1 < max_negotiate_attempts:
+                        other_config = yield receiver.softAllocateResources()
+        raise failure
+    @metrics.timed
+    @tracing.traced
+    def accept(self, other_config):
+        """The receiving side of a batched negotiation: allocate resources,
+        start our half of the connection to [other_config] and return our
+        config. Allocations are leased, so a retry never reuses a minor or
+        port which just clashed."""
+        # always make at least one attempt, so there is a failure to raise
+        for attempt in range(0, max(1, max_accept_attempts)):
+            span = tracing.tracer.begin("attempt")
+            try:
+                my_config = self.softAllocateResources()
+                self.start(my_config, other_config)
+                tracing.tracer.end(span)
+                return my_config
+            except TransientException, e:
+                tracing.tracer.end(span, e)
+                log("accept: %s: reallocating" % str(e))
+                failure = e
+            except Exception, e:
+                tracing.tracer.end(span, e)
+                raise
+        raise failure
+
+def close_peers(peers):
+    """Stop the DRBD resources of all of [peers] and free their metadata
+    devices, minors and ports. Resources sharing a Drbd are stopped with a
+    single stop_many."""
+    by_drbd = {}
+    for peer in peers:
+        if peer.started:
+            if id(peer.drbd) not in by_drbd:
+                by_drbd[id(peer.drbd)] = (peer.drbd, [])
+            by_drbd[id(peer.drbd)][1].append(peer.started)
+    for drbd, configs in by_drbd.values():
+        drbd.stop_many(configs)
+    for peer in peers:
+        if peer.localdevice:
+            # stopping released the minor and port, which someone else
+            # may already have reserved: only cancel leases never used
+            peer.localdevice.close(cancel=not peer.started)
+            peer.localdevice = None
+        peer.started = None
+
+# How many times Peer.accept reallocates after transient failures
+max_accept_attempts = 10
+
+class Peer_factory:
+    """Creates the receiving Peers on a host, naming each by a URI. Also
+    the receiving side of negotiate_batch."""
+    def __init__(self, drbd, peers=None):
+        self.drbd = drbd
+        if peers is None:
+            peers = {}
+        self.peers = peers
+        self.x = 0
+        self.lock = threading.Lock()
+        self.transports = {}    # offered by our Peers: see rpc
+    def make(self, disk, uuid, meta=None):
+        """Create a Peer for [disk] with metadata placed as [meta] (see
+        Localdevice) and return its URI"""
+        peer = Peer(self.drbd, disk, uuid, transports=self.transports, meta=meta)
+        self.lock.acquire()
+        try:
+            uri = "/%d" % self.x
+            self.x = self.x + 1
+        finally:
+            self.lock.release()
+        self.peers[uri] = peer
+        return uri
+    def close(self, uris):
+        """Forget the Peers at [uris], stopping and freeing their resources
+        in one batch once any calls in progress on them have finished"""
+        peers = []
+        for uri in uris:
+            peer = self.peers.pop(uri, None)
+            if peer is not None:
+                peers.append(peer)
+        close_peers(peers)
         return "OK"
+    def rpcTransports(self):
+        """Return the RPC transports our Peers offer (name -> port)"""
+        return self.transports
+    def resyncStatus(self):
+        """Return a list with the resync status (see
+        monitor.Resync_monitor) and "minor" of every local resource"""
+        status = self.drbd.resync_status()
+        results = []
+        for minor in sorted(status.keys()):
+            x = dict(status[minor])
+            x["minor"] = minor
+            results.append(x)
+        return results
+    def negotiateBatch(self, other_version, requests):
+        """Given [requests], a list of [disk, uuid, config] from the other
+        host, create a Peer for each disk and start its half of the
+        connection. Returns our version and, per disk, the URI of the Peer
+        and either its config or the error which stopped it. A disk which
+        fails doesn't stop the rest."""
+        my_version = self.drbd.version()
+        results = []
+        if my_version == other_version:
+            for disk, uuid, other_config in requests:
+                uri = self.make(disk, uuid)
+                try:
+                    config = self.peers[uri].accept(other_config)
+                    results.append({ "uri": uri, "config": config })
+                except Exception, e:
+                    results.append({ "uri": uri, "error": str(e) })
+        return { "version": my_version, "results": results }
+
+import xmlrpclib
+def negotiate_batch(peers, factory, disks, connect):
+    """Negotiate DRBD connections for all of [peers] (the local Peers for
+    one VM's disks) in a single request to [factory], the remote
+    Peer_factory. [disks] are the corresponding remote disks and
+    [connect uri] returns a proxy for a remote Peer. Disks which can't be
+    set up in the batch, and peers which don't understand batches, fall
+    back to Peer.negotiate. Returns a list with, per disk, a dictionary of
+    "uuid", remote Peer "uri" and whether it was "batched"."""
+    if peers == []:
+        return []
+    my_version = peers[0].drbd.version()
+    my_configs = map(lambda p:p.softAllocateResources(), peers)
+    requests = []
+    for peer, disk, my_config in zip(peers, disks, my_configs):
+        requests.append([ disk, peer.uuid, my_config ])
+    try:
+        reply = factory.negotiateBatch(my_version, requests)
+    except (AttributeError, xmlrpclib.Fault), e:
+        log("negotiateBatch not supported (%s): negotiating one disk at a time" % str(e))
+        results = []
+        for peer, disk in zip(peers, disks):
+            uri = factory.make(disk, peer.uuid)
+            peer.negotiate(connect(uri))
+            results.append({ "uuid": peer.uuid, "uri": uri, "batched": False })
+        return results
+    if reply["version"] <> my_version:
+        log("Versions must match exactly. My version = %s; Their version = %s" % (my_version, reply["version"]))
+        raise VersionMismatchError(my_version, reply["version"])
+    results = []
+    for peer, my_config, result in zip(peers, my_configs, reply["results"]):
+        uri = result["uri"]
+        batched = False
+        if "error" in result:
+            log("remote: %s: %s: negotiating separately" % (peer.uuid, result["error"]))
+        else:
+            try:
+                peer.start(my_config, result["config"])
+                batched = True
+            except TransientException, e:
+                log("local: %s: %s: negotiating separately" % (peer.uuid, str(e)))
+                connect(uri).stop(result["config"], my_config)
+        if not batched:
+            peer.negotiate(connect(uri))
+        results.append({ "uuid": peer.uuid, "uri": uri, "batched": batched })
+    return results
+
+import Queue
+class Scheduler:
+    """Negotiates DRBD connections for many disks concurrently on at most
+    [workers] threads. Every local Peer shares [drbd], and so its minor
+    and port allocators, so the workers never hand out the same minor or
+    port twice. [connect uri] returns a proxy for the remote object at
+    [uri]: "/" is the remote Peer_factory. Each worker connects for
+    itself since xmlrpclib proxies can't be shared between threads. The
+    local Peers ask for the tuning [profile] and [tuning] overrides."""
+    def __init__(self, drbd, connect, workers=8, profile=None, tuning=None):
+        self.drbd = drbd
+        self.connect = connect
+        self.workers = workers
+        self.profile = profile
+        self.tuning = tuning
+    def _negotiate(self, disk, uuid, remote_disk):
+        peer = Peer(self.drbd, disk, uuid, self.profile, self.tuning)
+        uri = None
+        try:
+            uri = self.connect("/").make(remote_disk, uuid)
+            peer.negotiate(self.connect(uri))
+            return { "uuid": uuid, "uri": uri, "peer": peer }
+        except Exception, e:
+            log("%s: negotiation failed: %s" % (uuid, str(e)))
+            peer.close()
+            if uri:
+                try:
+                    self.connect("/").close([ uri ])
+                except Exception, e2:
+                    log("%s: failed to close the remote Peer %s: %s" % (uuid, uri, str(e2)))
+            return { "uuid": uuid, "uri": uri, "error": str(e) }
+    def run(self, jobs, remote_disk=None, progress=None):
+        """Negotiate each (disk, uuid) pair in [jobs]. The remote Peer uses
+        the disk [remote_disk uuid], by default the same path as ours.
+        [progress result] is called as each disk finishes. Returns, in the
+        order of [jobs], a dictionary per disk of "uuid", remote "uri" and
+        either the local "peer" or the "error" which stopped it."""
+        if remote_disk is None:
+            paths = dict(map(lambda (disk, uuid):(uuid, disk), jobs))
+            remote_disk = paths.get
+        queue = Queue.Queue()
+        for i in range(0, len(jobs)):
+            queue.put(i)
+        results = [ None ] * len(jobs)
+        lock = threading.Lock()
+        def work():
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                disk, uuid = jobs[i]
+                result = self._negotiate(disk, uuid, remote_disk(uuid))
+                lock.acquire()
+                try:
+                    results[i] = result
+                    if progress:
+                        progress(result)
+                finally:
+                    lock.release()
+        threads = [ threading.Thread(target=work) for i in range(0, min(self.workers, len(jobs))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
 
 class Negotiate_test(unittest.TestCase):
     def setUp(self):
@@ -516,13 +2169,91 @@ class Negotiate_test(unittest.TestCase):
     def testVersionMismatch(self):
         """Check VersionMismatch is thrown when expected"""
         self.assertRaises(VersionMismatchError, self.mismatch)
+    def testSplit(self):
+        """Only receiver_part is agreed to"""
+        for split in [ [ 5000000, 5000001 ], [ 0, 2 ], [ -1, 2 ], [ 1 ], "x" ]:
+            reply = self.remote.versionExchange(self.local.drbd.version(), None, split)
+            self.failUnless("split" not in reply and self.remote.part is None)
+        reply = self.remote.versionExchange(self.local.drbd.version(), None, receiver_part)
+        self.failUnless(reply["split"] == receiver_part and self.remote.part == receiver_part)
     def testSuccess(self):
         """The negotiation should always succeed eventually"""
         self.local.negotiate(self.remote)
     def testLocalhost(self):
         """The negotiation should always succeed even on localhost"""
-        self.local.negotiate(self.local)
+        # one kernel can't run two resources with the same name
+        remote = Peer(self.local.drbd, self.disk, "uuid-remote")
+        self.local.negotiate(remote)
+        self.failUnless(len(self.local.drbd.configs) == 2)
+        close_peers([ self.local, remote ])
+    def testFlaky(self):
+        """Negotiations succeed despite a flaky remote"""
+        clock = Fake_clock()
+        model = Sim_model(seed=4, latency={ "start": constant(0.1) }, transient={ "start": 0.5 },
+                          clock=clock.time, sleep=clock.sleep)
+        remote = Peer(Drbd_simulator(model=model), self.disk, "uuid")
+        self.local.negotiate(remote)
+        self.failUnless(len(remote.drbd.configs) == 1 and len(clock.sleeps) > 1)
+    def retries(self):
+        return sum([ metrics.metrics.get("drbd_manager_negotiate_retries_total", (("side", side),)) or 0 for side in [ "local", "remote" ] ])
+    def contended(self, make_remote, n):
+        """Negotiate [n] times between Peers whose Drbd_simulators share one
+        kernel but not their allocators and return how many retries
+        there were"""
+        before = self.retries()
+        local = Drbd_simulator()
+        remote = Drbd_simulator()
+        remote.configs = local.configs
+        peers = []
+        for i in range(0, n):
+            peers.append(Peer(local, self.disk, "uuid%d" % i))
+            peers.append(make_remote(remote, self.disk, "uuid%d-remote" % i))
+            peers[-2].negotiate(peers[-1])
+        self.failUnless(len(local.configs) == 2 * n)
+        close_peers(peers)
+        return self.retries() - before
+    def testContended(self):
+        """Peers on one host split the minors and ports, so never clash"""
+        self.failUnless(self.contended(Peer, 20) == 0)
+    def testContendedOld(self):
+        """Clashes with a receiver which can't split are retried"""
+        self.failUnless(self.contended(Old_peer, 5) > 0)
+    def testGiveUp(self):
+        """A clash which doesn't go away is only retried so often"""
+        global max_negotiate_backoff
+        before = self.retries()
+        remote = Peer(Drbd_simulator(model=Sim_model(transient={ "start": 1.0 })), self.disk, "uuid")
+        allocations = []
+        allocate = remote.softAllocateResources
+        def counted():
+            allocations.append(None)
+            return allocate()
+        remote.softAllocateResources = counted
+        saved = max_negotiate_backoff
+        max_negotiate_backoff = 0.0
+        try:
+            self.assertRaises(TransientException, lambda:self.local.negotiate(remote))
+        finally:
+            max_negotiate_backoff = saved
+            close_peers([ self.local, remote ])
+        self.failUnless(self.retries() - before == max_negotiate_attempts)
+        # one allocation per attempt: none after the last
+        self.failUnless(len(allocations) == max_negotiate_attempts)
+    def testProfile(self):
+        """The receiver adopts the profile the sender asks for"""
+        self.local.profile = "wan"
+        self.local.negotiate(self.remote)
+        config = self.remote.drbd.configs["uuid"]
+        self.failUnless("  protocol A;" in drbd_conf(config))
+        self.failUnless(drbd_conf_tuning(config) == drbd_conf_tuning(self.local.drbd.configs["uuid"]))
+    def testProfileMismatch(self):
+        """Peers asking for different profiles don't start"""
+        self.local.profile = "wan"
+        self.remote.profile = "lan"
+        self.assertRaises(TuningMismatch, lambda:self.local.negotiate(self.remote))
     def testRemote(self):
+        """Negotiations work over XML-RPC, and the remote spans join the
+        local trace"""
         import drbd, xmlrpclib
         localhost = "127.0.0.1"
         port = util.replication_port(localhost)
@@ -530,14 +2261,291 @@ class Negotiate_test(unittest.TestCase):
         s.start()
         prefix = "http://%s:%d" % (localhost, port)
         suffix = xmlrpclib.Server(prefix + "/", allow_none=True).make(self.disk, "uuid")
-        remote = xmlrpclib.Server(prefix + suffix, allow_none=True)
+        remote = tracing.proxy(prefix + suffix)
         self.local.negotiate(remote)
         s.stop()
         s.join()
+        # free the remote Peer's loop device
+        del drbd.peers[suffix]
+        trace = filter(lambda x:x["name"] == "negotiate", tracing.tracer.dump())[-1]["trace"]
+        spans = tracing.tracer.dump(trace)
+        attempts = [ x["id"] for x in spans if x["name"] == "attempt" ]
+        starts = [ x for x in spans if x["name"] == "start" ]
+        self.failUnless(len(starts) == 2 and starts[0]["parent"] in attempts and starts[1]["parent"] in attempts)
 
+    def json(self, make_remote):
+        """Negotiate via drbd.Server with an rpc.Proxy; the remote Peer is
+        replaced by [make_remote disk uuid] if given"""
+        import drbd
+        localhost = "127.0.0.1"
+        port = util.replication_port(localhost)
+        s = drbd.Server(localhost, port)
+        s.start()
+        pool = rpc.Pool()
+        prefix = "http://%s:%d" % (localhost, port)
+        suffix = rpc.Proxy(prefix + "/", pool).make(self.disk, "uuid")
+        try:
+            if make_remote:
+                drbd.peers[suffix] = make_remote(drbd.peers[suffix].drbd, self.disk, "uuid")
+            remote = rpc.Proxy(prefix + suffix, pool)
+            self.local.negotiate(remote)
+            my_config, other_config = self.local.started["hosts"]
+            remote.stop(other_config, my_config)
+        finally:
+            pool.close()
+            s.stop()
+            s.join()
+            # free the remote Peer's loop device
+            del drbd.peers[suffix]
+        return remote
+    def testJson(self):
+        """Peers switch to the compact transport when both offer it"""
+        remote = self.json(None)
+        self.failUnless(remote.address is not None)
+    def testFallback(self):
+        """Servers which don't offer it are spoken to in XML-RPC"""
+        remote = self.json(Old_peer)
+        self.failUnless(remote.address is None)
+
+    def tearDown(self):
+        self.losetup.remove(self.disk)
+        os.unlink(self.file)
+
+class Async_negotiate_test(unittest.TestCase):
+    def setUp(self):
+        self.size = 16L * 1024L * 1024L * 1024L
+        self.file = util.make_sparse_file(self.size)
+        self.losetup = losetup.Loop()
+        self.disk = self.losetup.add(self.file)
+        self.local = Drbd_simulator()
     def tearDown(self):
         self.losetup.remove(self.disk)
         os.unlink(self.file)
+    def negotiate(self, uuid, remote):
+        """A coroutine negotiating [uuid] with [remote] and tidying up"""
+        peer = Peer(self.local, self.disk, uuid)
+        try:
+            yield peer.async_negotiate(remote)
+        finally:
+            close_peers([ peer ])
+    def testMany(self):
+        """One aio.Loop drives many negotiations at once"""
+        drbd = Drbd_simulator()
+        remotes = [ Peer(drbd, self.disk, "uuid%d" % i) for i in range(0, 50) ]
+        loop = aio.Loop()
+        x = loop.run_until_complete(aio.gather(loop, [ self.negotiate("uuid%d" % i, aio.Local(remotes[i])) for i in range(0, 50) ], limit=10))
+        self.failUnless(x == [ None ] * 50)
+        self.failUnless(len(drbd.configs) == 50 and len(self.local.configs) == 0)
+        # the receivers allocated from their part of the ranges
+        self.failUnless(filter(lambda c:minor_of_config(c) % 2 <> 1, drbd.configs.values()) == [])
+        close_peers(remotes)
+    def testRemote(self):
+        """Negotiations via an aio.Proxy to drbd.Server"""
+        import drbd
+        localhost = "127.0.0.1"
+        port = util.replication_port(localhost)
+        s = drbd.Server(localhost, port)
+        s.start()
+        pool = aio.Pool()
+        try:
+            address = (localhost, rpc.Proxy("http://%s:%d/" % (localhost, port)).rpcTransports()["json"])
+            factory = aio.Proxy(address, "/", pool)
+            loop = aio.Loop()
+            uris = [ loop.run_until_complete(factory.make(self.disk, "uuid%d" % i)) for i in range(0, 4) ]
+            x = loop.run_until_complete(aio.gather(loop, [ self.negotiate("uuid%d" % i, aio.Proxy(address, uris[i], pool)) for i in range(0, 4) ]))
+            self.failUnless(x == [ None ] * 4)
+            loop.run_until_complete(factory.close(uris))
+        finally:
+            pool.close()
+            s.stop()
+            s.join()
+
+class Old_peer(Peer):
+    """A Peer from before transports were negotiated"""
+    def versionExchange(self, other_version):
+        return self.drbd.version()
+
+class Localhost_factory(Peer_factory):
+    """A Peer_factory on its caller's host, whose resources are renamed
+    since one kernel can't run two with the same name"""
+    def make(self, disk, uuid, meta=None):
+        return Peer_factory.make(self, disk, uuid + "-remote", meta)
+
+class Counting_factory(Localhost_factory):
+    """A Peer_factory which counts the batches requested of it"""
+    def __init__(self, drbd):
+        Peer_factory.__init__(self, drbd)
+        self.calls = 0
+    def negotiateBatch(self, other_version, requests):
+        self.calls = self.calls + 1
+        return Peer_factory.negotiateBatch(self, other_version, requests)
+
+class Peer_factory_test(unittest.TestCase):
+    def setUp(self):
+        self.size = 16L * 1024L * 1024L * 1024L
+        self.file = util.make_sparse_file(self.size)
+        self.losetup = losetup.Loop()
+        self.disk = self.losetup.add(self.file)
+        self.nloops = len(self.losetup.list())
+    def tearDown(self):
+        self.losetup.remove(self.disk)
+        os.unlink(self.file)
+    def testClose(self):
+        """Closing Peers frees loops, minors and ports without the GC"""
+        drbd = Drbd_simulator()
+        factory = Peer_factory(drbd)
+        other = make_simple_config(100, 9000)
+        for i in range(0, 20):
+            uris = [ factory.make(self.disk, "uuid%d" % j) for j in range(0, 3) ]
+            peers = map(lambda uri:factory.peers[uri], uris)
+            for peer in peers:
+                peer.accept(other)
+            factory.close(uris)
+            self.failUnless(len(self.losetup.list()) == self.nloops)
+            self.failUnless(len(drbd.configs) == 0 and factory.peers == {})
+        # every minor and port was given back
+        self.failUnless(drbd.get_free_minor_number() == 1)
+        self.failUnless(drbd.get_replication_port("127.0.0.1") == 7789)
+
+class Slow_factory(Peer_factory):
+    """A Peer_factory which takes [delay] seconds to make each Peer and
+    records the greatest number of concurrent calls"""
+    def __init__(self, drbd, delay):
+        Peer_factory.__init__(self, drbd)
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+    def make(self, disk, uuid):
+        self.lock.acquire()
+        self.active = self.active + 1
+        self.max_active = max(self.max_active, self.active)
+        self.lock.release()
+        time.sleep(self.delay)
+        self.lock.acquire()
+        self.active = self.active - 1
+        self.lock.release()
+        return Peer_factory.make(self, disk, uuid)
+
+class Scheduler_test(unittest.TestCase):
+    def setUp(self):
+        self.size = 16L * 1024L * 1024L * 1024L
+        self.file = util.make_sparse_file(self.size)
+        self.losetup = losetup.Loop()
+        self.disk = self.losetup.add(self.file)
+        self.nloops = len(self.losetup.list())
+        self.jobs = [ (self.disk, "uuid%d" % i) for i in range(0, 12) ]
+    def tearDown(self):
+        self.losetup.remove(self.disk)
+        os.unlink(self.file)
+    def connect(self, factory):
+        return lambda uri:(uri == "/" and factory) or factory.peers[uri]
+    def testParallel(self):
+        """Disks are negotiated concurrently but by at most [workers]"""
+        drbd = Drbd_simulator()
+        factory = Slow_factory(Drbd_simulator(), 0.1)
+        done = []
+        start = time.time()
+        x = Scheduler(drbd, self.connect(factory), workers=4).run(self.jobs, progress=done.append)
+        elapsed = time.time() - start
+        self.failUnless(factory.max_active == 4)
+        # four at a time should take well under half as long as one
+        self.failUnless(elapsed < 0.1 * len(self.jobs) / 2)
+        self.failUnless(map(lambda r:r["uuid"], x) == map(lambda (disk, uuid):uuid, self.jobs))
+        self.failUnless(len(done) == len(self.jobs) and "error" not in done[0])
+        # the shared allocators gave every disk its own minor
+        minors = set(map(minor_of_config, drbd.configs.values()))
+        self.failUnless(len(minors) == len(self.jobs))
+        close_peers(map(lambda r:r["peer"], x))
+        factory.close(factory.peers.keys())
+        self.failUnless(len(self.losetup.list()) == self.nloops)
+    def testLocalhost(self):
+        """Concurrent negotiations succeed when both sides share a host"""
+        drbd = Drbd_simulator()
+        factory = Localhost_factory(drbd)
+        x = Scheduler(drbd, self.connect(factory), workers=6).run(self.jobs)
+        self.failUnless(filter(lambda r:"error" in r, x) == [])
+        close_peers(map(lambda r:r["peer"], x))
+        factory.close(factory.peers.keys())
+        self.failUnless(len(self.losetup.list()) == self.nloops)
+    def testError(self):
+        """A failure is reported against its disk and frees its resources
+        on both sides"""
+        factory = Peer_factory(Drbd_simulator())
+        factory.drbd.version_number = "a"
+        x = Scheduler(Drbd_simulator(), self.connect(factory)).run(self.jobs[:3])
+        self.failUnless(map(lambda r:"error" in r, x) == [ True ] * 3)
+        self.failUnless(factory.peers == {})
+        self.failUnless(len(self.losetup.list()) == self.nloops)
+
+class Old_factory:
+    """A remote factory from before negotiateBatch existed"""
+    def __init__(self, drbd):
+        self.factory = Peer_factory(drbd)
+        self.peers = self.factory.peers
+    def make(self, disk, uuid):
+        return self.factory.make(disk, uuid)
+
+class Negotiate_batch_test(unittest.TestCase):
+    def setUp(self):
+        self.size = 16L * 1024L * 1024L * 1024L
+        self.file = util.make_sparse_file(self.size)
+        self.losetup = losetup.Loop()
+        self.disk = self.losetup.add(self.file)
+        self.drbd = Drbd_simulator()
+        self.local = [ Peer(self.drbd, self.disk, "uuid%d" % i) for i in range(0, 4) ]
+    def tearDown(self):
+        self.local = []
+        self.losetup.remove(self.disk)
+        os.unlink(self.file)
+    def testBatch(self):
+        """All disks are negotiated with a single remote request"""
+        factory = Counting_factory(Drbd_simulator())
+        x = negotiate_batch(self.local, factory, [ self.disk ] * 4, factory.peers.get)
+        self.failUnless(factory.calls == 1)
+        self.failUnless(map(lambda r:r["batched"], x) == [ True ] * 4)
+        self.failUnless(len(self.drbd.configs) == 4 and len(factory.drbd.configs) == 4)
+    def testLocalhost(self):
+        """A batch succeeds when both sides share one host"""
+        factory = Counting_factory(self.drbd)
+        x = negotiate_batch(self.local, factory, [ self.disk ] * 4, factory.peers.get)
+        self.failUnless(map(lambda r:r["batched"], x) == [ True ] * 4)
+    def testErrors(self):
+        """A disk which can't be started doesn't stop the rest of the batch"""
+        factory = Peer_factory(Drbd_simulator())
+        self.local[1].profile = "unknown"
+        requests = [ [ self.disk, p.uuid, p.softAllocateResources() ] for p in self.local ]
+        x = factory.negotiateBatch(self.drbd.version(), requests)["results"]
+        self.failUnless(map(lambda r:"error" in r, x) == [ False, True, False, False ])
+        self.failUnless(len(factory.drbd.configs) == 3)
+        factory.close(map(lambda r:r["uri"], x))
+        close_peers(self.local)
+    def testVersionMismatch(self):
+        """Check VersionMismatch is thrown when expected"""
+        factory = Peer_factory(Drbd_simulator())
+        factory.drbd.version_number = "a"
+        self.assertRaises(VersionMismatchError, lambda:negotiate_batch(self.local, factory, [ self.disk ] * 4, factory.peers.get))
+    def testFallback(self):
+        """Peers without negotiateBatch are negotiated one disk at a time"""
+        factory = Old_factory(Drbd_simulator())
+        x = negotiate_batch(self.local, factory, [ self.disk ] * 4, factory.peers.get)
+        self.failUnless(map(lambda r:r["batched"], x) == [ False ] * 4)
+        self.failUnless(len(factory.factory.drbd.configs) == 4)
+    def testRemote(self):
+        """A batch works over XML-RPC"""
+        import drbd
+        localhost = "127.0.0.1"
+        port = util.replication_port(localhost)
+        s = drbd.Server(localhost, port)
+        s.start()
+        try:
+            prefix = "http://%s:%d" % (localhost, port)
+            factory = xmlrpclib.Server(prefix + "/", allow_none=True)
+            x = negotiate_batch(self.local, factory, [ self.disk ] * 4, lambda uri:xmlrpclib.Server(prefix + uri, allow_none=True))
+            self.failUnless(map(lambda r:r["batched"], x) == [ True ] * 4)
+            factory.close(map(lambda r:r["uri"], x))
+        finally:
+            s.stop()
+            s.join()
 
 if __name__ == "__main__":
     unittest.main ()
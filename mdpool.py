@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+import os, fcntl, threading, collections
+import util, losetup
+from util import log
+
+BLKFLSBUF = 0x1261
+
+def size_class(size):
+    """Round a metadata size up to its size class: the next power of two,
+    and at least 1MiB. The files are sparse so the slack costs nothing."""
+    result = 1L << 20
+    while result < size:
+        result = result << 1
+    return result
+
+# A pool of sparse metadata files, already attached to loop devices, so
+# that Localdevice doesn't have to create and attach one (and tear it down
+# again) on the critical path of a migration. Entries are (md_file, loop)
+# pairs. A background thread keeps between [low] and [high] idle entries
+# of each size class in [sizes].
+class Md_pool:
+    def __init__(self, sizes=[], low=2, high=8, loop=None):
+        self.low = low
+        self.high = high
+        if loop is None:
+            loop = losetup.Loop()
+        self.loop = loop
+        self.lock = threading.Condition()
+        self.idle = {}   # size class -> deque of (md_file, loop)
+        for size in sizes:
+            self.idle[size_class(size)] = collections.deque()
+        self.stopped = False
+        self.busy = False
+        self.thread = threading.Thread(target=self._maintain)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    def _create(self, size):
+        md_file = util.make_sparse_file(size)
+        try:
+            return (md_file, self.loop.add(md_file))
+        except:
+            os.unlink(md_file)
+            raise
+    def _destroy(self, entry):
+        md_file, loop = entry
+        self.loop.remove(loop)
+        os.unlink(md_file)
+    def _wipe(self, entry, size):
+        """Zero the metadata so the next user sees a fresh device"""
+        md_file, loop = entry
+        f = open(md_file, "r+")
+        try:
+            os.ftruncate(f.fileno(), 0)
+            os.ftruncate(f.fileno(), size)
+        finally:
+            f.close()
+        # drop anything the loop device cached from the old contents
+        fd = os.open(loop, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, BLKFLSBUF, 0)
+        finally:
+            os.close(fd)
+    def _work(self):
+        """Return (size class, number to create, entries to destroy)"""
+        for size in self.idle:
+            idle = self.idle[size]
+            if len(idle) < self.low:
+                return size, self.high - len(idle), []
+            if len(idle) > self.high:
+                return size, 0, [ idle.pop() for i in range(self.high, len(idle)) ]
+        return None, 0, []
+    def _maintain(self):
+        failed = False
+        while True:
+            self.lock.acquire()
+            try:
+                if failed:
+                    # don't spin if (eg) we have run out of loop devices
+                    self.lock.wait(1.0)
+                    failed = False
+                self.busy = False
+                while not self.stopped:
+                    size, n, surplus = self._work()
+                    if size is not None:
+                        break
+                    self.lock.notifyAll()
+                    self.lock.wait()
+                self.busy = True
+                if self.stopped:
+                    # close() frees whatever is left idle
+                    return
+            finally:
+                self.lock.release()
+            for entry in surplus:
+                self._destroy(entry)
+            for i in range(0, n):
+                if self.stopped:
+                    break
+                try:
+                    entry = self._create(size)
+                except Exception, e:
+                    log("Md_pool: failed to create a %d byte metadata device: %s" % (size, str(e)))
+                    failed = True
+                    break
+                self.lock.acquire()
+                try:
+                    self.idle[size].append(entry)
+                    self.lock.notifyAll()
+                finally:
+                    self.lock.release()
+    def get(self, size):
+        """Return a (md_file, loop) pair of at least [size] bytes, taking an
+        idle one if possible"""
+        c = size_class(size)
+        self.lock.acquire()
+        try:
+            if c not in self.idle:
+                self.idle[c] = collections.deque()
+            idle = self.idle[c]
+            entry = None
+            if len(idle) > 0:
+                entry = idle.popleft()
+            if len(idle) < self.low:
+                self.lock.notifyAll()
+        finally:
+            self.lock.release()
+        if entry is None:
+            # the pool has run dry: pay for it now
+            entry = self._create(c)
+        return entry
+    def put(self, entry):
+        """Wipe [entry] and return it to the pool"""
+        md_file, loop = entry
+        c = size_class(os.path.getsize(md_file))
+        try:
+            self._wipe(entry, c)
+        except (OSError, IOError), e:
+            log("Md_pool: failed to wipe %s: %s" % (md_file, str(e)))
+            self._destroy(entry)
+            return
+        self.lock.acquire()
+        try:
+            if c not in self.idle:
+                self.idle[c] = collections.deque()
+            self.idle[c].append(entry)
+            if len(self.idle[c]) > self.high:
+                self.lock.notifyAll()
+        finally:
+            self.lock.release()
+    def wait(self):
+        """Block until the background thread has finished refilling and
+        trimming"""
+        self.lock.acquire()
+        try:
+            while not self.stopped and (self.busy or not self._balanced()):
+                self.lock.wait(0.1)
+        finally:
+            self.lock.release()
+    def _balanced(self):
+        for idle in self.idle.values():
+            if len(idle) < self.low or len(idle) > self.high:
+                return False
+        return True
+    def close(self):
+        """Stop the background thread and free every idle entry"""
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+        self.thread.join()
+        for idle in self.idle.values():
+            while len(idle) > 0:
+                self._destroy(idle.popleft())
+
+# DRBD's indexed metadata ("meta-disk <device> [<index>]") keeps the
+# metadata of many resources in fixed-size slots of one shared volume,
+# each good for a disk of up to 4TiB.
+index_slot_size = 128L * 1024L * 1024L
+
+# how much of a slot to zero when it is released: enough to destroy the
+# superblock and activity log, so create-md sees an empty slot
+_wipe_size = 1L << 20
+
+class Md_volume:
+    """A shared metadata volume of [slots] indexed slots, handed out one per
+    resource. Uses the existing [device] if given (eg a logical volume,
+    sized for the slots); otherwise creates a sparse file and attaches it
+    to a single loop device, which close() frees again."""
+    def __init__(self, slots, device=None, loop=None):
+        self.slots = slots
+        self.md_file = None
+        if loop is None:
+            loop = losetup.Loop()
+        self.loop = loop
+        if device is None:
+            self.md_file = util.make_sparse_file(slots * index_slot_size)
+            try:
+                device = self.loop.add(self.md_file)
+            except:
+                os.unlink(self.md_file)
+                raise
+        self.device = device
+        self.lock = threading.Lock()
+        self.free = range(0, slots)
+    def get(self, size):
+        """Return the index of a free slot which can hold [size] bytes of
+        metadata, or None if there isn't one"""
+        if size > index_slot_size:
+            return None
+        self.lock.acquire()
+        try:
+            if self.free == []:
+                return None
+            return self.free.pop(0)
+        finally:
+            self.lock.release()
+    def _wipe(self, index):
+        fd = os.open(self.device, os.O_WRONLY)
+        try:
+            os.lseek(fd, index * index_slot_size, 0)
+            os.write(fd, "\0" * _wipe_size)
+            os.fsync(fd)
+            fcntl.ioctl(fd, BLKFLSBUF, 0)
+        finally:
+            os.close(fd)
+    def put(self, index):
+        """Wipe the slot [index] and make it free again"""
+        try:
+            self._wipe(index)
+        except (OSError, IOError), e:
+            # keep it out of circulation rather than hand out stale metadata
+            log("Md_volume: failed to wipe slot %d of %s: %s" % (index, self.device, str(e)))
+            return
+        self.lock.acquire()
+        try:
+            self.free.append(index)
+            self.free.sort()
+        finally:
+            self.lock.release()
+    def close(self):
+        """Detach and delete the volume, if we created it"""
+        if self.md_file is None:
+            return
+        self.loop.remove(self.device)
+        os.unlink(self.md_file)
+        self.md_file = None
+
+import unittest
+class Md_pool_test(unittest.TestCase):
+    def setUp(self):
+        self.nloops = len(losetup.Loop().list())
+        self.pool = Md_pool(sizes=[ 299008L ], low=1, high=2)
+        self.pool.wait()
+    def tearDown(self):
+        self.pool.close()
+        self.failUnless(len(losetup.Loop().list()) == self.nloops)
+    def testSizeClass(self):
+        """Sizes are rounded up to powers of two of at least 1MiB"""
+        self.failUnless(size_class(299008L) == 1L << 20)
+        self.failUnless(size_class((1L << 21) + 1) == 1L << 22)
+    def testRecycle(self):
+        """A released entry is wiped and handed out again"""
+        entry = self.pool.get(299008L)
+        md_file, loop = entry
+        f = open(md_file, "r+")
+        f.write("metadata")
+        f.close()
+        self.pool.put(entry)
+        self.pool.wait()
+        entries = [ self.pool.get(299008L) for i in range(0, 2) ]
+        self.failUnless(entry in entries)
+        self.failUnless(os.path.getsize(md_file) == 1L << 20)
+        f = open(loop, "r")
+        self.failUnless(f.read(8) == "\0" * 8)
+        f.close()
+        for e in entries:
+            self.pool.put(e)
+    def testRefill(self):
+        """The pool refills in the background once below the low watermark"""
+        entries = [ self.pool.get(299008L) for i in range(0, 2) ]
+        self.pool.wait()
+        self.failUnless(len(self.pool.idle[1L << 20]) == 2)
+        for e in entries:
+            self.pool.put(e)
+        self.pool.wait()
+        self.failUnless(len(self.pool.idle[1L << 20]) == 2)
+
+class Md_volume_test(unittest.TestCase):
+    def setUp(self):
+        self.nloops = len(losetup.Loop().list())
+        self.volume = Md_volume(slots=2)
+    def tearDown(self):
+        self.volume.close()
+        self.failUnless(len(losetup.Loop().list()) == self.nloops)
+    def testSlots(self):
+        """Slots are handed out lowest first, one loop device for all"""
+        self.failUnless(len(losetup.Loop().list()) == self.nloops + 1)
+        self.failUnless(self.volume.get(index_slot_size + 1) is None)
+        self.failUnless([ self.volume.get(299008L) for i in range(0, 3) ] == [ 0, 1, None ])
+        self.volume.put(1)
+        self.volume.put(0)
+        self.failUnless(self.volume.get(299008L) == 0)
+    def testWipe(self):
+        """A released slot is zeroed before it is reused"""
+        index = self.volume.get(299008L)
+        f = open(self.volume.device, "r+")
+        f.seek(index * index_slot_size)
+        f.write("metadata")
+        f.close()
+        self.volume.put(index)
+        f = open(self.volume.device, "r")
+        f.seek(index * index_slot_size)
+        self.failUnless(f.read(8) == "\0" * 8)
+        f.close()
+
+if __name__ == "__main__":
+    unittest.main()
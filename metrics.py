@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+# Latency histograms and error counters, exported in the Prometheus text
+# format. Recording a value costs a lock and a bisect, so it stays on.
+
+import time, threading, bisect
+
+# Upper bounds (in seconds) of the histogram buckets
+buckets = [ 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 ]
+
+class Histogram:
+    def __init__(self):
+        self.counts = [ 0 ] * (len(buckets) + 1)   # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+def _labels(labels, extra=[]):
+    pairs = list(labels) + extra
+    if pairs == []:
+        return ""
+    return "{%s}" % ",".join([ '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs ])
+
+def _number(x):
+    if x == int(x):
+        return str(int(x))
+    return repr(x)
+
+class Metrics:
+    """A set of named histograms and counters, each split by labels (a
+    tuple of (name, value) pairs). Safe to share between threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}     # name -> "histogram" or "counter"
+        self.help = {}      # name -> description
+        self.values = {}    # name -> labels -> Histogram or number
+    def describe(self, name, kind, help):
+        self.lock.acquire()
+        try:
+            self.kinds[name] = kind
+            self.help[name] = help
+            if name not in self.values:
+                self.values[name] = {}
+        finally:
+            self.lock.release()
+    def observe(self, name, labels, value):
+        """Add [value] to the histogram [name] with [labels]"""
+        self.lock.acquire()
+        try:
+            series = self.values[name]
+            if labels not in series:
+                series[labels] = Histogram()
+            series[labels].observe(value)
+        finally:
+            self.lock.release()
+    def increment(self, name, labels, n=1):
+        """Add [n] to the counter [name] with [labels]"""
+        self.lock.acquire()
+        try:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + n
+        finally:
+            self.lock.release()
+    def get(self, name, labels):
+        """Return the Histogram or counter value of [name] with [labels]"""
+        return self.values[name].get(labels)
+    def expose(self):
+        """Return every metric in the Prometheus text format"""
+        lines = []
+        self.lock.acquire()
+        try:
+            for name in sorted(self.values.keys()):
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, self.kinds[name]))
+                series = self.values[name]
+                for labels in sorted(series.keys()):
+                    value = series[labels]
+                    if self.kinds[name] == "counter":
+                        lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+                        continue
+                    total = 0
+                    for bound, count in zip(buckets + [ "+Inf" ], value.counts):
+                        total = total + count
+                        if bound <> "+Inf":
+                            bound = repr(bound)
+                        lines.append("%s_bucket%s %d" % (name, _labels(labels, [ ("le", bound) ]), total))
+                    lines.append("%s_sum%s %s" % (name, _labels(labels), repr(value.sum)))
+                    lines.append("%s_count%s %d" % (name, _labels(labels), value.count))
+        finally:
+            self.lock.release()
+        return "\n".join(lines) + "\n"
+
+# Shared by everything in this process
+metrics = Metrics()
+metrics.describe("drbd_manager_command_seconds", "histogram", "Time taken by external commands")
+metrics.describe("drbd_manager_command_errors_total", "counter", "External commands which failed")
+metrics.describe("drbd_manager_peer_seconds", "histogram", "Time taken by Peer methods")
+metrics.describe("drbd_manager_peer_errors_total", "counter", "Peer methods which raised, by exception")
+metrics.describe("drbd_manager_negotiate_retries_total", "counter", "Negotiation attempts which clashed and were retried, by side")
+
+def timed(method):
+    """Wrap the Peer [method] to record how long it takes and what it
+    raises"""
+    labels = (("method", method.__name__),)
+    def wrapper(*args):
+        start = time.time()
+        try:
+            return method(*args)
+        except Exception, e:
+            metrics.increment("drbd_manager_peer_errors_total", labels + (("error", e.__class__.__name__),))
+            raise
+        finally:
+            metrics.observe("drbd_manager_peer_seconds", labels, time.time() - start)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+import unittest
+class Metrics_test(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.describe("x_seconds", "histogram", "Some times")
+        self.metrics.describe("x_total", "counter", "Some things")
+    def testHistogram(self):
+        """Values land in the first bucket which is big enough"""
+        labels = (("command", "drbdadm"),)
+        for value in [ 0.001, 0.002, 0.3, 100.0 ]:
+            self.metrics.observe("x_seconds", labels, value)
+        h = self.metrics.get("x_seconds", labels)
+        self.failUnless(h.count == 4 and h.counts[0] == 1 and h.counts[1] == 1 and h.counts[-1] == 1)
+        text = self.metrics.expose()
+        self.failUnless('x_seconds_bucket{command="drbdadm",le="0.0025"} 2\n' in text)
+        self.failUnless('x_seconds_bucket{command="drbdadm",le="+Inf"} 4\n' in text)
+        self.failUnless('x_seconds_count{command="drbdadm"} 4\n' in text)
+        self.failUnless("# TYPE x_seconds histogram\n" in text)
+    def testCounter(self):
+        """Counters add up and their label values are escaped"""
+        self.metrics.increment("x_total", (("error", 'a"b'),))
+        self.metrics.increment("x_total", (("error", 'a"b'),))
+        self.failUnless('x_total{error="a\\"b"} 2\n' in self.metrics.expose())
+    def testTimed(self):
+        """Wrapped methods record their time and errors"""
+        class Thing:
+            @timed
+            def fail(self):
+                raise KeyError("x")
+        self.assertRaises(KeyError, Thing().fail)
+        self.failUnless(metrics.get("drbd_manager_peer_errors_total", (("method", "fail"), ("error", "KeyError"))) >= 1)
+        self.failUnless(metrics.get("drbd_manager_peer_seconds", (("method", "fail"),)).count >= 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+import time, threading, collections
+from util import log
+
+# KiB per unit of the "(remaining/total)" figures on a sync'ed line
+_units = { "K": 1, "M": 1024, "G": 1024 * 1024 }
+
+def out_of_sync(device):
+    """Return the KiB [device] (a Proc_drbd_device) still has to resync,
+    or None if /proc/drbd doesn't say"""
+    oos = device.get("oos")
+    if oos is not None:
+        return oos
+    remaining = device.get("remaining")
+    if remaining is not None:
+        return remaining * _units.get(device.get("units"), 1)
+    return None
+
+# One observation of a minor: the time, the KiB out of sync and the
+# application's KiB written and read
+Sample = collections.namedtuple("Sample", [ "time", "oos", "dw", "dr" ])
+
+def _rate(old, new, field):
+    a = getattr(old, field)
+    b = getattr(new, field)
+    if a is None or b is None or new.time <= old.time:
+        return None
+    return (b - a) / (new.time - old.time)
+
+class Minor_history:
+    """The last [size] samples of one minor and the resync throughput
+    smoothed with weight [alpha] given to the newest observation"""
+    def __init__(self, size, alpha):
+        self.samples = collections.deque(maxlen=size)
+        self.alpha = alpha
+        self.device = None
+        self.throughput = None      # KiB/s over the last interval
+        self.throughput_avg = None  # KiB/s, smoothed
+    def add(self, sample, device):
+        self.device = device
+        if len(self.samples) > 0:
+            rate = _rate(self.samples[-1], sample, "oos")
+            if rate is not None:
+                self.throughput = max(0.0, -rate)
+                if self.throughput_avg is None:
+                    self.throughput_avg = self.throughput
+                else:
+                    self.throughput_avg = self.alpha * self.throughput + (1.0 - self.alpha) * self.throughput_avg
+        self.samples.append(sample)
+    def status(self):
+        last = self.samples[-1]
+        eta = None
+        if last.oos == 0:
+            eta = 0.0
+        elif last.oos is not None and self.throughput_avg:
+            eta = last.oos / self.throughput_avg
+        write_rate = None
+        read_rate = None
+        if len(self.samples) > 1:
+            write_rate = _rate(self.samples[-2], last, "dw")
+            read_rate = _rate(self.samples[-2], last, "dr")
+        return {
+            "cs": self.device.get("cs"),
+            "progress": self.device.get("progress"),
+            "speed": self.device.get("speed"),
+            "out_of_sync": last.oos,
+            "throughput": self.throughput,
+            "throughput_avg": self.throughput_avg,
+            "eta": eta,
+            "write_rate": write_rate,
+            "read_rate": read_rate,
+            # requests waiting on the application, local disk and peer
+            "ap": self.device.get("ap"),
+            "lo": self.device.get("lo"),
+            "pe": self.device.get("pe"),
+            }
+
+# Samples /proc/drbd (via [read], which returns the result of
+# drbdadm.proc_drbd) every [interval] seconds in a background thread and
+# keeps the last [history] samples of each minor, so callers can ask for
+# the throughput and ETA of every resync without parsing /proc/drbd
+# themselves.
+class Resync_monitor:
+    def __init__(self, read, interval=1.0, history=60, alpha=0.3, clock=time.time):
+        self.read = read
+        self.interval = interval
+        self.history = history
+        self.alpha = alpha
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.minors = {}    # minor -> Minor_history
+        self.thread = None
+        self.stopped = threading.Event()
+    def sample(self):
+        """Read /proc/drbd once and record a sample of every minor"""
+        devices = self.read()["devices"]
+        now = self.clock()
+        self.lock.acquire()
+        try:
+            for minor in self.minors.keys():
+                if minor not in devices or devices[minor].get("cs") == "Unconfigured":
+                    del self.minors[minor]
+            for minor in devices:
+                device = devices[minor]
+                if device.get("cs") == "Unconfigured":
+                    continue
+                if minor not in self.minors:
+                    self.minors[minor] = Minor_history(self.history, self.alpha)
+                self.minors[minor].add(Sample(now, out_of_sync(device), device.get("dw"), device.get("dr")), device)
+        finally:
+            self.lock.release()
+    def status(self, minor=None):
+        """Return a dictionary of minor -> resync status, or just the
+        status of [minor]"""
+        self.lock.acquire()
+        try:
+            if minor is not None:
+                return self.minors[minor].status()
+            results = {}
+            for minor in self.minors:
+                results[minor] = self.minors[minor].status()
+            return results
+        finally:
+            self.lock.release()
+    def samples(self, minor):
+        """Return the samples held for [minor], oldest first"""
+        self.lock.acquire()
+        try:
+            return list(self.minors[minor].samples)
+        finally:
+            self.lock.release()
+    def _run(self):
+        while not self.stopped.isSet():
+            try:
+                self.sample()
+            except Exception, e:
+                log("Resync_monitor: %s" % str(e))
+            self.stopped.wait(self.interval)
+    def start(self):
+        """Start sampling in the background, if not already"""
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+    def stop(self):
+        """Stop sampling in the background; [start] may be called again"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.thread = None
+        self.stopped.clear()
+
+import unittest, drbdadm
+class Resync_monitor_test(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.lines = []
+        self.monitor = Resync_monitor(lambda:drbdadm.proc_drbd(self.lines),
+                                      history=4, alpha=0.5, clock=lambda:self.now)
+    def resync(self, t, oos, dw):
+        self.now = t
+        self.lines = drbdadm.header + [
+            " 1: cs:SyncSource st:Primary/Secondary ds:UpToDate/Inconsistent C r---\n",
+            "    ns:0 nr:0 dw:%d dr:0 al:0 bm:0 lo:0 pe:0 ua:0 ap:0 ep:1 wo:f oos:%d\n" % (dw, oos),
+            "	[>....................] sync'ed:  0.1% (8058/8063)M\n",
+            "	finish: 8:35:44 speed: 12,252 (12,240) K/sec\n",
+            " 2: cs:Unconfigured\n" ]
+        self.monitor.sample()
+    def testThroughput(self):
+        """Throughput, the smoothed average and the ETA follow oos"""
+        self.resync(0.0, 10000, 0)
+        x = self.monitor.status(1)
+        self.failUnless(x["throughput"] is None and x["eta"] is None)
+        self.resync(1.0, 9000, 100)
+        x = self.monitor.status(1)
+        self.failUnless(x["throughput"] == 1000.0 and x["eta"] == 9.0)
+        self.failUnless(x["write_rate"] == 100.0 and x["speed"] == 12252)
+        self.resync(2.0, 7000, 100)
+        x = self.monitor.status(1)
+        self.failUnless(x["throughput"] == 2000.0 and x["throughput_avg"] == 1500.0)
+        self.failUnless(x["eta"] == 7000 / 1500.0)
+        self.failUnless(2 not in self.monitor.status())
+    def testRing(self):
+        """Only the most recent samples are kept"""
+        for i in range(0, 10):
+            self.resync(float(i), 10000 - i, 0)
+        x = self.monitor.samples(1)
+        self.failUnless(map(lambda s:s.time, x) == [ 6.0, 7.0, 8.0, 9.0 ])
+    def testRemaining(self):
+        """Without oos, the sync'ed line's remaining figure is used"""
+        self.now = 0.0
+        self.lines = drbdadm.header + [
+            " 1: cs:SyncTarget st:Secondary/Primary ds:Inconsistent/UpToDate C r---\n",
+            "    ns:0 nr:0 dw:0 dr:0 al:0 bm:0 lo:0 pe:0 ua:0 ap:0\n",
+            "	[>....................] sync'ed:  0.1% (8058/8063)M\n" ]
+        self.monitor.sample()
+        self.failUnless(self.monitor.status(1)["out_of_sync"] == 8058 * 1024)
+    def testGone(self):
+        """Minors which disappear are forgotten"""
+        self.resync(0.0, 10000, 0)
+        self.lines = drbdadm.header
+        self.monitor.sample()
+        self.failUnless(self.monitor.status() == {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+import threading
+from util import log
+
+# Adjusts the resync rate of every resource on [drbd] (a Drbd or
+# Drbd_simulator) from what its resync monitor sees in /proc/drbd:
+#  - while a resync is limited by its rate (the measured throughput is
+#    within [headroom] of it) and the application isn't queueing, the rate
+#    is multiplied by [increase], up to [max_rate];
+#  - when more than [max_pending] application or local disk requests are
+#    waiting ("ap" + "lo"), which is how suffering foreground I/O shows up
+#    in /proc/drbd, the rate is multiplied by [decrease], down to
+#    [min_rate].
+# Rates are in KiB/s. A resync which is limited by something else (the
+# link, the disks) is left alone: raising its rate would gain nothing, as
+# is any resource which isn't resyncing. A resync starts from the rate its
+# resource was configured with, or [initial_rate] if it has none.
+resync_states = [ "SyncSource", "SyncTarget", "PausedSyncS", "PausedSyncT" ]
+
+class Rate_controller:
+    def __init__(self, drbd, min_rate=10240, max_rate=1048576, initial_rate=None,
+                 increase=1.25, decrease=0.5, headroom=0.8, max_pending=16, interval=5.0):
+        self.drbd = drbd
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        if initial_rate is None:
+            initial_rate = min_rate
+        self.initial_rate = initial_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.headroom = headroom
+        self.max_pending = max_pending
+        self.interval = interval
+        self.rates = {}     # minor -> the rate we last set
+        self.thread = None
+        self.stopped = threading.Event()
+    def _decide(self, rate, status):
+        """Return the new rate for a resource with [status] (see
+        monitor.Resync_monitor) currently resyncing at [rate]"""
+        pending = (status.get("ap") or 0) + (status.get("lo") or 0)
+        if pending > self.max_pending:
+            return max(self.min_rate, int(rate * self.decrease))
+        if not status.get("out_of_sync"):
+            return rate
+        throughput = status.get("throughput_avg")
+        if throughput is not None and throughput >= rate * self.headroom:
+            return min(self.max_rate, int(rate * self.increase))
+        return rate
+    def tick(self, status):
+        """Given [status], minor -> resync status, change the rate of each
+        resource which needs it. Returns minor -> new rate for the
+        resources which were changed."""
+        for minor in self.rates.keys():
+            if minor not in status:
+                del self.rates[minor]
+        changed = {}
+        for minor in status:
+            if status[minor].get("cs") not in resync_states:
+                self.rates.pop(minor, None)
+                continue
+            config = self.drbd.configs.by_minor(minor)
+            if config is None:
+                # not one of ours
+                continue
+            rate = self.rates.get(minor, config.get("rate"))
+            configured = rate is not None
+            if not configured:
+                rate = self.initial_rate
+            new = self._decide(rate, status[minor])
+            if not configured or new <> rate:
+                try:
+                    self.drbd.set_resync_rate(minor, new)
+                except KeyError:
+                    # stopped since
+                    continue
+                changed[minor] = new
+            self.rates[minor] = new
+        return changed
+    def _run(self):
+        while not self.stopped.isSet():
+            try:
+                self.tick(self.drbd.resync_status())
+            except Exception, e:
+                log("Rate_controller: %s" % str(e))
+            self.stopped.wait(self.interval)
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+import unittest, drbdadm, monitor
+
+def snapshot(oos, dw, ap):
+    """A recorded /proc/drbd snapshot of minor 1 resyncing"""
+    return [
+        "version: 8.3.11 (api:88/proto:86-96)\n",
+        "srcversion: 71955441799F513ACA6DA60\n",
+        " 1: cs:SyncSource ro:Primary/Secondary ds:UpToDate/Inconsistent C r-----\n",
+        "    ns:0 nr:0 dw:%d dr:0 al:0 bm:0 lo:0 pe:2 ua:0 ap:%d ep:1 wo:f oos:%d\n" % (dw, ap, oos),
+        "	[>....................] sync'ed:  1.0% (8058/8063)M\n",
+        "	finish: 0:10:00 speed: 51,200 (51,200) K/sec\n" ]
+
+# A resync running at 50MiB/s on an idle VM
+idle_trace = [ snapshot(8000000 - i * 51200, 0, 0) for i in range(0, 20) ]
+# The same resync with the VM's writes queueing from the 10th sample on
+busy_trace = [ snapshot(8000000 - i * 51200, i * 4096, (i >= 10 and 64) or 0) for i in range(0, 20) ]
+
+class Rate_controller_test(unittest.TestCase):
+    def setUp(self):
+        self.drbd = drbdadm.Drbd_simulator()
+        self.drbd.start(drbdadm.make_simple_config(1, 8080))
+        self.now = 0.0
+        self.drbd.monitor = monitor.Resync_monitor(self.drbd._read_proc_drbd, clock=lambda:self.now)
+        self.controller = Rate_controller(self.drbd)
+    def replay(self, trace):
+        """Replay [trace] at one snapshot per second and return the rate
+        after each"""
+        self.drbd.replay(trace)
+        rates = []
+        for i in range(0, len(trace)):
+            self.now = float(i)
+            self.drbd.monitor.sample()
+            self.controller.tick(self.drbd.monitor.status())
+            rates.append(self.drbd.configs["1.8080"]["rate"])
+        return rates
+    def testIncrease(self):
+        """The rate rises until it is no longer the limit"""
+        rates = self.replay(idle_trace)
+        self.failUnless(rates[0] == self.controller.min_rate)
+        self.failUnless(rates == sorted(rates))
+        self.failUnless(51200 <= rates[-1] < 51200 / self.controller.headroom * self.controller.increase)
+        # once it stops being the limit it stays put
+        self.failUnless(rates[-1] == rates[-2])
+    def testBackOff(self):
+        """The rate falls when the application's requests start queueing"""
+        rates = self.replay(busy_trace)
+        self.failUnless(rates[10] == rates[9] / 2)
+        self.failUnless(rates[-1] == self.controller.min_rate)
+    def testConfigured(self):
+        """A resync starts from its configured rate"""
+        self.drbd.configs["1.8080"]["rate"] = 40960
+        rates = self.replay(idle_trace)
+        self.failUnless(rates[0] == 40960 and rates[-1] >= 51200)
+    def testInSync(self):
+        """Resources which aren't resyncing are left alone"""
+        self.drbd.monitor.sample()
+        status = self.drbd.monitor.status()
+        self.failUnless(status[1]["cs"] == "Connected")
+        self.failUnless(self.controller.tick(status) == {} and "rate" not in self.drbd.configs["1.8080"])
+    def testForget(self):
+        """Resources which go away are forgotten"""
+        self.replay(idle_trace[:2])
+        self.failUnless(self.controller.tick({}) == {} and self.controller.rates == {})
+
+if __name__ == "__main__":
+    unittest.main()
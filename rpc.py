@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+# A compact alternative to XML-RPC for talking to remote Peers: each
+# message is a 4-byte big-endian length followed by that many bytes of
+# JSON, and connections stay open between calls.
+#   request: { "uri": "/3", "method": "start", "params": [...], "trace": ... }
+#   reply:   { "result": ... } or { "error": class name, "message": ... }
+# A Proxy starts out speaking XML-RPC and switches to this if the server
+# offers it in versionExchange, so old servers keep working.
+
+import socket, struct, json, threading, SocketServer, urlparse, xmlrpclib, select
+import tracing
+
+_length = struct.Struct(">I")
+
+# refuse to read anything bigger than this
+max_message = 16 * 1024 * 1024
+
+class Fault(xmlrpclib.Fault):
+    """A remote exception with no local equivalent: an xmlrpclib.Fault so
+    callers needn't care which transport was used"""
+    pass
+
+# class name -> constructor (taking the message) of remote exceptions which
+# are raised again locally rather than as a Fault
+errors = {}
+
+def _str(x):
+    """Turn the unicode strings from json.loads back into str, as xmlrpclib
+    would return"""
+    if isinstance(x, unicode):
+        return x.encode("utf-8")
+    if isinstance(x, list):
+        return [ _str(y) for y in x ]
+    if isinstance(x, dict):
+        return dict([ (_str(k), _str(v)) for k, v in x.items() ])
+    return x
+
+def send(sock, obj):
+    body = json.dumps(obj, separators=(",", ":"))
+    sock.sendall(_length.pack(len(body)) + body)
+
+def _read(sock, n):
+    chunks = []
+    while n > 0:
+        data = sock.recv(n)
+        if not data:
+            raise EOFError("connection closed")
+        chunks.append(data)
+        n = n - len(data)
+    return "".join(chunks)
+
+def closed(sock):
+    """Whether the idle connection [sock] is no use: there should be nothing
+    to read from it, so if there is, the server has closed it (or it has
+    failed, or is out of step)"""
+    try:
+        return select.select([ sock ], [], [], 0)[0] <> []
+    except (select.error, socket.error):
+        return True
+
+def receive(sock):
+    n = _length.unpack(_read(sock, _length.size))[0]
+    if n > max_message:
+        raise ValueError("message of %d bytes is too big" % n)
+    return _str(json.loads(_read(sock, n)))
+
+class Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request.settimeout(self.server.idle_timeout)
+        while True:
+            try:
+                request = receive(self.request)
+            except (EOFError, ValueError, socket.error):
+                return
+            try:
+                send(self.request, self.server.dispatch(request))
+            except socket.error:
+                return
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serves requests on [address] by calling [call uri method params],
+    one thread per connection. Connections idle for [idle_timeout]
+    seconds are closed."""
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, call, idle_timeout=60.0):
+        SocketServer.TCPServer.__init__(self, address, Handler)
+        self.call = call
+        self.idle_timeout = idle_timeout
+    def dispatch(self, request):
+        # continue the caller's trace, if it sent one
+        tracing.tracer.adopt(request.get("trace"))
+        try:
+            try:
+                return { "result": self.call(request["uri"], request["method"], request["params"]) }
+            except Exception, e:
+                return { "error": e.__class__.__name__, "message": str(e) }
+        finally:
+            tracing.tracer.release()
+
+def _error(reply):
+    if reply["error"] in errors:
+        return errors[reply["error"]](reply["message"])
+    return Fault(1, "%s:%s" % (reply["error"], reply["message"]))
+
+class Pool:
+    """Keeps up to [size] idle connections to each server for reuse"""
+    def __init__(self, size=8, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}  # (host, port) -> [ socket ]
+    def _get(self, address):
+        """Return an idle connection to [address] which is still open, or
+        None"""
+        while True:
+            self.lock.acquire()
+            try:
+                x = self.idle.get(address, [])
+                if x == []:
+                    return None
+                s = x.pop()
+            finally:
+                self.lock.release()
+            if not closed(s):
+                return s
+            s.close()
+    def _put(self, address, s):
+        self.lock.acquire()
+        try:
+            x = self.idle.setdefault(address, [])
+            if len(x) < self.size:
+                x.append(s)
+                return
+        finally:
+            self.lock.release()
+        s.close()
+    def _connect(self, address):
+        s = socket.create_connection(address, self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s
+    def call(self, address, uri, method, params):
+        """Call [method] with [params] on the object at [uri] on the server
+        at [address]"""
+        request = { "uri": uri, "method": method, "params": list(params) }
+        trace = tracing.tracer.header()
+        if trace is not None:
+            request["trace"] = trace
+        s = self._get(address)
+        if s is None:
+            s = self._connect(address)
+        # once sent, the request may have run even if there's no reply, so
+        # it's never sent again: that could start a resource twice
+        try:
+            send(s, request)
+            reply = receive(s)
+        except:
+            s.close()
+            raise
+        self._put(address, s)
+        if "error" in reply:
+            raise _error(reply)
+        return reply["result"]
+    def close(self):
+        self.lock.acquire()
+        try:
+            for x in self.idle.values():
+                for s in x:
+                    s.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+pool = Pool()
+
+class Proxy:
+    """Calls the methods of the remote object (a Peer or Peer_factory) at
+    the XML-RPC [url]. Calls go over XML-RPC until versionExchange finds
+    the server offers one of [transports], then over [pool]."""
+    def __init__(self, url, pool=pool, transports=[ "json" ]):
+        self.xmlrpc = tracing.proxy(url)
+        parts = urlparse.urlparse(url)
+        self.host = parts.hostname
+        self.uri = parts.path or "/"
+        self.pool = pool
+        self.transports = transports
+        self.address = None     # of our JSON server, once agreed
+    def versionExchange(self, version, transports=None, split=None):
+        """As the server's versionExchange, negotiating our own transports
+        along the way. With a [split] the reply is the server's dictionary,
+        and a server which doesn't understand it raises a Fault."""
+        if self.transports == [] or self.address is not None:
+            if transports is None and split is None:
+                return self._call("versionExchange", [ version ])
+            return self._call("versionExchange", [ version, transports, split ])
+        if split is not None:
+            x = self.xmlrpc.versionExchange(version, self.transports, split)
+        else:
+            try:
+                x = self.xmlrpc.versionExchange(version, self.transports)
+            except xmlrpclib.Fault:
+                # a server which doesn't know about transports
+                return self.xmlrpc.versionExchange(version)
+        if "json" in x["transports"]:
+            self.address = (self.host, x["transports"]["json"])
+        if split is not None:
+            return x
+        return x["version"]
+    def _call(self, method, params):
+        if self.address is None:
+            return getattr(self.xmlrpc, method)(*params)
+        return self.pool.call(self.address, self.uri, method, params)
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *params:self._call(name, params)
+
+import unittest
+class Rpc_test(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.server = Server(("127.0.0.1", 0), self.call, idle_timeout=5.0)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.address = self.server.server_address
+        self.pool = Pool()
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+    def call(self, uri, method, params):
+        self.calls.append((uri, method, params))
+        if method == "fail":
+            raise KeyError(params[0])
+        if method == "transient":
+            raise IOError(params[0])
+        return { "uri": uri, "params": params }
+    def testCall(self):
+        """Calls reuse one connection and round-trip str values"""
+        for i in range(0, 3):
+            x = self.pool.call(self.address, "/1", "start", [ "a", { "b": [ 1, None ] } ])
+        self.failUnless(x == { "uri": "/1", "params": [ "a", { "b": [ 1, None ] } ] })
+        self.failUnless(type(x["uri"]) == str)
+        self.failUnless(len(self.pool.idle[self.address]) == 1)
+    def testErrors(self):
+        """Registered exceptions are raised again; the rest are Faults"""
+        errors["IOError"] = IOError
+        try:
+            self.assertRaises(IOError, lambda:self.pool.call(self.address, "/", "transient", [ "x" ]))
+        finally:
+            del errors["IOError"]
+        self.assertRaises(xmlrpclib.Fault, lambda:self.pool.call(self.address, "/", "fail", [ "x" ]))
+    def testStale(self):
+        """A pooled connection the server has closed is replaced"""
+        self.pool.call(self.address, "/", "start", [])
+        s = self.pool.idle[self.address][0]
+        s.shutdown(socket.SHUT_RDWR)
+        self.pool.call(self.address, "/", "start", [])
+        self.failUnless(len(self.calls) == 2)
+    def testNoResend(self):
+        """A request to a server which dies before replying isn't sent
+        again"""
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        requests = []
+        def serve():
+            c, _ = listener.accept()
+            requests.append(receive(c))
+            send(c, { "result": None })
+            requests.append(receive(c))
+            c.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        try:
+            address = listener.getsockname()
+            self.pool.call(address, "/", "start", [])
+            self.assertRaises(EOFError, lambda:self.pool.call(address, "/", "start", []))
+            t.join()
+            # no second connection
+            listener.settimeout(0.1)
+            self.assertRaises(socket.timeout, listener.accept)
+        finally:
+            listener.close()
+        self.failUnless(len(requests) == 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# Copyright (C) Citrix
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+
+# Trace spans for negotiations. A span started with no trace in progress
+# on the current thread begins a new trace; spans started inside it are
+# its children. The trace id and the current span travel to a remote
+# drbd.py in an X-Trace header (see Transport) so both halves of a
+# negotiation can be put back together from the two hosts' dumps.
+
+import os, time, socket, threading, collections, xmlrpclib
+
+header = "X-Trace"
+
+class Span:
+    __slots__ = [ "trace", "id", "parent", "name", "host", "start", "end", "error" ]
+    def __init__(self, trace, id, parent, name, host, start):
+        self.trace = trace
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.host = host
+        self.start = start
+        self.end = None
+        self.error = None
+    def to_dict(self):
+        return dict([ (k, getattr(self, k)) for k in self.__slots__ ])
+
+def _new_id():
+    return os.urandom(8).encode("hex")
+
+# Finished spans are kept in a ring of [size], oldest dropped first
+class Tracer:
+    def __init__(self, size=10000, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.spans = collections.deque(maxlen=size)
+        self.local = threading.local()
+        self.host = "%s:%d" % (socket.gethostname(), os.getpid())
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = []
+            self.local.stack = stack
+        return stack
+    def current(self):
+        """Return (trace id, span id) of the innermost span on this thread,
+        or None"""
+        stack = self._stack()
+        if stack == []:
+            return None
+        return stack[-1]
+    def begin(self, name, root=True, push=True):
+        """Start a span called [name] on this thread. Unless [root], only
+        do so within a trace: otherwise return None. Unless [push], the span
+        is not the parent of spans begun after it (as when coroutines share
+        the thread)"""
+        stack = self._stack()
+        if stack == []:
+            if not root:
+                return None
+            trace, parent = _new_id(), None
+        else:
+            trace, parent = stack[-1]
+        span = Span(trace, _new_id(), parent, name, self.host, self.clock())
+        if push:
+            stack.append((trace, span.id))
+        return span
+    def end(self, span, error=None):
+        """Finish [span] (which may be None) and record it"""
+        if span is None:
+            return
+        span.end = self.clock()
+        if error is not None:
+            span.error = error.__class__.__name__
+        stack = self._stack()
+        if stack <> [] and stack[-1][1] == span.id:
+            stack.pop()
+        self.lock.acquire()
+        try:
+            self.spans.append(span)
+        finally:
+            self.lock.release()
+    def adopt(self, value):
+        """Continue the trace described by an X-Trace header [value] on
+        this thread, until [release]"""
+        self.local.stack = []
+        try:
+            trace, parent = value.split("-")
+        except (AttributeError, ValueError):
+            return
+        self.local.stack.append((trace, parent))
+    def release(self):
+        self.local.stack = []
+    def header(self):
+        """Return the X-Trace value describing the current span, or None"""
+        x = self.current()
+        if x is None:
+            return None
+        return "%s-%s" % x
+    def dump(self, trace=None):
+        """Return the recorded spans (of [trace] only, if given) as dicts"""
+        self.lock.acquire()
+        try:
+            return [ s.to_dict() for s in self.spans if trace is None or s.trace == trace ]
+        finally:
+            self.lock.release()
+
+tracer = Tracer()
+
+def traced(method):
+    """Wrap [method] so each call is a span named after it"""
+    def wrapper(*args):
+        span = tracer.begin(method.__name__)
+        try:
+            result = method(*args)
+        except Exception, e:
+            tracer.end(span, e)
+            raise
+        tracer.end(span)
+        return result
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class Transport(xmlrpclib.Transport):
+    """An xmlrpclib Transport which sends the current trace with each call"""
+    def send_host(self, connection, host):
+        xmlrpclib.Transport.send_host(self, connection, host)
+        value = tracer.header()
+        if value is not None:
+            connection.putheader(header, value)
+
+def proxy(uri):
+    """An xmlrpclib.Server for [uri] which propagates the current trace"""
+    return xmlrpclib.Server(uri, transport=Transport(), allow_none=True)
+
+def _children(spans):
+    ids = set([ s["id"] for s in spans ])
+    children = {}
+    for s in spans:
+        parent = s["parent"]
+        if parent not in ids:
+            parent = None
+        children.setdefault(parent, []).append(s)
+    for x in children.values():
+        x.sort(key=lambda s:s["start"])
+    return children
+
+def timeline(spans):
+    """Render [spans] (dicts, perhaps merged from several hosts' dumps) as
+    one indented timeline per trace: offset from the start of the trace
+    and duration, both in ms"""
+    lines = []
+    traces = {}
+    for s in spans:
+        traces.setdefault(s["trace"], []).append(s)
+    for trace in sorted(traces.keys(), key=lambda t:min([ s["start"] for s in traces[t] ])):
+        x = traces[trace]
+        children = _children(x)
+        origin = min([ s["start"] for s in x ])
+        lines.append("trace %s" % trace)
+        def walk(parent, depth):
+            for s in children.get(parent, []):
+                error = ""
+                if s["error"]:
+                    error = " !%s" % s["error"]
+                lines.append("%9.3f %9.3f %s%s [%s]%s" % ((s["start"] - origin) * 1000.0, (s["end"] - s["start"]) * 1000.0, "  " * depth, s["name"], s["host"], error))
+                walk(s["id"], depth + 1)
+        walk(None, 1)
+    return "\n".join(lines) + "\n"
+
+def folded(spans):
+    """Render [spans] as folded stacks ("a;b;c <us>", time spent in c
+    itself), the input format of flame graph tools"""
+    children = _children(spans)
+    totals = {}
+    def walk(parent, path):
+        for s in children.get(parent, []):
+            stack = path + [ s["name"] ]
+            inner = sum([ c["end"] - c["start"] for c in children.get(s["id"], []) ])
+            key = ";".join(stack)
+            totals[key] = totals.get(key, 0) + max(0, int(((s["end"] - s["start"]) - inner) * 1000000))
+            walk(s["id"], stack)
+    walk(None, [])
+    return "".join([ "%s %d\n" % (k, totals[k]) for k in sorted(totals.keys()) ])
+
+import unittest
+class Tracer_test(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.tracer = Tracer(size=4, clock=lambda:self.now)
+    def span(self, name, duration, root=True):
+        s = self.tracer.begin(name, root)
+        self.now = self.now + duration
+        return s
+    def testNesting(self):
+        """Spans started within a span are its children, in one trace"""
+        outer = self.span("negotiate", 1.0)
+        inner = self.span("start", 2.0)
+        self.tracer.end(inner)
+        self.tracer.end(outer, KeyError())
+        x = self.tracer.dump()
+        self.failUnless([ s["name"] for s in x ] == [ "start", "negotiate" ])
+        self.failUnless(x[0]["parent"] == x[1]["id"] and x[0]["trace"] == x[1]["trace"])
+        self.failUnless(x[1]["error"] == "KeyError" and x[1]["end"] == 3.0)
+        self.failUnless(self.tracer.current() is None)
+        self.failUnless(self.span("run", 1.0, root=False) is None)
+        self.failUnless(folded(x) == "negotiate 1000000\nnegotiate;start 2000000\n")
+        lines = timeline(x).splitlines()
+        self.failUnless(lines[1].split()[:3] == [ "0.000", "3000.000", "negotiate" ])
+        self.failUnless(lines[2].split()[:3] == [ "1000.000", "2000.000", "start" ])
+    def testBounded(self):
+        """Only the most recent spans are kept"""
+        for i in range(0, 10):
+            self.tracer.end(self.span(str(i), 1.0))
+        self.failUnless([ s["name"] for s in self.tracer.dump() ] == [ "6", "7", "8", "9" ])
+    def testAdopt(self):
+        """A trace continued from a header keeps its id and parent"""
+        outer = self.span("negotiate", 1.0)
+        value = self.tracer.header()
+        remote = Tracer(clock=lambda:self.now)
+        remote.adopt(value)
+        s = remote.begin("start")
+        remote.end(s)
+        remote.release()
+        self.failUnless(remote.current() is None)
+        self.failUnless(s.trace == outer.trace and s.parent == outer.id)
+
+if __name__ == "__main__":
+    unittest.main()
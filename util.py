@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import os, sys, time, socket, traceback, subprocess
+from metrics import metrics
+from tracing import tracer
 
 log_f = os.fdopen(os.dup(sys.stdout.fileno()), "aw")
 pid = None
@@ -29,15 +31,40 @@ class CommandError(Exception):
     def __str__(self):
         return "CommandError(%s, %s)" % (self.code, self.output)
 
+def _command_labels(cmd, task):
+    program = cmd[0]
+    if program == "sudo" and len(cmd) > 1:
+        program = cmd[1]
+    return (("command", os.path.basename(program)), ("task", task))
+
 # [run task cmd] executes [cmd], throwing a CommandError if exits with
-# a non-zero exit code.
+# a non-zero exit code. The time taken and any failure are recorded in
+# metrics by command name and [task].
 def run(cmd, task='unknown'):
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    result = p.stdout.readlines()
-    retval = p.wait ()
+    labels = _command_labels(cmd, task)
+    # a span of its own, if part of a traced negotiation
+    name = labels[0][1]
+    if task <> 'unknown':
+        name = "%s %s" % (name, task)
+    span = tracer.begin(name, root=False)
+    start = time.time()
+    try:
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError, e:
+            metrics.increment("drbd_manager_command_errors_total", labels)
+            tracer.end(span, e)
+            raise
+        result = p.stdout.readlines()
+        retval = p.wait ()
+    finally:
+        metrics.observe("drbd_manager_command_seconds", labels, time.time() - start)
     if retval <> 0:
+        metrics.increment("drbd_manager_command_errors_total", labels)
+        tracer.end(span, CommandError(retval, result))
         log("%s: %s exitted with code %d: %s" % (task, repr(cmd), retval, repr(result)))
         raise(CommandError(retval, result))
+    tracer.end(span)
     log("%s: %s" % (task, " ".join(cmd)))
     return result
 
@@ -49,52 +76,382 @@ def run_as_root(cmd, task='unknown'):
 import tempfile
 def make_sparse_file(size):
     fd, filename = tempfile.mkstemp(suffix='.md')
-    os.fdopen(fd).close()
-    run(["dd", "if=/dev/zero", "of=%s" % filename, "bs=1", "count=0", "seek=%Ld" % size])
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
     return filename
 
+import re, struct, fcntl, array, stat, errno, threading
+
+# From <linux/fs.h>
+BLKSSZGET = 0x1268
+BLKGETSIZE64 = (2 << 30) | (struct.calcsize("P") << 16) | (0x12 << 8) | 114
+
+def _blockdev_geometry(disk):
+    """(sector size, 512-byte sectors) of [disk] according to blockdev"""
+    sector_size = int(run_as_root(["blockdev", "--getss", disk])[0].strip())
+    sectors = long(run_as_root(["blockdev", "--getsize", disk])[0].strip())
+    return sector_size, sectors
+
+def _ioctl_geometry(disk):
+    """(sector size, 512-byte sectors) of [disk] asking the kernel directly"""
+    fd = os.open(disk, os.O_RDONLY)
+    try:
+        sector_size = struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, struct.pack("i", 0)))[0]
+        size = struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, struct.pack("Q", 0)))[0]
+    finally:
+        os.close(fd)
+    return sector_size, long(size / 512)
+
+class Block_device_cache:
+    """The sector size and size of block devices, read with ioctls rather
+    than by forking blockdev. Each is kept until its size in sysfs
+    changes, which is cheap to check, or until [invalidate]. Devices we
+    can't open ourselves (eg when not root) are still asked of blockdev."""
+    def __init__(self, read=_ioctl_geometry, fallback=_blockdev_geometry):
+        self.read = read
+        self.fallback = fallback
+        self.lock = threading.Lock()
+        self.entries = {}   # device number -> (sector size, sectors)
+    def _sysfs_sectors(self, rdev):
+        try:
+            return long(read_file("/sys/dev/block/%d:%d/size" % (os.major(rdev), os.minor(rdev)))[0])
+        except (IOError, IndexError, ValueError):
+            return None
+    def get(self, disk):
+        """Return (sector size, 512-byte sectors) of [disk]"""
+        try:
+            st = os.stat(disk)
+        except OSError:
+            return self.fallback(disk)
+        if not stat.S_ISBLK(st.st_mode):
+            return self.fallback(disk)
+        sectors = self._sysfs_sectors(st.st_rdev)
+        self.lock.acquire()
+        try:
+            x = self.entries.get(st.st_rdev)
+        finally:
+            self.lock.release()
+        if x is not None and sectors is not None and x[1] == sectors:
+            return x
+        try:
+            x = self.read(disk)
+        except (IOError, OSError), e:
+            if e.errno not in [ errno.EACCES, errno.EPERM ]:
+                raise
+            return self.fallback(disk)
+        self.lock.acquire()
+        try:
+            self.entries[st.st_rdev] = x
+        finally:
+            self.lock.release()
+        return x
+    def invalidate(self, disk=None):
+        """Forget [disk], or every device"""
+        self.lock.acquire()
+        try:
+            if disk is None:
+                self.entries = {}
+            else:
+                self.entries.pop(os.stat(disk).st_rdev, None)
+        finally:
+            self.lock.release()
+
+block_devices = Block_device_cache()
+
+def block_device_geometry(disk):
+    """Return (sector size, 512-byte sectors) of [disk]"""
+    return block_devices.get(disk)
+
 def block_device_sector_size(disk):
-    return int(run_as_root(["blockdev", "--getss", disk])[0].strip())
+    return block_device_geometry(disk)[0]
 
 def block_device_sectors(disk):
-    return long(run_as_root(["blockdev", "--getsize", disk])[0].strip())
+    return block_device_geometry(disk)[1]
+
+SIOCGIFCONF = 0x8912
+SIOCGIFNETMASK = 0x891b
+
+def list_ipv4_interfaces():
+    """Return a list of (interface name, IPv4 address, netmask) for every
+    configured address, asking the kernel directly with SIOCGIFCONF."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # struct ifreq is 40 bytes on 64-bit and 32 on 32-bit
+        ifreq_size = 16 + 2 * struct.calcsize("P") + 8
+        size = 32 * ifreq_size
+        while True:
+            buf = array.array('B', '\0' * size)
+            addr, _ = buf.buffer_info()
+            ifconf = fcntl.ioctl(s.fileno(), SIOCGIFCONF, struct.pack("iP", size, addr))
+            length = struct.unpack("iP", ifconf)[0]
+            if length < size:
+                break
+            # the buffer may have been truncated
+            size = size * 2
+        data = buf.tostring()
+        results = []
+        for i in range(0, length, ifreq_size):
+            name = data[i:i+16].split('\0', 1)[0]
+            ip = socket.inet_ntoa(data[i+20:i+24])
+            ifreq = fcntl.ioctl(s.fileno(), SIOCGIFNETMASK, struct.pack("256s", name))
+            results.append((name, ip, socket.inet_ntoa(ifreq[20:24])))
+        return results
+    finally:
+        s.close()
 
-import re
 def list_all_ipv4_addresses():
-    results = []
-    for line in run(["/sbin/ifconfig"]):
-        m = re.match('^\s*inet addr:(\S+) ', line)
-        if m:
-            results.append(m.group(1))
-    return results
+    return map(lambda x:x[1], list_ipv4_interfaces())
 
-def replication_ip():
-    # XXX we need to define storage, replication IPs officially somehow
-    return filter(lambda x:x <> "127.0.0.1", list_all_ipv4_addresses())[0]
+def _ipv4_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
 
-def used_ports(ip):
-    """Return a list of port numbers currently in-use."""
-    used = []
+def in_subnet(ip, subnet):
+    """True if [ip] is within [subnet] (in CIDR "a.b.c.d/n" form)"""
+    network, _, bits = subnet.partition("/")
+    mask = (0xffffffffL << (32 - int(bits))) & 0xffffffffL
+    return _ipv4_to_int(ip) & mask == _ipv4_to_int(network) & mask
+
+class NoReplicationIP(Exception):
+    def __init__(self, network):
+        self.network = network
+    def __str__(self):
+        return "No local IPv4 address matches replication network %s" % repr(self.network)
+
+def select_replication_ip(interfaces, network=None):
+    """Choose the replication IP from [interfaces] (as returned by
+    list_ipv4_interfaces). [network] may be a subnet ("10.0.0.0/24") or an
+    interface name ("eth1"); by default the first non-loopback address is
+    used."""
+    for name, ip, netmask in interfaces:
+        if network is None:
+            if not ip.startswith("127."):
+                return ip
+        elif "/" in network:
+            if in_subnet(ip, network):
+                return ip
+        elif name == network:
+            return ip
+    raise NoReplicationIP(network)
+
+# The subnet or interface name which replication traffic should use, or
+# None to pick the first non-loopback address
+# XXX we need to define storage, replication IPs officially somehow
+replication_network = None
+
+class Address_cache:
+    """Caches the list of local interface addresses. Call [invalidate]
+    when addresses change; optionally entries also expire after [ttl]
+    seconds."""
+    def __init__(self, ttl=None, clock=time.time, read=list_ipv4_interfaces):
+        self.ttl = ttl
+        self.clock = clock
+        self.read = read
+        self.cached = None
+        self.read_at = None
+    def interfaces(self):
+        now = self.clock()
+        if self.cached is None or (self.ttl is not None and now - self.read_at > self.ttl):
+            self.cached = self.read()
+            self.read_at = now
+        return self.cached
+    def invalidate(self):
+        self.cached = None
+    def replication_ip(self, network=None):
+        return select_replication_ip(self.interfaces(), network)
+
+address_cache = Address_cache()
+
+def replication_ip(network=None):
+    """Return the local IP to use for replication traffic"""
+    if network is None:
+        network = replication_network
+    return address_cache.replication_ip(network)
+
+def used_ports_netstat(ip):
+    """Return the set of port numbers currently in-use on [ip], according
+    to netstat. Forks; used_ports is much cheaper."""
+    used = set()
     for line in run(["/bin/netstat", "-an"]):
-        m = re.match('^tcp\s+\S+\s+\S+\s+(\S+)\s+', line)
+        m = re.match('^tcp6?\s+\S+\s+\S+\s+(\S+)\s+', line)
         if m:
-            endpoint = m.group(1)
-            bits = endpoint.split(':')
-            if bits[0] == ip:
-                used.append(bits[1])
+            ip_txt, _, port = m.group(1).rpartition(':')
+            if ip_txt in [ ip, "0.0.0.0", "::", ":::" ]:
+                used.add(int(port))
     return used
 
+def _proc_net_ip(txt):
+    """Convert an address from /proc/net/tcp{,6} (hex, host byte order
+    32-bit words) to the usual text form. IPv4-mapped IPv6 addresses are
+    returned as IPv4."""
+    if len(txt) == 8:
+        return socket.inet_ntoa(struct.pack("=I", int(txt, 16)))
+    words = [ int(txt[i:i+8], 16) for i in range(0, 32, 8) ]
+    packed = struct.pack("=4I", *words)
+    if packed[:12] == "\0" * 10 + "\xff\xff":
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+# Addresses which mean "every local address"
+_wildcard_ips = [ "0.0.0.0", "::" ]
+
+def parse_proc_net_tcp(lines):
+    """Given [lines] from /proc/net/tcp or /proc/net/tcp6 return a dictionary
+    of local IP -> set of local ports in use. Sockets bound to the wildcard
+    address are listed under the key ''."""
+    results = {}
+    for line in lines[1:]:
+        bits = line.split()
+        if len(bits) < 2:
+            continue
+        ip_txt, _, port_txt = bits[1].partition(':')
+        ip = _proc_net_ip(ip_txt)
+        if ip in _wildcard_ips:
+            ip = ""
+        if ip not in results:
+            results[ip] = set()
+        results[ip].add(int(port_txt, 16))
+    return results
+
+def read_used_ports():
+    """Return a dictionary of local IP -> set of TCP ports in use, read
+    directly from /proc/net/tcp and /proc/net/tcp6"""
+    results = {}
+    for filename in [ "/proc/net/tcp", "/proc/net/tcp6" ]:
+        try:
+            lines = read_file(filename)
+        except IOError:
+            # no IPv6
+            continue
+        for ip, ports in parse_proc_net_tcp(lines).items():
+            results[ip] = results.get(ip, set()) | ports
+    return results
+
+def used_ports(ip):
+    """Return the set of port numbers currently in-use on [ip]."""
+    used = read_used_ports()
+    return used.get(ip, set()) | used.get("", set())
+
+import threading
+class Port_allocator:
+    """Hands out TCP ports which are currently free for DRBD replication.
+    The kernel's socket table is read from /proc (at most every
+    [refresh_interval] seconds) into a set of used ports per IP. Ports
+    handed out are leased for [lease] seconds so concurrent allocations
+    in this process don't collide. With [probe] each port is also bound to
+    check it really is free, and the socket is held until [handover] is
+    called just before DRBD binds the port itself. Safe to share between
+    threads."""
+    def __init__(self, first=7789, probe=False, lease=60.0, refresh_interval=1.0, clock=time.time, read=read_used_ports):
+        self.first = first
+        self.probe = probe
+        self.lease = lease
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.read = read
+        self.lock = threading.Lock()
+        self.used = {}      # IP -> set of ports, '' for the wildcard address
+        self.refreshed = None
+        self.reserved = {}  # (IP, port) -> time the lease expires
+        self.held = {}      # (IP, port) -> bound socket
+    def _refresh(self, now):
+        if self.refreshed is None or now - self.refreshed > self.refresh_interval:
+            self.used = self.read()
+            self.refreshed = now
+            for key in self.reserved.keys():
+                if self.reserved[key] <= now:
+                    del self.reserved[key]
+    def _bind(self, ip, port):
+        family = socket.AF_INET
+        if ":" in ip:
+            family = socket.AF_INET6
+        s = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((ip, port))
+            return s
+        except socket.error:
+            s.close()
+            return None
+    def reserve(self, ip, part=None):
+        """Return a port which is free on [ip] and lease it. With [part],
+        an [index, count] pair, only every count'th port from the first
+        plus index is considered."""
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            self._refresh(now)
+            # remember ports found dead by probing until the next refresh
+            used = self.used.setdefault(ip, set())
+            wildcard = self.used.get("", set())
+            port = self.first
+            step = 1
+            if part:
+                port = port + part[0]
+                step = part[1]
+            while True:
+                if port not in used and port not in wildcard and self.reserved.get((ip, port), now) <= now:
+                    if not self.probe:
+                        break
+                    s = self._bind(ip, port)
+                    if s:
+                        self.held[(ip, port)] = s
+                        break
+                    used.add(port)
+                port = port + step
+            self.reserved[(ip, port)] = now + self.lease
+            return port
+        finally:
+            self.lock.release()
+    def handover(self, ip, port):
+        """Close any socket holding [port] so DRBD can bind it. The lease
+        is kept until [use] or [release]."""
+        self.lock.acquire()
+        try:
+            s = self.held.pop((ip, port), None)
+            if s:
+                s.close()
+        finally:
+            self.lock.release()
+    def use(self, ip, port):
+        """Record that [port] on [ip] is now in use (by us or someone else)"""
+        self.handover(ip, port)
+        self.lock.acquire()
+        try:
+            self.reserved.pop((ip, port), None)
+            if ip not in self.used:
+                self.used[ip] = set()
+            self.used[ip].add(port)
+        finally:
+            self.lock.release()
+    def cancel(self, ip, port):
+        """End the lease on [port] if it was never used"""
+        self.handover(ip, port)
+        self.lock.acquire()
+        try:
+            self.reserved.pop((ip, port), None)
+        finally:
+            self.lock.release()
+    def release(self, ip, port):
+        """Record that [port] on [ip] is free again"""
+        self.handover(ip, port)
+        self.lock.acquire()
+        try:
+            self.reserved.pop((ip, port), None)
+            if ip in self.used:
+                self.used[ip].discard(port)
+        finally:
+            self.lock.release()
+
+# Shared by everything in this process which allocates replication ports
+port_allocator = Port_allocator()
+
 def replication_port(ip):
     """Returns a port number which is currently free. Note someone else
     may come along and allocate this one for us, so we have to be prepared
     to retry."""
-    free_port = 7789
-    used = used_ports(ip)
-    while True:
-        if free_port not in used:
-            return free_port
-        free_port = free_port + 1
-
+    return port_allocator.reserve(ip)
 
 def read_file(filename):
     f = open(filename, "r")
@@ -102,3 +459,134 @@ def read_file(filename):
         return f.readlines()
     finally:
         f.close()
+
+import unittest
+class Port_allocator_test(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.table = {
+            "127.0.0.1": set([7789, 7790]),
+            "": set([7792])
+            }
+        self.ports = Port_allocator(lease=10.0, clock=lambda:self.now, read=lambda:self.table)
+    def testParse(self):
+        """Check /proc/net/tcp and /proc/net/tcp6 lines are parsed"""
+        x = parse_proc_net_tcp([
+                "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n",
+                "   0: 0100007F:1E6D 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 662 1\n",
+                "   1: 00000000:1E6E 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 663 1\n"])
+        self.failUnless(x == { "127.0.0.1": set([7789]), "": set([7790]) })
+        x = parse_proc_net_tcp([
+                "  sl  local_address                         remote_address                        st\n",
+                "   0: 0000000000000000FFFF00000100007F:1E6D 00000000000000000000000000000000:0000 0A\n",
+                "   1: 00000000000000000000000000000000:1E6E 00000000000000000000000000000000:0000 0A\n"])
+        self.failUnless(x == { "127.0.0.1": set([7789]), "": set([7790]) })
+    def testReserve(self):
+        """Used ports, wildcard ports and leased ports are skipped"""
+        x = [ self.ports.reserve("127.0.0.1") for i in range(0, 3) ]
+        self.failUnless(x == [7791, 7793, 7794])
+        self.failUnless(self.ports.reserve("10.0.0.1") == 7789)
+    def testPart(self):
+        """Only ports in the part asked for are handed out"""
+        self.failUnless([ self.ports.reserve("127.0.0.1", [ 1, 2 ]) for i in range(0, 2) ] == [7794, 7796])
+        self.failUnless([ self.ports.reserve("127.0.0.1", [ 0, 2 ]) for i in range(0, 2) ] == [7791, 7793])
+    def testLeaseExpiry(self):
+        """An unused reservation is handed out again once it expires"""
+        x = self.ports.reserve("127.0.0.1")
+        self.now = 11.0
+        self.failUnless(self.ports.reserve("127.0.0.1") == x)
+    def testProbe(self):
+        """A probed port is held until it is handed over"""
+        ports = Port_allocator(first=20000, probe=True, read=lambda:{})
+        port = ports.reserve("127.0.0.1")
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.assertRaises(socket.error, lambda:s.bind(("127.0.0.1", port)))
+            ports.handover("127.0.0.1", port)
+            s.bind(("127.0.0.1", port))
+        finally:
+            s.close()
+    def testProbeRemembered(self):
+        """A port found in use by probing isn't probed again"""
+        ports = Port_allocator(first=20000, probe=True, read=lambda:{})
+        s = ports._bind("127.0.0.1", 20000)
+        s.listen(1)
+        try:
+            port = ports.reserve("127.0.0.1")
+            self.failUnless(port > 20000 and 20000 in ports.used["127.0.0.1"])
+            ports.cancel("127.0.0.1", port)
+        finally:
+            s.close()
+
+class Run_test(unittest.TestCase):
+    def testMetrics(self):
+        """Commands are timed and failures counted by name and task"""
+        labels = (("command", "false"), ("task", "test"))
+        before = metrics.get("drbd_manager_command_errors_total", labels) or 0
+        run(["/bin/true"], "test")
+        self.assertRaises(CommandError, lambda:run(["/bin/false"], "test"))
+        self.failUnless(metrics.get("drbd_manager_command_errors_total", labels) == before + 1)
+        self.failUnless(metrics.get("drbd_manager_command_seconds", (("command", "true"), ("task", "test"))).count >= 1)
+
+class Block_device_cache_test(unittest.TestCase):
+    def setUp(self):
+        import losetup
+        self.filename = make_sparse_file(16L * 1024L * 1024L)
+        self.losetup = losetup.Loop()
+        self.loop = self.losetup.add(self.filename)
+        self.reads = 0
+        self.cache = Block_device_cache(read=self.read)
+    def tearDown(self):
+        self.losetup.remove(self.loop)
+        os.unlink(self.filename)
+    def read(self, disk):
+        self.reads = self.reads + 1
+        return _ioctl_geometry(disk)
+    def testGeometry(self):
+        """The ioctls agree with blockdev, and aren't repeated"""
+        self.failUnless(self.cache.get(self.loop) == _blockdev_geometry(self.loop) == (512, 32768L))
+        self.cache.get(self.loop)
+        self.failUnless(self.reads == 1)
+    def testResize(self):
+        """A resized device is read again"""
+        self.cache.get(self.loop)
+        f = open(self.filename, "r+")
+        try:
+            f.truncate(32L * 1024L * 1024L)
+        finally:
+            f.close()
+        run_as_root(["losetup", "-c", self.loop])
+        self.failUnless(self.cache.get(self.loop) == (512, 65536L) and self.reads == 2)
+        self.cache.invalidate(self.loop)
+        self.cache.get(self.loop)
+        self.failUnless(self.reads == 3)
+
+class Address_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.reads = 0
+        self.cache = Address_cache(read=self.read)
+    def read(self):
+        self.reads = self.reads + 1
+        return [ ("lo", "127.0.0.1", "255.0.0.0"),
+                 ("eth0", "192.168.0.2", "255.255.255.0"),
+                 ("eth1", "10.0.0.2", "255.255.255.0") ]
+    def testSelect(self):
+        """The replication IP may be chosen by subnet or interface name"""
+        self.failUnless(self.cache.replication_ip() == "192.168.0.2")
+        self.failUnless(self.cache.replication_ip("10.0.0.0/8") == "10.0.0.2")
+        self.failUnless(self.cache.replication_ip("eth1") == "10.0.0.2")
+        self.assertRaises(NoReplicationIP, lambda:self.cache.replication_ip("eth2"))
+    def testCache(self):
+        """Interfaces are only re-read after an invalidation"""
+        self.cache.replication_ip()
+        self.cache.replication_ip()
+        self.failUnless(self.reads == 1)
+        self.cache.invalidate()
+        self.cache.replication_ip()
+        self.failUnless(self.reads == 2)
+    def testKernel(self):
+        """The kernel reports the loopback interface"""
+        self.failUnless(("lo", "127.0.0.1", "255.0.0.0") in list_ipv4_interfaces())
+
+if __name__ == "__main__":
+    unittest.main()